@@ -8,9 +8,12 @@ import sys
 import time
 from datetime import datetime, timedelta
 
+from mcm.config import Config
 from mcm.consul import Consul
+from mcm.heartbeat import Heartbeat
 from mcm.mysql import Mysql
 from mcm.proxysql import Proxysql
+from mcm.semi_sync import SemiSync
 from mcm.snapshot import Snapshot
 from mcm.utils import Utils
 
@@ -20,6 +23,10 @@ class Actions:
 
     consul_process = None
     mysql_process = None
+    heartbeat = None
+
+    # Maximum time (in seconds) a switchover may pause the writes
+    switchover_timeout = 30
 
     @staticmethod
     def join_or_bootstrap():
@@ -34,6 +41,12 @@ class Actions:
         # Use this backup if exists, or init a new MySQL database
         snapshotExists = Snapshot.exists()
 
+        # Stop the heartbeat if the leadership is lost with the session
+        Consul.get_instance().leadership_lost_callback = Actions.stop_heartbeat
+
+        # Keep session alive from now on, independent of blocking operations
+        Consul.get_instance().start_session_keepalive()
+
         # Test for unstable environment (other nodes are present and no leader is present)
         # We don't want to become the new leader on the restored backup directly
         #
@@ -52,9 +65,6 @@ class Actions:
         # Try to become session leader (needed to decide if we can create a database)
         replication_leader = Consul.get_instance().try_to_become_replication_leader()
 
-        # Keep session alive until we start the main loop
-        Consul.get_instance().start_session_auto_refresh_thread()
-
         # Register node
         Consul.get_instance().register_node()
 
@@ -106,12 +116,12 @@ class Actions:
         # Remove the old replication configuration (e.g., from backup)
         Mysql.delete_replication_config()
 
+        if replication_leader:
+            Actions.start_heartbeat()
+
         # Register service as leader or follower
         Consul.get_instance().register_service(replication_leader)
 
-        # Session keep alive will be handled by the main event loop
-        Consul.get_instance().stop_session_auto_refresh_thread()
-
         # Make an initial snapshot from leader
         if needInitialSnapshot:
             Snapshot.create(fromSource=True)
@@ -128,8 +138,10 @@ class Actions:
         """
 
         last_backup_check = None
-        last_session_refresh = None
+        last_local_ip_check = None
+        last_consul_role_check = None
         last_replication_leader_check = None
+        last_semi_sync_check = None
         replication_failure_count = 0
         max_replication_failures = 12
         replication_lag_count = 0
@@ -137,9 +149,13 @@ class Actions:
 
         proxysql = Proxysql()
 
-        # Main Loop, heavy operations needs to be dispatched
-        # to an extra thread. The loop needs to refresh the
-        # Consul sessions every few seconds.
+        # Membership and leader changes are pushed by blocking query watches
+        Consul.get_instance().start_instances_watch_thread()
+        Consul.get_instance().start_leader_watch_thread()
+
+        # Main Loop, the Consul sessions are kept alive by the
+        # keep-alive scheduler, so the loop may block on slow
+        # MySQL or backup operations.
         while True:
             if Actions.consul_process.poll() is not None:
                 logging.error(
@@ -155,19 +171,34 @@ class Actions:
                 )
                 sys.exit(1)
 
+            # Update ProxySQL nodes as soon as the membership or the leader changes
+            if (
+                Consul.get_instance().instances_changed.is_set()
+                or Consul.get_instance().leader_changed.is_set()
+            ):
+                Consul.get_instance().instances_changed.clear()
+                mysql_nodes = Consul.get_instance().get_all_registered_nodes()
+                proxysql.update_mysql_server_if_needed(
+                    mysql_nodes, Consul.get_instance().get_replication_leader_ip()
+                )
+
+            # Check the replication leader immediately if the leader key changed
+            if Consul.get_instance().leader_changed.is_set():
+                Consul.get_instance().leader_changed.clear()
+                last_replication_leader_check = None
+
             # Try to replace a failed replication leader
             if Utils.is_refresh_needed(
                 last_replication_leader_check, timedelta(seconds=5)
             ):
                 last_replication_leader_check = datetime.now()
 
-                # Update ProxySQL nodes
-                mysql_nodes = Consul.get_instance().get_all_registered_nodes()
-                proxysql.update_mysql_server_if_needed(mysql_nodes)
-
                 replication_leader = Consul.get_instance().is_replication_leader()
                 replication_healthy = False
 
+                # Follow a leader key handed over by a switchover
+                Actions.sync_replication_leader_role(replication_leader)
+
                 # Allow an unhealthy replica 60 seconds to restart before killing it off
                 if replication_leader:
                     replication_failure_count = 0
@@ -201,14 +232,25 @@ class Actions:
                     else:
                         replication_lag_count = 0
 
-                # Attempt to become leader if the replica is healthy - this will only occur if the original leader
-                # has gone offline. Do not promote if currently snapshotting.
-                if not replication_leader and replication_healthy and not Snapshot.is_snapshotting:
-                    promotion = Consul.get_instance().try_to_become_replication_leader()
+                # Take part in the leader election if the original leader has gone offline. The
+                # replica with the most advanced GTID position wins, the IO thread of the candidates
+                # is allowed to fail as the leader is gone. Do not promote if currently snapshotting.
+                if (
+                    not replication_leader
+                    and not Snapshot.is_snapshotting
+                    and Consul.get_instance().get_replication_leader_ip() is None
+                ):
+                    promotion = False
+                    election_state = Mysql.get_election_state()
+
+                    if election_state is not None:
+                        promotion = Consul.get_instance().elect_replication_leader(election_state)
 
                     # Are we the new leader?
                     if promotion:
+                        Mysql.reset_replication_health()
                         Mysql.delete_replication_config()
+                        Actions.start_heartbeat()
                         Consul.get_instance().register_service(True)
                         replication_leader = True
 
@@ -225,19 +267,190 @@ class Actions:
                         )
                         Mysql.change_to_replication_client(real_leader)
 
-            # Keep Consul sessions alive
-            if Utils.is_refresh_needed(last_session_refresh, timedelta(seconds=5)):
-                Consul.get_instance().refresh_sessions()
-                last_session_refresh = datetime.now()
+            # Adapt semi-sync replication to the healthy replicas and their latency
+            if SemiSync.is_enabled() and Utils.is_refresh_needed(
+                last_semi_sync_check, timedelta(seconds=10)
+            ):
+                if Consul.get_instance().is_replication_leader():
+                    local_ip = Consul.get_instance().local_ip
+                    replica_ips = [
+                        ip_address
+                        for ip_address in Consul.get_instance().get_all_registered_nodes()
+                        if ip_address != local_ip
+                    ]
+                    SemiSync.tune_source(replica_ips)
+                last_semi_sync_check = datetime.now()
+
+            # Detect interface changes of the cached local IP
+            if Utils.is_refresh_needed(last_local_ip_check, timedelta(seconds=30)):
+                Consul.get_instance().check_local_ip()
+                last_local_ip_check = datetime.now()
+
+            # Replace Consul servers that left the cluster
+            if Utils.is_refresh_needed(last_consul_role_check, timedelta(seconds=30)):
+                if Consul.get_instance().should_promote_agent():
+                    Actions.promote_consul_agent()
+                last_consul_role_check = datetime.now()
 
             # Create MySQL Backups (using extra thread for backup)
             if Utils.is_refresh_needed(last_backup_check, timedelta(minutes=1)):
-                Consul.get_instance().start_session_auto_refresh_thread()
                 Mysql.create_backup_if_needed()
                 last_backup_check = datetime.now()
-                Consul.get_instance().stop_session_auto_refresh_thread()
 
-            time.sleep(1)
+            # Sleep until the next tick, or wake up on a membership or leader change
+            Consul.get_instance().wait_for_change(1)
+
+    @staticmethod
+    def start_heartbeat():
+        """
+        Start writing the replication heartbeat (on the replication leader)
+        """
+        interval_ms = Config.get().heartbeat_interval_ms
+
+        if interval_ms <= 0:
+            logging.info("Replication heartbeat is disabled")
+            return
+
+        if Actions.heartbeat is None:
+            Actions.heartbeat = Heartbeat(interval_ms)
+
+        Actions.heartbeat.start()
+
+    @staticmethod
+    def stop_heartbeat():
+        """
+        Stop writing the replication heartbeat
+        """
+        if Actions.heartbeat is not None:
+            Actions.heartbeat.stop()
+
+    @staticmethod
+    def sync_replication_leader_role(replication_leader):
+        """
+        Promote or demote the local node if the replication leader key was
+        handed over by a switchover
+        """
+        consul_client = Consul.get_instance()
+
+        if replication_leader and not consul_client.replication_leader:
+            logging.info("Replication leadership was handed over to this node")
+            Mysql.reset_replication_health()
+            Mysql.delete_replication_config()
+            Actions.start_heartbeat()
+            consul_client.register_service(True)
+            consul_client.set_replication_leader_role(True)
+            return
+
+        # Only demote if another node holds the key (not on a failed read)
+        if not replication_leader and consul_client.replication_leader:
+            leader_ip = consul_client.get_replication_leader_ip()
+
+            if leader_ip is None or leader_ip == consul_client.local_ip:
+                return
+
+            logging.info("Replication leadership was handed over to %s", leader_ip)
+            Mysql.set_read_only(True)
+            Actions.stop_heartbeat()
+            consul_client.register_service(False)
+            consul_client.set_replication_leader_role(False)
+
+    @staticmethod
+    def switchover(target_ip=None):
+        """
+        Hand the replication leadership over to a replica. Writes are paused
+        (the leader is read-only) until the target has applied all
+        transactions of the leader and took over the leader key.
+        """
+        consul_client = Consul.get_instance()
+        leader_entry = consul_client.get_replication_leader_entry()
+
+        if consul_client.get_replication_leader_ip() != consul_client.local_ip:
+            logging.error("Switchover must be executed on the replication leader")
+            sys.exit(1)
+
+        if target_ip is None:
+            target_ip = consul_client.get_switchover_target()
+
+        if target_ip is None or target_ip == consul_client.local_ip:
+            logging.error("No replica available for the switchover")
+            sys.exit(1)
+
+        target_session = consul_client.get_node_session(target_ip)
+        if target_session is None:
+            logging.error("Node %s is not registered in Consul", target_ip)
+            sys.exit(1)
+
+        logging.info("Switching the replication leader over to %s", target_ip)
+
+        # Pause the writes and wait for the target to apply them all
+        pause_start = time.monotonic()
+        Mysql.set_read_only(True)
+
+        gtid_executed = Mysql.execute_query_as_root(
+            "SELECT @@GLOBAL.gtid_executed AS gtid_executed"
+        )[0]["gtid_executed"]
+
+        handed_over = Mysql.wait_for_gtid_set_on_node(
+            target_ip, gtid_executed, Actions.switchover_timeout
+        ) and consul_client.hand_over_replication_leader(
+            leader_entry, target_ip, target_session
+        )
+
+        if not handed_over:
+            logging.error("Switchover to %s failed, resuming writes", target_ip)
+            Mysql.set_read_only(False)
+            consul_client.destroy_session()
+            sys.exit(1)
+
+        # The target promotes itself as soon as its leader watch fires
+        deadline = pause_start + Actions.switchover_timeout
+        writable = False
+
+        while not writable and time.monotonic() < deadline:
+            try:
+                writable = (
+                    Mysql.execute_query_on_node(
+                        target_ip, "SELECT @@GLOBAL.read_only AS read_only"
+                    )[0]["read_only"]
+                    == 0
+                )
+            except Exception as err:
+                logging.debug("Unable to check the target: %s", err)
+
+            if not writable:
+                time.sleep(0.01)
+
+        consul_client.destroy_session()
+
+        if not writable:
+            logging.error("Node %s did not become writable", target_ip)
+            sys.exit(1)
+
+        logging.info(
+            "Switchover to %s done, writes were paused for %.3f seconds",
+            target_ip,
+            time.monotonic() - pause_start,
+        )
+
+    @staticmethod
+    def promote_consul_agent():
+        """
+        Restart the local Consul agent as a server
+        """
+        logging.info("Restarting the Consul agent as a server")
+
+        subprocess.run(["consul", "leave"])
+        Actions.consul_process.terminate()
+
+        try:
+            Actions.consul_process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            logging.warning("Consul agent did not stop, killing it")
+            Actions.consul_process.kill()
+            Actions.consul_process.wait()
+
+        Actions.consul_process = Consul.agent_start(server=True)
+        Consul.get_instance().finish_agent_promotion()
 
     @staticmethod
     def execute_file():
@@ -272,10 +485,10 @@ class Actions:
             [
                 "mysql",
                 "-u",
-                Utils.get_envvar_or_secret("MYSQL_USER"),
-                "-p" + Utils.get_envvar_or_secret("MYSQL_PASSWORD"),
+                Config.get().mysql_user,
+                "-p" + Config.get().mysql_password,
                 "-D",
-                Utils.get_envvar_or_secret("MYSQL_DATABASE"),
+                Config.get().mysql_database,
             ],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
@@ -290,6 +503,14 @@ class Actions:
         Snapshot.create(fromSource=True, force=True)
         Mysql.server_stop()
 
+    @staticmethod
+    def reload_handler(signum, frame):
+        """
+        Reload handler for the configuration
+        """
+        logging.info("Received signal %s, reloading configuration", signum)
+        Config.request_reload()
+
     @staticmethod
     def terminate_handler(signum, frame):
         """
@@ -303,9 +524,13 @@ class Actions:
         logging.info("Received signal %s, terminating...", signum)
 
         if Consul.get_instance().node_health_session is not None:
-            Consul.get_instance().stop_session_auto_refresh_thread()
+            Consul.get_instance().stop_instances_watch_thread()
+            Consul.get_instance().stop_leader_watch_thread()
+            Consul.get_instance().stop_session_keepalive()
             Consul.get_instance().destroy_session()
 
+        Actions.stop_heartbeat()
+
         # Leave cluster and stop the consul agent
         if Actions.consul_process is not None:
             subprocess.run(["consul", "leave"])
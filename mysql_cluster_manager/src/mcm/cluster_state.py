@@ -0,0 +1,143 @@
+"""This file contains the cached view of the cluster state"""
+
+import json
+import logging
+
+
+class ClusterState:
+    """
+    Immutable, parsed view of the nodes registered in Consul. Node records
+    are keyed by the Consul ModifyIndex of their KV entry, so only changed
+    nodes are parsed again on an update.
+    """
+
+    # Node fields published in the topology document
+    topology_fields = (
+        "restoring",
+        "snapshotting",
+        "replication_unhealthy",
+        "replication_lag_ms",
+        "gtid_backlog",
+    )
+
+    def __init__(self, index=None, nodes=None, modify_indexes=None):
+        """
+        Init the state and precompute the aggregates
+        """
+        self.index = index
+        self.nodes = nodes if nodes is not None else {}
+        self.modify_indexes = modify_indexes if modify_indexes is not None else {}
+
+        self.any_restoring = False
+        self.any_snapshotting = False
+        routable_ips = []
+
+        for node_data in self.nodes.values():
+            if node_data.get("restoring") is True:
+                self.any_restoring = True
+
+            if node_data.get("snapshotting") is True:
+                self.any_snapshotting = True
+
+            if ClusterState.is_routable(node_data):
+                routable_ips.append(node_data["ip_address"])
+
+        routable_ips.sort()
+        self.routable_ips = tuple(routable_ips)
+
+    def update(self, index, entries):
+        """
+        Get the state for the given Consul index and KV entries. Returns
+        this instance if the index is unchanged.
+        """
+        if index is not None and index == self.index:
+            return self
+
+        nodes = {}
+        modify_indexes = {}
+
+        for entry in entries if entries is not None else []:
+            key = entry["Key"]
+            modify_index = entry["ModifyIndex"]
+
+            # Reuse the parsed record if the node did not change
+            if self.modify_indexes.get(key) == modify_index:
+                nodes[key] = self.nodes[key]
+                modify_indexes[key] = modify_index
+                continue
+
+            try:
+                node_data = json.loads(entry["Value"])
+            except (TypeError, ValueError):
+                logging.error("Invalid node data in %s", entry)
+                continue
+
+            nodes[key] = node_data
+            modify_indexes[key] = modify_index
+
+        return ClusterState(index, nodes, modify_indexes)
+
+    def topology(self, leader_ip):
+        """
+        Get the compact topology document of the state, as published by the
+        replication leader. The version is the Consul index of the state.
+        """
+        nodes = {}
+
+        for node_data in self.nodes.values():
+            if not "ip_address" in node_data:
+                continue
+
+            ip_address = node_data["ip_address"]
+            record = {"ip_address": ip_address}
+            record["role"] = "leader" if ip_address == leader_ip else "replica"
+
+            for field in ClusterState.topology_fields:
+                if field in node_data:
+                    record[field] = node_data[field]
+
+            nodes[ip_address] = record
+
+        return {
+            "version": self.index,
+            "leader": leader_ip,
+            "nodes": nodes,
+            "routable_ips": list(self.routable_ips),
+        }
+
+    @staticmethod
+    def from_topology(document):
+        """
+        Get the state of a topology document
+        """
+        return ClusterState(document.get("version"), document.get("nodes", {}))
+
+    @staticmethod
+    def is_routable(node_data):
+        """
+        Can queries be routed to the node
+        """
+        if not "ip_address" in node_data:
+            logging.error("ip_address missing in %s", node_data)
+            return False
+
+        # Never skip the replication leader, the writer hostgroup would be empty
+        if (
+            node_data.get("replication_leader") is True
+            or node_data.get("role") == "leader"
+        ):
+            return True
+
+        if node_data.get("restoring") is True:
+            logging.debug("Skipping node %s as it is currently restoring", node_data)
+            return False
+
+        if node_data.get("snapshotting") is True:
+            logging.debug("Skipping node %s as it is currently snapshotting", node_data)
+            return False
+
+        if node_data.get("replication_unhealthy") is True:
+            logging.debug("Skipping node %s as replication is unhealthy", node_data)
+            return False
+
+        return True
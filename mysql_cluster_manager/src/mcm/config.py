@@ -0,0 +1,190 @@
+"""This file contains the runtime configuration of the cluster manager"""
+
+import logging
+import os
+import threading
+import time
+
+from mcm.utils import Utils
+
+
+class Config:
+    """
+    Immutable, typed runtime configuration. All settings are parsed once
+    from the environment and the secret files. The configuration is only
+    reloaded on SIGHUP or when a secret file changed, so hot paths never
+    touch the environment or the filesystem.
+    """
+
+    # The settings as (attribute, variable, default, type). Settings without
+    # default are None if not set, "path" settings are read from the
+    # environment only.
+    settings = (
+        ("mysql_root_password", "MYSQL_ROOT_PASSWORD", None, str),
+        ("mysql_user", "MYSQL_USER", None, str),
+        ("mysql_password", "MYSQL_PASSWORD", None, str),
+        ("mysql_database", "MYSQL_DATABASE", None, str),
+        ("mysql_backup_user", "MYSQL_BACKUP_USER", None, str),
+        ("mysql_backup_password", "MYSQL_BACKUP_PASSWORD", None, str),
+        ("mysql_replication_user", "MYSQL_REPLICATION_USER", None, str),
+        ("mysql_replication_password", "MYSQL_REPLICATION_PASSWORD", None, str),
+        ("proxysql_admin_password", "PROXYSQL_ADMIN_PASSWORD", "admin", str),
+        ("tls_ca", "MYSQL_TLS_CA", None, "path"),
+        ("tls_cert", "MYSQL_TLS_CERT", None, "path"),
+        ("tls_key", "MYSQL_TLS_KEY", None, "path"),
+        ("tls_required", "MYSQL_TLS_REQUIRED", "True", bool),
+        ("replication_lag_threshold", "MYSQL_REPLICATION_LAG_THRESHOLD", "5", int),
+        ("replication_routing_lag_ms", "MYSQL_REPLICATION_ROUTING_LAG_MS", None, int),
+        ("heartbeat_interval_ms", "MYSQL_HEARTBEAT_INTERVAL_MS", "100", int),
+        ("replica_parallel_workers", "MYSQL_REPLICA_PARALLEL_WORKERS", "0", int),
+        ("innodb_buffer_pool_size", "MYSQL_INNODB_BUFFER_POOL_SIZE", None, str),
+        ("innodb_redo_log_capacity", "MYSQL_INNODB_REDO_LOG_CAPACITY", None, str),
+        ("innodb_io_capacity", "MYSQL_INNODB_IO_CAPACITY", None, int),
+        ("semi_sync", "MYSQL_SEMI_SYNC", "false", bool),
+        ("semi_sync_timeout_ms", "MYSQL_SEMI_SYNC_TIMEOUT_MS", "0", int),
+        ("snapshot_minutes", "SNAPSHOT_MINUTES", "15", int),
+        ("consul_bootstrap_service", "CONSUL_BOOTSTRAP_SERVICE", "mysql", str),
+        ("consul_bootstrap_expect", "CONSUL_BOOTSTRAP_EXPECT", "3", int),
+        ("consul_max_servers", "CONSUL_MAX_SERVERS", "5", int),
+        ("consul_enable_ui", "CONSUL_ENABLE_UI", "false", bool),
+        ("consul_session_ttl", "CONSUL_SESSION_TTL", "15", int),
+        ("consul_lock_delay", "CONSUL_LOCK_DELAY", "0", int),
+        ("consul_ready_timeout", "CONSUL_READY_TIMEOUT", "60", int),
+    )
+
+    __slots__ = tuple(setting[0] for setting in settings) + ("tls_enabled",)
+
+    # Interval (in seconds) of the secret file modification checks
+    check_interval = 10
+
+    # The current configuration and the reload state
+    _current = None
+    _lock = threading.Lock()
+    _reload_requested = False
+    _last_check = 0
+    _secret_mtimes = {}
+
+    def __init__(self, values):
+        """
+        Init the configuration from the parsed values
+        """
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+        object.__setattr__(
+            self,
+            "tls_enabled",
+            bool(self.tls_ca and self.tls_cert and self.tls_key),
+        )
+
+        # The routing lag defaults to the lag threshold
+        if self.replication_routing_lag_ms is None:
+            object.__setattr__(
+                self,
+                "replication_routing_lag_ms",
+                self.replication_lag_threshold * 1000,
+            )
+
+    def __setattr__(self, name, value):
+        raise AttributeError("The configuration is immutable")
+
+    @staticmethod
+    def get():
+        """
+        Get the current configuration. The secret files are only checked
+        for modifications every check_interval seconds.
+        """
+        current = Config._current
+
+        if (
+            current is not None
+            and not Config._reload_requested
+            and time.monotonic() - Config._last_check < Config.check_interval
+        ):
+            return current
+
+        with Config._lock:
+            if Config._current is None or Config._reload_requested:
+                Config.reload()
+            elif Config.get_secret_mtimes() != Config._secret_mtimes:
+                logging.info("Secret files changed, reloading the configuration")
+                Config.reload()
+
+            Config._last_check = time.monotonic()
+            return Config._current
+
+    @staticmethod
+    def request_reload():
+        """
+        Reload the configuration on the next access (safe to call from
+        a signal handler)
+        """
+        Config._reload_requested = True
+
+    @staticmethod
+    def reload():
+        """
+        Parse the configuration and replace the current one atomically. On
+        errors, the current configuration is kept.
+        """
+        Config._reload_requested = False
+        secret_mtimes = Config.get_secret_mtimes()
+
+        try:
+            config = Config.load()
+        except ValueError as err:
+            if Config._current is None:
+                raise
+
+            logging.error("Invalid configuration, keeping the current one: %s", err)
+            return
+
+        Config._secret_mtimes = secret_mtimes
+        Config._current = config
+        logging.debug("Configuration loaded")
+
+    @staticmethod
+    def load():
+        """
+        Parse all settings
+        """
+        values = {}
+
+        for name, variable, default, kind in Config.settings:
+            if kind == "path":
+                values[name] = Utils.get_envvar(variable, False) or None
+                continue
+
+            try:
+                value = Utils.get_envvar_or_secret(variable, default)
+            except Exception:
+                value = None
+
+            if value is not None and kind is int:
+                value = int(value)
+            elif value is not None and kind is bool:
+                value = value.lower() == "true" or value == "1"
+
+            values[name] = value
+
+        return Config(values)
+
+    @staticmethod
+    def get_secret_mtimes():
+        """
+        Get the modification times of all configured secret files
+        """
+        mtimes = {}
+
+        for _, variable, _, _ in Config.settings:
+            secret_file = os.environ.get(f"{variable}_FILE")
+
+            if secret_file is None:
+                continue
+
+            try:
+                mtimes[secret_file] = os.stat(secret_file).st_mtime_ns
+            except OSError:
+                mtimes[secret_file] = None
+
+        return mtimes
@@ -1,5 +1,6 @@
 """This file is part of the MySQL cluster manager"""
 
+import base64
 import json
 import logging
 import socket
@@ -8,10 +9,16 @@ import sys
 import threading
 import time
 
-import consul as pyconsul
 import netifaces
+import requests
+from consul.exceptions import ClientError
 
-from mcm.utils import Utils
+from mcm.cluster_state import ClusterState
+from mcm.config import Config
+from mcm.consul_client import PooledConsul
+from mcm.gtid import Gtid
+from mcm.retry import RetryPolicy
+from mcm.session_keepalive import SessionKeepAlive
 
 
 class Consul:
@@ -37,9 +44,73 @@ class Consul:
     # Replication leader path
     replication_leader_path = kv_prefix + "replication_leader"
 
-    def __init__(self):
+    # Topology document published by the replication leader
+    topology_path = kv_prefix + "topology"
+
+    # GTID states published by the replicas during a leader election
+    gtid_state_path = kv_prefix + "gtid_state/"
+
+    # Lock key held by the node promoting its agent to a server
+    agent_promotion_path = kv_prefix + "consul_promotion"
+
+    # TTL (in seconds) of the session holding the promotion lock
+    agent_promotion_ttl = 120
+
+    # The cached local IP
+    local_ip_address = None
+
+    # Role of the local agent (True = server, False = client)
+    agent_server = None
+
+    # Retry policies per operation class, the deadlines keep every call
+    # well within the session TTL
+    read_retry = RetryPolicy("Consul read", deadline=5)
+    write_retry = RetryPolicy("Consul write", deadline=5)
+    session_retry = RetryPolicy("Consul session", deadline=10)
+
+    # Short backoff while waiting for the local agent to become ready
+    readiness_retry = RetryPolicy(
+        "Consul readiness", deadline=60, initial_delay=0.05, max_delay=0.5
+    )
+
+    # Monotonic start time of the local agent, for the startup metrics
+    agent_start_time = None
+
+    # Maximum duration of a blocking query before it returns unchanged
+    watch_wait = "30s"
+
+    # Without a valid topology document, the registered nodes are read
+    # at this interval
+    topology_fallback_wait = "5s"
+
+    # Time (in seconds) for the other candidates to publish their GTID state
+    election_settle_time = 2
+
+    # Age (in seconds) after which a published GTID state is ignored
+    election_state_max_age = 15
+
+    # Maximum age (in seconds) of the cluster state when it is not watched
+    cluster_state_max_age = 1
+
+    # Resolution of the replication lag (in ms) and the GTID backlog in the
+    # node document. Smaller values are published as 0, larger values are
+    # rounded down to the resolution times a power of two, so the document
+    # (and the topology) only changes when the lag changes significantly.
+    replication_lag_resolution_ms = 1000
+    gtid_backlog_resolution = 100
+
+    # Replica health fields reset in the node document of a new leader, a
+    # flag left over from its time as a replica would stop the routing
+    leader_health_fields = {
+        "replication_unhealthy": False,
+        "replication_lag_ms": 0,
+        "gtid_backlog": 0,
+    }
+
+    def __init__(self, client=None):
         """
-        Init the Consul client
+        Init the Consul client. A client (e.g., the InMemoryConsul stand-in)
+        can be injected instead of connecting to the local agent.
         """
         if Consul.__instance is not None:
             raise Exception("This class is a singleton!")
@@ -47,26 +118,74 @@ class Consul:
         Consul.__instance = self
         logging.info("Register Consul connection")
 
-        # Allow 30 seconds for Consul agent to start
-        for _ in range(6):
+        self.client = client
+
+        # Allow 30 seconds for the Consul client to be created
+        for _ in Consul.session_retry.attempts(deadline=30):
+            if self.client:
+                break
+
             try:
-                self.client = pyconsul.Consul()
+                self.client = PooledConsul()
+                break
             except:
-                logging.warning("Unable to connect to Consul, retrying in 5 seconds")
-                time.sleep(5)
-                continue
+                logging.warning("Unable to connect to Consul, retrying")
 
         if not self.client:
             raise Exception("Unable to establish a connection with Consul")
 
+        if client is None and not Consul.wait_for_agent(self.client):
+            logging.error("Consul agent is not ready, trying to continue")
+
+        # TTL (in seconds, Consul enforces at least 10) and lock-delay of the
+        # node health session
+        self.session_ttl = max(10, Config.get().consul_session_ttl)
+        self.session_lock_delay = Config.get().consul_lock_delay
+
         self.node_health_session = None
+        self.time_to_first_session = None
+        self.promotion_session = None
         self.create_node_health_session()
-        self.mysql_version = None
-        self.server_id = None
 
-        # The session auto refresh thread
-        self.auto_refresh_thread = None
-        self.run_auto_refresh_thread = False
+        # The authoritative local node document and its last known ModifyIndex
+        self.node_document = None
+        self.node_document_index = None
+        self.node_document_pending = False
+        self.replication_leader = False
+
+        # Called when the local replication leadership is lost with the session
+        self.leadership_lost_callback = None
+
+        # The session keep-alive scheduler
+        self.session_keepalive = SessionKeepAlive(self, self.session_ttl)
+
+        # Guards the node document against concurrent session recreation
+        self.node_document_lock = threading.RLock()
+
+        # The registered nodes watch thread
+        self.instances_watch_thread = None
+        self.run_instances_watch_thread = False
+        self.instances_index = None
+        self.instances_changed = threading.Event()
+
+        # The topology document, watched by all nodes except the leader
+        self.topology_index = None
+        self.topology_accepted = False
+        self.published_topology = None
+
+        # The replication leader watch thread
+        self.leader_watch_thread = None
+        self.run_leader_watch_thread = False
+        self.leader_index = None
+        self.leader_entry = None
+        self.leader_changed = threading.Event()
+
+        # Set by all watches to wake up the main loop
+        self.watch_event = threading.Event()
+
+        # The cached cluster state
+        self.cluster_state = ClusterState()
+        self.cluster_state_read_time = None
 
     @staticmethod
     def get_instance():
@@ -76,36 +195,285 @@ class Consul:
 
         return Consul.__instance
 
-    def start_session_auto_refresh_thread(self):
+    @staticmethod
+    def reset_instance():
+        """
+        Drop the singleton instance, so a new one (e.g., with another
+        injected client) can be created
+        """
+        Consul.__instance = None
+
+    def start_session_keepalive(self):
+        """
+        Start the session keep-alive scheduler (if not already running)
+        """
+        self.session_keepalive.start()
+
+    def stop_session_keepalive(self):
+        """
+        Stop the session keep-alive scheduler
+        """
+        self.session_keepalive.stop()
+
+    def start_instances_watch_thread(self):
+        """
+        Start the thread watching the registered nodes via blocking queries
+        """
+        if self.instances_watch_thread is not None:
+            return
+
+        logging.info("Starting the Consul registered nodes watch thread")
+        self.run_instances_watch_thread = True
+        self.instances_watch_thread = threading.Thread(
+            target=self.watch_instances, args=(), daemon=True
+        )
+        self.instances_watch_thread.start()
+
+    def watch_instances(self):
+        """
+        Keep the cluster state up to date and signal every change through
+        the instances_changed event. The replication leader watches the
+        instances prefix and publishes the topology document, all other
+        nodes only watch the topology document.
+        """
+        while self.run_instances_watch_thread:
+            try:
+                if self.replication_leader:
+                    changed = self.watch_instances_prefix()
+
+                    if changed:
+                        self.publish_topology(self.cluster_state)
+                else:
+                    changed = self.watch_topology()
+            except:
+                logging.warning(
+                    "Unable to watch registered nodes in Consul, retrying in 1 second"
+                )
+                time.sleep(1)
+                continue
+
+            if not changed:
+                logging.debug("Registered nodes watch timed out without changes")
+                continue
+
+            logging.debug(
+                "Registered nodes changed (index=%s)", self.cluster_state.index
+            )
+            self.instances_changed.set()
+            self.watch_event.set()
+
+    def watch_instances_prefix(self):
+        """
+        Long-poll the instances prefix with the last seen X-Consul-Index.
+        Returns True if the cluster state changed.
+        """
+        index, result = self.client.kv.get(
+            Consul.instances_path,
+            index=self.instances_index,
+            recurse=True,
+            wait=Consul.watch_wait,
+        )
+
+        index = int(index)
+        last_index = self.cluster_state.index
+
+        # The index must be reset if it goes backwards (e.g., Consul snapshot restore)
+        if self.instances_index is not None and index < self.instances_index:
+            logging.debug("Consul index went backwards, resetting watch")
+            self.instances_index = None
+            return False
+
+        self.cluster_state = self.cluster_state.update(index, result)
+        self.instances_index = index
+
+        return index != last_index
+
+    def watch_topology(self):
+        """
+        Long-poll the topology document with the last seen X-Consul-Index.
+        The document is only accepted if it was published by the current
+        replication leader, otherwise the instances prefix is read at the
+        fallback interval. Returns True if the cluster state changed.
+        """
+        wait = (
+            Consul.watch_wait
+            if self.topology_accepted
+            else Consul.topology_fallback_wait
+        )
+
+        index, entry = self.client.kv.get(
+            Consul.topology_path, index=self.topology_index, wait=wait
+        )
+
+        index = int(index)
+
+        if self.topology_index is not None and index < self.topology_index:
+            logging.debug("Consul index went backwards, resetting watch")
+            self.topology_index = None
+            return False
+
+        last_state = self.cluster_state
+        document = Consul.parse_topology(entry)
+        leader_ip = self.get_replication_leader_ip()
+
+        if (
+            document is not None
+            and leader_ip is not None
+            and document.get("leader") == leader_ip
+        ):
+            self.topology_accepted = True
+            state = ClusterState.from_topology(document)
+        else:
+            if self.topology_accepted:
+                logging.info("Topology document is stale, reading registered nodes")
+
+            self.topology_accepted = False
+            prefix_index, result = self.client.kv.get(
+                Consul.instances_path, recurse=True
+            )
+            state = last_state.update(int(prefix_index), result)
+
+        self.cluster_state = state
+        self.topology_index = index
+
+        return state.nodes != last_state.nodes
+
+    @staticmethod
+    def parse_topology(entry):
+        """
+        Parse the KV entry of the topology document
+        """
+        if entry is None or entry["Value"] is None:
+            return None
+
+        try:
+            return json.loads(entry["Value"])
+        except ValueError:
+            logging.error("Invalid topology document %s", entry["Value"])
+            return None
+
+    def publish_topology(self, state=None):
+        """
+        Publish the topology document of the given (default: a freshly read)
+        cluster state. The key is locked with the node health session, so it
+        is removed when the leader is gone. Returns True on success.
+        """
+        try:
+            if state is None:
+                index, result = self.client.kv.get(Consul.instances_path, recurse=True)
+                state = self.cluster_state.update(int(index), result)
+                self.cluster_state = state
+
+            document = state.topology(self.local_ip)
+
+            # Skip the write if only the version changed
+            if self.published_topology is not None and dict(
+                document, version=None
+            ) == dict(self.published_topology, version=None):
+                return True
+
+            published = self.client.kv.put(
+                Consul.topology_path,
+                json.dumps(document),
+                acquire=self.node_health_session,
+            )
+        except:
+            logging.warning("Unable to publish the topology document")
+            return False
+
+        if not published:
+            logging.warning("Topology document is locked by another node")
+            return False
+
+        logging.debug("Published topology document (version=%s)", document["version"])
+        self.published_topology = document
+        return True
+
+    def stop_instances_watch_thread(self):
+        """
+        Stop the registered nodes watch thread. The thread is a daemon and is
+        not joined, as it might be blocked in a long-poll.
+        """
+        logging.info("Stopping the Consul registered nodes watch thread")
+        self.run_instances_watch_thread = False
+        self.instances_watch_thread = None
+        self.instances_index = None
+        self.topology_index = None
+        self.topology_accepted = False
+
+    def start_leader_watch_thread(self):
         """
-        Start the session auto refresh thread
+        Start the thread watching the replication leader key via blocking queries
         """
-        logging.info("Starting the Consul session auto refresh thread")
-        self.run_auto_refresh_thread = True
-        self.auto_refresh_thread = threading.Thread(
-            target=self.auto_refresh_sessions, args=()
+        if self.leader_watch_thread is not None:
+            return
+
+        logging.info("Starting the Consul replication leader watch thread")
+        self.run_leader_watch_thread = True
+        self.leader_watch_thread = threading.Thread(
+            target=self.watch_replication_leader, args=(), daemon=True
         )
-        self.auto_refresh_thread.start()
+        self.leader_watch_thread.start()
+
+    def watch_replication_leader(self):
+        """
+        Long-poll the replication leader key and signal every change (e.g., the
+        release of the key by a failed leader) through the leader_changed event
+        """
+        while self.run_leader_watch_thread:
+            try:
+                index, result = self.client.kv.get(
+                    Consul.replication_leader_path,
+                    index=self.leader_index,
+                    wait=Consul.watch_wait,
+                )
+            except:
+                logging.warning(
+                    "Unable to watch replication leader in Consul, retrying in 1 second"
+                )
+                time.sleep(1)
+                continue
+
+            index = int(index)
+
+            # The index must be reset if it goes backwards (e.g., Consul snapshot restore)
+            if self.leader_index is not None and index < self.leader_index:
+                logging.debug("Consul index went backwards, resetting watch")
+                self.leader_index = None
+                continue
+
+            if index == self.leader_index:
+                logging.debug("Replication leader watch timed out without changes")
+                continue
+
+            self.leader_entry = result
+            self.leader_index = index
 
-    def auto_refresh_sessions(self):
+            if result is None or result.get("Session") is None:
+                logging.info("Replication leader key was released")
+            else:
+                logging.debug("Replication leader key changed (index=%s)", index)
+
+            self.leader_changed.set()
+            self.watch_event.set()
+
+    def stop_leader_watch_thread(self):
         """
-        Auto refresh the active sessions
+        Stop the replication leader watch thread. The thread is a daemon and is
+        not joined, as it might be blocked in a long-poll.
         """
-        while self.run_auto_refresh_thread:
-            logging.debug("Refreshing active consul sessions from auto refresh thread")
-            self.refresh_sessions()
-            time.sleep(5)
+        logging.info("Stopping the Consul replication leader watch thread")
+        self.run_leader_watch_thread = False
+        self.leader_watch_thread = None
+        self.leader_index = None
+        self.leader_entry = None
 
-    def stop_session_auto_refresh_thread(self):
+    def wait_for_change(self, timeout):
         """
-        Stop the session auto refresh thread
+        Wait until one of the watches signals a change or the timeout expires
         """
-        logging.info("Stopping the Consul session auto refresh thread")
-        self.run_auto_refresh_thread = False
-        if self.auto_refresh_thread is not None:
-            self.auto_refresh_thread.join()
-            self.auto_refresh_thread = None
-        logging.info("Consul session auto refresh thread is stopped")
+        self.watch_event.wait(timeout)
+        self.watch_event.clear()
 
     def create_node_health_session(self):
         """
@@ -116,97 +484,80 @@ class Consul:
 
         session = None
 
-        # Allow 30 seconds for session to be created
-        for _ in range(6):
+        # Allow 30 seconds for session to be created, the agent might still be starting
+        for _ in Consul.session_retry.attempts(deadline=30):
             try:
                 self.node_health_session = self.client.session.create(
                     name=Consul.instances_session_key,
                     behavior="delete",
-                    ttl=15,
-                    lock_delay=0,
+                    ttl=self.session_ttl,
+                    lock_delay=self.session_lock_delay,
                 )
 
+                if (
+                    self.time_to_first_session is None
+                    and Consul.agent_start_time is not None
+                ):
+                    self.time_to_first_session = (
+                        time.monotonic() - Consul.agent_start_time
+                    )
+                    logging.info(
+                        "Time to first Consul session: %.3fs",
+                        self.time_to_first_session,
+                    )
+
                 return self.node_health_session
             except:
-                logging.warning(
-                    "Unable to create a session in Consul, retrying in 5 seconds"
-                )
-                time.sleep(5)
+                logging.warning("Unable to create a session in Consul, retrying")
 
         if session is None:
             raise Exception("Unable to create node health session")
 
-    def get_all_registered_nodes(self):
+    def get_cluster_state(self):
         """
-        Get all registered MySQL nodes
+        Get the cached cluster state. Consul is only read if the state is
+        not watched and older than cluster_state_max_age.
         """
-        mysql_nodes = []
-
-        # Allow 3 minutes of retries to get the nodes as this will usually only fail on a potential
-        # network downtime
-        for _ in range(36):
-            try:
-                result = self.client.kv.get(Consul.instances_path, recurse=True)
-
-                if result[1] is not None:
-                    for node in result[1]:
-                        node_value = node["Value"]
-                        node_data = json.loads(node_value)
-
-                        if not "ip_address" in node_data:
-                            logging.error("ip_address missing in %s", node)
-                            continue
-
-                        if "restoring" in node_data and node_data["restoring"] is True:
-                            logging.debug(
-                                "Skipping node %s as it is currently restoring",
-                                node_data,
-                            )
-                            continue
-
-                        if (
-                            "snapshotting" in node_data
-                            and node_data["snapshotting"] is True
-                        ):
-                            logging.debug(
-                                "Skipping node %s as it is currently snapshotting",
-                                node_data,
-                            )
-                            continue
-
-                        if (
-                            "replication_unhealthy" in node_data
-                            and node_data["replication_unhealthy"] is True
-                        ):
-                            logging.debug(
-                                "Skipping node %s as replication is unhealthy",
-                                node_data,
-                            )
-                            continue
+        if self.instances_index is not None or self.topology_index is not None:
+            return self.cluster_state
 
-                        ip_address = node_data["ip_address"]
-                        mysql_nodes.append(ip_address)
+        if self.cluster_state_read_time is not None and (
+            time.monotonic() - self.cluster_state_read_time
+            < Consul.cluster_state_max_age
+        ):
+            return self.cluster_state
 
-                return mysql_nodes
+        for _ in Consul.read_retry.attempts():
+            try:
+                index, result = self.client.kv.get(Consul.instances_path, recurse=True)
+                self.cluster_state = self.cluster_state.update(int(index), result)
+                self.cluster_state_read_time = time.monotonic()
+                return self.cluster_state
             except:
-                logging.warning(
-                    "Unable to get registered nodes from Consul, retrying in 5 seconds"
-                )
-                time.sleep(5)
+                logging.warning("Unable to get registered nodes from Consul, retrying")
 
-        return mysql_nodes
+        # Fall back to the last known state
+        return self.cluster_state
 
-    def get_mysql_server_id(self):
+    def get_all_registered_nodes(self):
+        """
+        Get all registered MySQL nodes
+        """
+        return list(self.get_cluster_state().routable_ips)
+
+    def claim_server_id(self):
         """
-        Get the MySQL server id from consul
+        Claim a new MySQL server id from consul. Only called when the data
+        directory has no server id lease yet, so restarts do not contend on
+        the counter.
 
-        Try to get existing value and update to +1
-          * If Update fails, retry
+        Try to get existing value and update to +1 with a CAS
+          * If Update fails (another node claimed an id), read again and retry
           * If Key not exists, try to create
         """
 
         # Allow 30 seconds for a server ID to be assigned
-        for _ in range(6):
+        for _ in Consul.write_retry.attempts(deadline=30):
             try:
                 result = self.client.kv.get(Consul.kv_server_id)
 
@@ -255,553 +606,962 @@ class Consul:
                     )
                     return server_data["last_used_id"]
             except:
-                logging.debug("Unable to get MYSQL server ID, retrying in 5 seconds")
-                time.sleep(5)
+                logging.debug("Unable to get MYSQL server ID, retrying")
 
         raise Exception("Unable to determine server id")
 
-    def is_replication_leader(self):
+    def get_replication_leader_entry(self):
         """
-        Test if this is the MySQL replication leader or not
+        Get the KV entry of the replication leader key. Answers from the
+        watched entry if the leader watch thread is running.
         """
+        if self.leader_index is not None:
+            return self.leader_entry
 
-        # Allow 3 minutes of retries
-        for _ in range(36):
+        for _ in Consul.read_retry.attempts():
             try:
-                result = self.client.kv.get(Consul.replication_leader_path)
+                return self.client.kv.get(Consul.replication_leader_path)[1]
+            except:
+                logging.warning(
+                    "Unable to determine replication leader from Consul, retrying"
+                )
 
-                if result[1] is None:
-                    logging.debug("No replication leader node available")
-                    return False
+        return None
+
+    def is_replication_leader(self):
+        """
+        Test if this is the MySQL replication leader or not
+        """
+        result = self.get_replication_leader_entry()
 
-                leader_session = result[1]["Session"]
+        if result is None:
+            logging.debug("No replication leader node available")
+            return False
 
-                logging.debug(
-                    "Replication leader is %s, we are %s",
-                    leader_session,
-                    self.node_health_session,
-                )
+        leader_session = result.get("Session")
 
-                return leader_session == self.node_health_session
-            except:
-                logging.warning(
-                    "Unable to determine replication leader from Consul, retrying in 5 seconds"
-                )
-                time.sleep(5)
+        logging.debug(
+            "Replication leader is %s, we are %s",
+            leader_session,
+            self.node_health_session,
+        )
 
-        return False
+        return leader_session == self.node_health_session
 
     def get_replication_leader_ip(self):
         """
         Get the IP of the current replication ledear
         """
+        result = self.get_replication_leader_entry()
 
-        # Allow 3 minutes of retries
-        for _ in range(36):
-            try:
-                result = self.client.kv.get(Consul.replication_leader_path)
-
-                if result[1] is None:
-                    return None
+        if result is None or result["Value"] is None:
+            return None
 
-                json_string = result[1]["Value"]
-                server_data = json.loads(json_string)
+        json_string = result["Value"]
 
-                if not "ip_address" in server_data:
-                    logging.error(
-                        "Invalid JSON returned from replication ledader (missing server_id) %s",
-                        json_string,
-                    )
+        try:
+            server_data = json.loads(json_string)
+        except ValueError:
+            logging.error(
+                "Invalid JSON returned from replication leader %s", json_string
+            )
+            return None
 
-                return server_data["ip_address"]
-            except:
-                logging.warning(
-                    "Unable to get replication leader IP from Consul, retrying in 5 seconds"
-                )
-                time.sleep(5)
+        if not "ip_address" in server_data:
+            logging.error(
+                "Invalid JSON returned from replication ledader (missing ip_address) %s",
+                json_string,
+            )
+            return None
 
-        return None
+        return server_data["ip_address"]
 
-    def try_to_become_replication_leader(self):
+    def elect_replication_leader(self, election_state):
         """
-        Try to become the new replication leader
+        Take part in the replication leader election. The GTID state of this
+        replica is published, and the leader key is only acquired if no
+        other candidate has a more advanced GTID position.
         """
+        if not self.publish_gtid_state(election_state):
+            return False
 
-        # Allow 3 minutes of retries
-        for _ in range(36):
-            try:
-                result = self.client.kv.get(Consul.replication_leader_path)
-
-                if result[1] is None:
-                    logging.debug("Register MySQL instance in Consul")
-                    ip_address = Consul.getLocalIp()
+        if election_state["gtid_backlog"] > 0:
+            logging.info(
+                "Not a leader candidate yet, %d received transactions are not applied",
+                election_state["gtid_backlog"],
+            )
+            return False
 
-                    json_string = json.dumps({"ip_address": ip_address})
+        # Allow the other candidates to publish their state
+        time.sleep(Consul.election_settle_time)
 
-                    put_result = self.client.kv.put(
-                        Consul.replication_leader_path,
-                        json_string,
-                        acquire=self.node_health_session,
-                    )
+        if not self.is_most_advanced_candidate(election_state):
+            return False
 
-                    if put_result:
-                        logging.info("We are the new replication leader")
-                    else:
-                        logging.debug("Unable to become replication leader, retry")
+        return self.try_to_become_replication_leader()
 
-                    return put_result
+    def publish_gtid_state(self, election_state):
+        """
+        Publish the GTID state of the current node, the key is deleted
+        with the node health session
+        """
+        json_string = json.dumps(dict(election_state, time=time.time()))
 
-                return False
-            except:
-                logging.warning(
-                    "Unable to become replication leader due to error communicating with Consul, retrying in 5 seconds"
+        for _ in Consul.write_retry.attempts():
+            try:
+                return self.client.kv.put(
+                    f"{Consul.gtid_state_path}{self.local_ip}",
+                    json_string,
+                    acquire=self.node_health_session,
                 )
-                time.sleep(5)
+            except:
+                logging.warning("Unable to publish the GTID state, retrying")
 
+        logging.error("Unable to publish the GTID state")
         return False
 
-    def register_service(self, leader=False, port=3306):
+    def get_gtid_states(self):
         """
-        Register the MySQL primary service
+        Get the recently published GTID states of the other nodes
         """
-
-        # Allow 30 seconds for session to be created
-        for _ in range(6):
+        for _ in Consul.read_retry.attempts():
             try:
-                ip_address = Consul.getLocalIp()
+                entries = self.client.kv.get(Consul.gtid_state_path, recurse=True)[1]
+                break
+            except:
+                logging.warning("Unable to read the GTID states, retrying")
+        else:
+            return None
 
-                tags = []
-                service_id = f"mysql_{ip_address}"
+        states = {}
+        nodes = {
+            node_data.get("ip_address"): node_data
+            for node_data in self.get_cluster_state().nodes.values()
+        }
 
-                if leader:
-                    tags.append("leader")
-                else:
-                    tags.append("follower")
+        for entry in entries if entries is not None else []:
+            ip_address = entry["Key"][len(Consul.gtid_state_path) :]
 
-                # Unrregister old service
-                all_services = self.client.agent.services()
+            if ip_address == self.local_ip:
+                continue
 
-                if service_id in all_services:
-                    logging.debug(
-                        "Unregister old service %s (%s)", service_id, all_services
-                    )
-                    self.client.agent.service.deregister(service_id)
+            try:
+                state = json.loads(entry["Value"])
+            except (TypeError, ValueError):
+                logging.error("Invalid GTID state in %s", entry)
+                continue
 
-                # Register new service
-                logging.info("Register new service_id=%s, tags=%s", service_id, tags)
-                self.client.agent.service.register(
-                    "mysql", service_id=service_id, port=port, tags=tags
-                )
+            # Skip stale states and nodes that are not candidates
+            node_data = nodes.get(ip_address)
+            if (
+                node_data is None
+                or node_data.get("restoring") is True
+                or node_data.get("snapshotting") is True
+                or time.time() - state.get("time", 0) > Consul.election_state_max_age
+            ):
+                continue
 
-                return True
-            except:
-                logging.warning(
-                    "Unable to register service in Consul, retrying in 5 seconds"
-                )
-                time.sleep(5)
+            states[ip_address] = state
 
-        return False
+        return states
 
-    def register_node(self):
+    def is_most_advanced_candidate(self, election_state):
         """
-        Register the node in Consul
+        Test if no other candidate has a more advanced GTID position. The
+        position of a candidate includes its received transactions, as it
+        applies them before taking over. Diverged positions are ordered by
+        the number of transactions and the IP address.
         """
+        states = self.get_gtid_states()
 
-        # Allow 30 seconds for node to be registered
-        for _ in range(6):
-            try:
-                logging.debug("Register MySQL instance in Consul")
-                ip_address = Consul.getLocalIp()
-
-                json_string = json.dumps(
-                    {
-                        "ip_address": ip_address,
-                        "server_id": "",
-                        "mysql_version": "",
-                        "snapshotting": False,
-                        "restoring": False,
-                        "replication_unhealthy": False,
-                    }
-                )
+        if states is None:
+            return False
 
-                path = f"{Consul.instances_path}{ip_address}"
-                logging.debug(
-                    "Consul: Path %s, value %s (session %s)",
-                    path,
-                    json_string,
-                    self.node_health_session,
-                )
+        position = Gtid.parse(election_state["gtid_executed"])
 
-                put_result = self.client.kv.put(
-                    path, json_string, acquire=self.node_health_session
-                )
+        for ip_address, state in states.items():
+            other_position = Gtid.union(
+                Gtid.parse(state.get("gtid_executed")),
+                Gtid.parse(state.get("gtid_received")),
+            )
 
-                if not put_result:
-                    logging.error("Unable to create %s", path)
-                    return False
+            if Gtid.is_superset(position, other_position):
+                continue
 
-                return True
-            except:
-                logging.warning(
-                    "Unable to register node in Consul, retrying in 5 seconds"
+            if Gtid.is_superset(other_position, position) or (
+                Gtid.count(other_position),
+                ip_address,
+            ) > (Gtid.count(position), self.local_ip):
+                logging.info(
+                    "Node %s has a more advanced GTID position, not becoming leader",
+                    ip_address,
                 )
-                time.sleep(5)
+                return False
 
-        logging.error("Unable to register node")
-        return False
+        return True
 
-    def populate_node_info(self, mysql_version=None, server_id=None):
+    def try_to_become_replication_leader(self):
         """
-        Populate the node information in Consul
+        Try to become the new replication leader. The leader key is acquired
+        and the node document is updated in one atomic transaction.
         """
+        with self.node_document_lock:
+            for _ in Consul.write_retry.attempts():
+                try:
+                    if self.get_replication_leader_entry() is not None:
+                        return False
+
+                    logging.debug("Try to acquire the replication leader key")
+                    json_string = json.dumps({"ip_address": self.local_ip})
+
+                    operations = [
+                        {
+                            "KV": {
+                                "Verb": "lock",
+                                "Key": Consul.replication_leader_path,
+                                "Value": Consul.encode_value(json_string),
+                                "Session": self.node_health_session,
+                            }
+                        }
+                    ]
+
+                    # Update the node document in the same transaction if registered
+                    node_document = None
+                    if self.node_document is not None:
+                        node_document = dict(
+                            self.node_document,
+                            replication_leader=True,
+                            **Consul.leader_health_fields,
+                        )
+                        operations.append(
+                            {
+                                "KV": self.node_document_operation(
+                                    node_document, "cas", self.node_document_index
+                                )
+                            }
+                        )
+
+                    try:
+                        txn_result = self.client.txn.put(operations)
+                    except ClientError:
+                        # Either the key was acquired by another node or our node
+                        # document index is stale, check again
+                        logging.debug("Unable to become replication leader, retry")
+                        if (
+                            node_document is not None
+                            and not self.reload_node_document_index()
+                        ):
+                            return False
+                        continue
+
+                    if node_document is not None:
+                        self.node_document = node_document
+                        self.node_document_pending = False
+                        self.node_document_index = txn_result["Results"][1]["KV"][
+                            "ModifyIndex"
+                        ]
+
+                    self.replication_leader = True
+                    logging.info("We are the new replication leader")
+
+                    # Also wakes up the watch of the topology document
+                    self.published_topology = None
+                    self.publish_topology()
+                    return True
+                except:
+                    logging.warning(
+                        "Unable to become replication leader due to error communicating with Consul, retrying"
+                    )
 
-        self.mysql_version = mysql_version
-        self.server_id = server_id
+            return False
 
-        # Allow a minute for node info to be populated
-        for _ in range(12):
-            try:
-                logging.debug("Populate MySQL instance info in Consul")
-                ip_address = Consul.getLocalIp()
+    def set_replication_leader_role(self, leader):
+        """
+        Update the replication leader role of this node after the leader key
+        was handed over by a switchover
+        """
+        with self.node_document_lock:
+            self.replication_leader = leader
+            self.published_topology = None
+
+            if self.node_document is not None:
+                fields = Consul.leader_health_fields if leader else {}
+                self.update_node_document(
+                    "update replication leader role",
+                    replication_leader=leader,
+                    **fields,
+                )
 
-                get_result = self.client.kv.get(f"{Consul.instances_path}{ip_address}")
+        # The new leader publishes the topology from now on
+        if leader:
+            self.publish_topology()
+        else:
+            self.release_topology()
 
-                if get_result[1] is None or get_result[1]["Value"] is None:
-                    logging.error("Node %s not registered in Consul", ip_address)
-                    return False
+    def release_topology(self):
+        """
+        Delete the topology document if it is locked by the node health
+        session (e.g., published again after the handover), so the new
+        replication leader can publish it. Returns True on success.
+        """
+        operations = [
+            {
+                "KV": {
+                    "Verb": "check-session",
+                    "Key": Consul.topology_path,
+                    "Session": self.node_health_session,
+                }
+            },
+            {"KV": {"Verb": "delete", "Key": Consul.topology_path}},
+        ]
 
-                node_data = json.loads(get_result[1]["Value"])
+        try:
+            self.client.txn.put(operations)
+        except ClientError:
+            logging.debug("Topology document is not locked by this node")
+            return False
+        except:
+            logging.warning("Unable to release the topology document")
+            return False
 
-                node_data["server_id"] = self.server_id
-                node_data["mysql_version"] = self.mysql_version
+        logging.info("Released the topology document")
+        return True
 
-                json_string = json.dumps(node_data)
+    def get_node_session(self, ip_address):
+        """
+        Get the session holding the node document of the given node
+        """
+        for _ in Consul.read_retry.attempts():
+            try:
+                entry = self.client.kv.get(f"{Consul.instances_path}{ip_address}")[1]
 
-                path = f"{Consul.instances_path}{ip_address}"
-                logging.debug(
-                    "Consul: Path %s, value %s (session %s)",
-                    path,
-                    json_string,
-                    self.node_health_session,
-                )
+                if entry is None:
+                    return None
 
-                put_result = self.client.kv.put(
-                    path, json_string, acquire=self.node_health_session
+                return entry.get("Session")
+            except:
+                logging.warning(
+                    "Unable to read the node %s from Consul, retrying", ip_address
                 )
 
-                if not put_result:
-                    logging.error("Unable to populate node info for %s", path)
-                    return False
+        return None
 
+    def get_switchover_target(self):
+        """
+        Get the routable replica with the smallest GTID backlog and lag
+        """
+        state = self.get_cluster_state()
+
+        candidates = [
+            node_data
+            for node_data in state.nodes.values()
+            if node_data.get("ip_address") in state.routable_ips
+            and node_data["ip_address"] != self.local_ip
+        ]
+
+        if not candidates:
+            return None
+
+        target = min(
+            candidates,
+            key=lambda node_data: (
+                node_data.get("gtid_backlog", 0),
+                node_data.get("replication_lag_ms", 0),
+                node_data["ip_address"],
+            ),
+        )
+
+        return target["ip_address"]
+
+    def hand_over_replication_leader(self, leader_entry, target_ip, target_session):
+        """
+        Move the replication leader key to the given node in one atomic
+        transaction. The key is only replaced if it was not modified since
+        leader_entry was read, and it is locked with the session of the
+        target node. The topology document, locked by the session of the
+        old leader, is deleted so the target can publish it.
+        """
+        json_string = json.dumps({"ip_address": target_ip})
+
+        operations = [
+            {
+                "KV": {
+                    "Verb": "delete-cas",
+                    "Key": Consul.replication_leader_path,
+                    "Index": leader_entry["ModifyIndex"],
+                }
+            },
+            {
+                "KV": {
+                    "Verb": "lock",
+                    "Key": Consul.replication_leader_path,
+                    "Value": Consul.encode_value(json_string),
+                    "Session": target_session,
+                }
+            },
+            {"KV": {"Verb": "delete", "Key": Consul.topology_path}},
+        ]
+
+        for _ in Consul.write_retry.attempts():
+            try:
+                self.client.txn.put(operations)
+                logging.info("Replication leader key handed over to %s", target_ip)
                 return True
+            except ClientError:
+                # A previous attempt might have been applied already
+                entry = self.client.kv.get(Consul.replication_leader_path)[1]
+                if entry is not None and entry.get("Session") == target_session:
+                    return True
+
+                logging.error("Replication leader key was modified during the handover")
+                return False
             except:
                 logging.warning(
-                    "Unable to populate node info in Consul, retrying in 5 seconds"
+                    "Unable to hand over the replication leader key, retrying"
                 )
-                time.sleep(5)
 
-        logging.error("Unable to populate node info")
         return False
 
-    def node_set_restoring_flag(self, restoring=True):
+    def register_service(self, leader=False, port=3306):
         """
-        Marks the current node as restoring from snapshots. Used to lock snapshot writes until replication is done
+        Register the MySQL primary service. Registering an existing service_id
+        replaces the old registration.
         """
 
-        # Allow a minute for node info to be populated
-        for _ in range(12):
+        for _ in Consul.write_retry.attempts():
             try:
-                if restoring:
-                    logging.debug("Mark MySQL instance as restoring in Consul")
-                else:
-                    logging.debug("Mark MySQL instance as not restoring in Consul")
+                tags = []
+                service_id = f"mysql_{self.local_ip}"
 
-                ip_address = Consul.getLocalIp()
+                if leader:
+                    tags.append("leader")
+                else:
+                    tags.append("follower")
 
-                get_result = self.client.kv.get(f"{Consul.instances_path}{ip_address}")
-                logging.debug("Got result %s", get_result)
+                logging.info("Register service_id=%s, tags=%s", service_id, tags)
+                self.client.agent.service.register(
+                    "mysql", service_id=service_id, port=port, tags=tags
+                )
 
-                if get_result[1] is None or get_result[1]["Value"] is None:
-                    logging.error("Node %s not registered in Consul", ip_address)
-                    return False
+                return True
+            except:
+                logging.warning("Unable to register service in Consul, retrying")
 
-                node_data = json.loads(get_result[1]["Value"])
-                node_data["restoring"] = restoring
+        return False
 
-                json_string = json.dumps(node_data)
+    def register_node(self):
+        """
+        Register the node in Consul
+        """
 
-                path = f"{Consul.instances_path}{ip_address}"
-                logging.debug(
-                    "Consul: Path %s, value %s (session %s)",
-                    path,
-                    json_string,
-                    self.node_health_session,
-                )
+        # Keep the existing document (e.g., on session recreation)
+        if self.node_document is None:
+            self.node_document = {
+                "ip_address": self.local_ip,
+                "server_id": "",
+                "mysql_version": "",
+                "snapshotting": False,
+                "restoring": False,
+                "replication_unhealthy": False,
+                "replication_lag_ms": 0,
+                "gtid_backlog": 0,
+                "replication_leader": self.replication_leader,
+            }
+
+        for _ in Consul.write_retry.attempts():
+            try:
+                logging.debug("Register MySQL instance in Consul")
 
-                put_result = self.client.kv.put(
-                    path, json_string, acquire=self.node_health_session
+                self.node_document_index = self.put_node_document(
+                    self.node_document, "lock"
                 )
-
-                if not put_result:
-                    logging.error("Unable to mark restoring flag on %s", path)
-                    return False
+                self.node_document_pending = False
 
                 return True
+            except ClientError:
+                logging.error("Unable to create %s", self.get_node_path())
+                return False
             except:
-                logging.warning(
-                    "Unable to mark node as restoring in Consul, retrying in 5 seconds"
-                )
-                time.sleep(5)
+                logging.warning("Unable to register node in Consul, retrying")
 
-        logging.error("Unable to mark node as restoring")
+        logging.error("Unable to register node")
         return False
 
-    def node_set_snapshotting_flag(self, snapshotting=True):
+    def get_node_path(self):
         """
-        Marks the current node as snapshotting a new SQL backup. Only informational - snapshotting is
-        done nearly always from a replica node, which is already read-only.
+        Get the KV path of the local node
         """
+        return f"{Consul.instances_path}{self.node_document['ip_address']}"
 
-        # Allow a minute for node info to be populated
-        for _ in range(12):
-            try:
-                if snapshotting:
-                    logging.debug("Mark MySQL instance as snapshotting in Consul")
-                else:
-                    logging.debug("Mark MySQL instance as not snapshotting in Consul")
+    @staticmethod
+    def encode_value(json_string):
+        """
+        Encode a value for a Consul transaction
+        """
+        return base64.b64encode(json_string.encode()).decode()
 
-                ip_address = Consul.getLocalIp()
+    def node_document_operation(self, node_document, verb, index=None):
+        """
+        Get the transaction operation writing the node document, using the verb
+        "lock" (acquire with the node health session) or "cas" (on the given index)
+        """
+        json_string = json.dumps(node_document)
+
+        operation = {
+            "Verb": verb,
+            "Key": self.get_node_path(),
+            "Value": Consul.encode_value(json_string),
+        }
+
+        if verb == "lock":
+            operation["Session"] = self.node_health_session
+        else:
+            operation["Index"] = index
+
+        logging.debug(
+            "Consul: Path %s, value %s (verb %s, session %s, index %s)",
+            operation["Key"],
+            json_string,
+            verb,
+            self.node_health_session,
+            index,
+        )
 
-                get_result = self.client.kv.get(f"{Consul.instances_path}{ip_address}")
-                logging.debug("Got result %s", get_result)
+        return operation
 
-                if get_result[1] is None or get_result[1]["Value"] is None:
-                    logging.error("Node %s not registered in Consul", ip_address)
-                    return False
+    def put_node_document(self, node_document, verb, index=None):
+        """
+        Write the node document in a single transaction. Returns the new
+        ModifyIndex of the node key.
+        """
+        operation = self.node_document_operation(node_document, verb, index)
+        result = self.client.txn.put([{"KV": operation}])
+        return result["Results"][0]["KV"]["ModifyIndex"]
 
-                node_data = json.loads(get_result[1]["Value"])
-                node_data["snapshotting"] = snapshotting
+    def reload_node_document_index(self):
+        """
+        Reload the ModifyIndex of the node key after a failed CAS write. The
+        in-memory document stays authoritative.
+        """
+        get_result = self.client.kv.get(self.get_node_path())
 
-                json_string = json.dumps(node_data)
+        if get_result[1] is None:
+            logging.error("Node %s not registered in Consul", self.get_node_path())
+            return False
 
-                path = f"{Consul.instances_path}{ip_address}"
-                logging.debug(
-                    "Consul: Path %s, value %s (session %s)",
-                    path,
-                    json_string,
-                    self.node_health_session,
-                )
+        self.node_document_index = get_result[1]["ModifyIndex"]
+        return True
 
-                put_result = self.client.kv.put(
-                    path, json_string, acquire=self.node_health_session
+    def update_node_document(self, description, **fields):
+        """
+        Update fields of the local node document. Consul is only written if a
+        field has changed (or an earlier write failed), with a single CAS on
+        the last known ModifyIndex. The in-memory document is updated even if
+        the write fails, so a re-registration publishes the intended state.
+        """
+        with self.node_document_lock:
+            if self.node_document is None:
+                logging.error(
+                    "Node is not registered in Consul, unable to %s", description
                 )
+                return False
 
-                if not put_result:
-                    logging.error("Unable to mark snapshotting flag on %s", path)
-                    return False
+            changed_fields = {
+                key: value
+                for key, value in fields.items()
+                if self.node_document.get(key) != value
+            }
 
+            if not changed_fields and not self.node_document_pending:
+                logging.debug("Node document unchanged, skipping %s", description)
                 return True
-            except:
-                logging.warning(
-                    "Unable to mark node as snapshotting in Consul, retrying in 5 seconds"
-                )
-                time.sleep(5)
 
-        logging.error("Unable to mark node as snapshotting")
-        return False
+            self.node_document = dict(self.node_document, **changed_fields)
+            self.node_document_pending = True
+
+            for _ in Consul.write_retry.attempts():
+                try:
+                    logging.debug("%s in Consul (%s)", description, changed_fields)
+
+                    self.node_document_index = self.put_node_document(
+                        self.node_document, "cas", self.node_document_index
+                    )
+                    self.node_document_pending = False
+
+                    return True
+                except ClientError:
+                    logging.warning(
+                        "CAS write to %s failed, reloading index", self.get_node_path()
+                    )
+
+                    try:
+                        if not self.reload_node_document_index():
+                            return False
+                    except:
+                        logging.warning("Unable to reload index of node document")
+                except:
+                    logging.warning("Unable to %s in Consul, retrying", description)
+
+            logging.error("Unable to %s", description)
+            return False
+
+    def populate_node_info(self, mysql_version=None, server_id=None):
+        """
+        Populate the node information in Consul
+        """
+        return self.update_node_document(
+            "populate node info", mysql_version=mysql_version, server_id=server_id
+        )
+
+    def node_set_restoring_flag(self, restoring=True):
+        """
+        Marks the current node as restoring from snapshots. Used to lock snapshot writes until replication is done
+        """
+        if restoring:
+            description = "mark node as restoring"
+        else:
+            description = "mark node as not restoring"
+
+        return self.update_node_document(description, restoring=restoring)
+
+    def node_set_snapshotting_flag(self, snapshotting=True):
+        """
+        Marks the current node as snapshotting a new SQL backup. Only informational - snapshotting is
+        done nearly always from a replica node, which is already read-only.
+        """
+        if snapshotting:
+            description = "mark node as snapshotting"
+        else:
+            description = "mark node as not snapshotting"
+
+        return self.update_node_document(description, snapshotting=snapshotting)
 
     def node_set_replication_unhealthy_flag(self, unhealthy=True):
         """
         Marks the current node as having unhealthy replication. Unhealthy nodes
         are excluded from ProxySQL routing to prevent serving stale reads.
         """
+        if unhealthy:
+            description = "mark node as replication unhealthy"
+        else:
+            description = "mark node as replication healthy"
 
-        # Allow a minute for node info to be populated
-        for _ in range(12):
-            try:
-                if unhealthy:
-                    logging.debug(
-                        "Mark MySQL instance as replication unhealthy in Consul"
-                    )
-                else:
-                    logging.debug(
-                        "Mark MySQL instance as replication healthy in Consul"
-                    )
+        return self.update_node_document(description, replication_unhealthy=unhealthy)
 
-                ip_address = Consul.getLocalIp()
+    def node_set_replication_lag(self, lag_ms, gtid_backlog):
+        """
+        Publish the replication lag (in ms) and the GTID backlog of the
+        current node, quantized to avoid a write on every check
+        """
+        return self.update_node_document(
+            "update replication lag",
+            replication_lag_ms=Consul.quantize(
+                lag_ms, Consul.replication_lag_resolution_ms
+            ),
+            gtid_backlog=Consul.quantize(gtid_backlog, Consul.gtid_backlog_resolution),
+        )
 
-                get_result = self.client.kv.get(f"{Consul.instances_path}{ip_address}")
-                logging.debug("Got result %s", get_result)
+    @staticmethod
+    def quantize(value, resolution):
+        """
+        Round the value down to the resolution times a power of two, values
+        below the resolution are 0
+        """
+        steps = int(value) // resolution
 
-                if get_result[1] is None or get_result[1]["Value"] is None:
-                    logging.error("Node %s not registered in Consul", ip_address)
-                    return False
+        if steps <= 0:
+            return 0
 
-                node_data = json.loads(get_result[1]["Value"])
-                node_data["replication_unhealthy"] = unhealthy
+        return resolution << (steps.bit_length() - 1)
 
-                json_string = json.dumps(node_data)
+    def are_nodes_restoring(self):
+        """
+        Check if any nodes are restoring from snapshots
+        """
+        return self.get_cluster_state().any_restoring
 
-                path = f"{Consul.instances_path}{ip_address}"
-                logging.debug(
-                    "Consul: Path %s, value %s (session %s)",
-                    path,
-                    json_string,
-                    self.node_health_session,
-                )
+    def are_nodes_snapshotting(self):
+        """
+        Check if any nodes are creating a snapshot
+        """
+        return self.get_cluster_state().any_snapshotting
 
-                put_result = self.client.kv.put(
-                    path, json_string, acquire=self.node_health_session
-                )
+    def refresh_sessions(self):
+        """
+        Refresh the active sessions
+        """
+        logging.debug("Keeping Consul sessions alive")
+        logging.debug("Refreshing session %s", self.node_health_session)
 
-                if not put_result:
-                    logging.error(
-                        "Unable to mark replication unhealthy flag on %s", path
-                    )
-                    return False
+        # Give up before the TTL of the session runs out
+        deadline = self.session_ttl - self.session_keepalive.interval
 
+        for _ in Consul.session_retry.attempts(deadline=deadline):
+            try:
+                self.client.session.renew(self.node_health_session)
                 return True
             except:
                 logging.warning(
-                    "Unable to mark node as replication unhealthy in Consul, retrying in 5 seconds"
+                    "Unable to refresh session %s, retrying",
+                    self.node_health_session,
                 )
-                time.sleep(5)
 
-        logging.error("Unable to mark node as replication unhealthy")
+        # If the session is unable to be refreshed, try to recreate it and re-register the node, as it will be
+        # automatically delisted by the old session's lock being removed. The failure might also be caused
+        # by a changed network, so the local IP is resolved again.
+        Consul.invalidate_local_ip()
+        self.recreate_node_health_session()
+
         return False
 
-    def are_nodes_restoring(self):
+    def recreate_node_health_session(self):
         """
-        Check if any nodes are restoring from snapshots
+        Recreate the node health session and re-register the node
         """
+        with self.node_document_lock:
+            self.node_health_session = None
 
-        # Allow 3 minutes of retries
-        for _ in range(36):
-            try:
-                logging.debug("Check if any nodes are restoring from snapshots")
-
-                result = self.client.kv.get(Consul.instances_path, recurse=True)
-                logging.debug("Got result %s", result)
-
-                if result[1] is not None:
-                    for node in result[1]:
-                        node_value = node["Value"]
-                        node_data = json.loads(node_value)
+            # The leader key was released together with the old session, e.g.
+            # the heartbeat must stop before another node is promoted
+            if self.replication_leader and self.leadership_lost_callback is not None:
+                self.leadership_lost_callback()
 
-                        if not "restoring" in node_data:
-                            logging.error("Restoring flag missing in %s", node)
-                            continue
+            self.replication_leader = False
+            if self.node_document is not None:
+                self.node_document["replication_leader"] = False
 
-                        if node_data["restoring"] is True:
-                            logging.debug("Node %s is restoring", node_data)
-                            return True
+                ip_address = self.local_ip
+                if ip_address is not None:
+                    self.node_document["ip_address"] = ip_address
 
-                return False
+            try:
+                self.create_node_health_session()
+                self.register_node()
             except:
-                logging.warning(
-                    "Unable to get registered nodes from Consul, retrying in 5 seconds"
+                logging.error(
+                    "Unable to recreate the node health session, something is wrong with Consul"
                 )
-                time.sleep(5)
-
-        return False
 
-    def are_nodes_snapshotting(self):
+    def check_local_ip(self):
         """
-        Check if any nodes are creating a snapshot
+        Check that the cached local IP is still assigned to an interface. On an
+        interface change, the IP is resolved again and the node re-registered.
         """
+        if Consul.local_ip_address is None:
+            return True
 
-        # Allow 3 minutes of retries
-        for _ in range(36):
-            try:
-                logging.debug("Check if any nodes are creating the snapshot")
+        if Consul.is_local_ip_assigned(Consul.local_ip_address):
+            return True
 
-                result = self.client.kv.get(Consul.instances_path, recurse=True)
-                logging.debug("Got result %s", result)
+        old_ip_address = Consul.local_ip_address
+        Consul.invalidate_local_ip()
 
-                if result[1] is not None:
-                    for node in result[1]:
-                        node_value = node["Value"]
-                        node_data = json.loads(node_value)
+        logging.warning(
+            "Local IP %s is no longer assigned (new IP %s), re-registering node",
+            old_ip_address,
+            self.local_ip,
+        )
 
-                        if not "snapshotting" in node_data:
-                            logging.error("Snapshotting flag missing in %s", node)
-                            continue
+        self.destroy_session()
+        self.recreate_node_health_session()
+        return False
 
-                        if node_data["snapshotting"] is True:
-                            logging.debug("Node %s is snapshotting", node_data)
-                            return True
+    def destroy_session(self):
+        """
+        Destory a previosly registered session
+        """
 
-                return False
+        if self.node_health_session is None:
+            logging.debug("No session to destroy")
+            return True
+
+        for _ in Consul.session_retry.attempts():
+            try:
+                self.client.session.destroy(self.node_health_session)
+                break
             except:
                 logging.warning(
-                    "Unable to get registered nodes from Consul, retrying in 5 seconds"
+                    "Unable to destroy session %s, retrying",
+                    self.node_health_session,
                 )
-                time.sleep(5)
 
-        return False
+        return True
 
-    def refresh_sessions(self):
+    def should_promote_agent(self):
         """
-        Refresh the active sessions
+        Test if the local client agent should be promoted to a server, because
+        fewer than the maximum number of servers are present. The promotion
+        lock is acquired on success, so only one node promotes at a time.
         """
-        logging.debug("Keeping Consul sessions alive")
-        logging.debug("Refreshing session %s", self.node_health_session)
+        if Consul.agent_server is not False:
+            return False
+
+        # The leader keeps its agent, a restart might invalidate its session
+        if self.is_replication_leader():
+            return False
+
+        max_servers = Consul.get_max_servers()
+
+        try:
+            peers = self.client.status.peers()
+        except:
+            logging.warning("Unable to determine the Consul servers")
+            return False
+
+        if len(peers) >= max_servers:
+            return False
+
+        # The agent restart invalidates the node health session (serfHealth),
+        # so the lock is held by a session without health checks. The TTL
+        # frees the lock if the node fails during the promotion.
+        try:
+            self.promotion_session = self.client.session.create(
+                name=Consul.agent_promotion_path,
+                checks=[],
+                ttl=Consul.agent_promotion_ttl,
+                lock_delay=0,
+            )
+            acquired = self.client.kv.put(
+                Consul.agent_promotion_path,
+                self.local_ip,
+                acquire=self.promotion_session,
+            )
+        except:
+            logging.warning("Unable to acquire the Consul promotion lock")
+            self.destroy_promotion_session()
+            return False
+
+        if not acquired:
+            logging.debug("Another node is promoting its Consul agent")
+            self.destroy_promotion_session()
+            return False
+
+        logging.info(
+            "Only %d of %d Consul servers are present, promoting the local agent",
+            len(peers),
+            max_servers,
+        )
+        return True
+
+    def finish_agent_promotion(self):
+        """
+        Wait until the local agent joined the Raft peers, register the node
+        again and release the promotion lock
+        """
+        Consul.wait_for_agent(self.client)
+
+        peer = f"{self.local_ip}:8300"
 
-        # Allow 35 seconds to refresh session before recreating the session
-        for _ in range(7):
+        for _ in Consul.readiness_retry.attempts():
             try:
-                self.client.session.renew(self.node_health_session)
-                return True
+                if peer in self.client.status.peers():
+                    logging.info("Local Consul agent is now a server (%s)", peer)
+                    break
             except:
-                logging.warning(
-                    "Unable to refresh session %s, retrying in 5 seconds",
-                    self.node_health_session,
+                logging.debug("Unable to determine the Consul servers, retrying")
+
+        # The agent restart invalidates the node health session, which deletes
+        # the node registration (unless the keep-alive already recreated it)
+        with self.node_document_lock:
+            try:
+                session = self.client.session.info(self.node_health_session)[1]
+            except:
+                session = None
+
+            if session is None:
+                logging.info(
+                    "Recreating the node health session after the agent promotion"
                 )
-                time.sleep(5)
-                continue
+                self.destroy_session()
+                self.recreate_node_health_session()
 
-        # If the session is unable to be refreshed, try to recreate it and re-register the node, as it will be
-        # automatically delisted by the old session's lock being removed.
-        self.node_health_session = None
+        self.destroy_promotion_session()
+
+    def destroy_promotion_session(self):
+        """
+        Destroy the session of the Consul promotion lock (releases the lock)
+        """
+        if self.promotion_session is None:
+            return
 
         try:
-            self.create_node_health_session()
-            self.register_node()
-            self.populate_node_info(self.mysql_version, self.server_id)
+            self.client.session.destroy(self.promotion_session)
         except:
-            logging.error(
-                "Unable to recreate the node health session, something is wrong with Consul"
-            )
+            # The lock is released anyway once the TTL expires
+            logging.warning("Unable to release the Consul promotion lock")
 
-        return False
+        self.promotion_session = None
 
-    def destroy_session(self):
+    @staticmethod
+    def get_max_servers():
         """
-        Destory a previosly registered session
+        Get the maximum number of Consul servers, never below the number
+        of servers needed to bootstrap the cluster
         """
+        bootstrap_expect = Config.get().consul_bootstrap_expect
+        max_servers = Config.get().consul_max_servers
 
-        if self.node_health_session is None:
-            logging.debug("No session to destroy")
-            return True
+        return max(bootstrap_expect, max_servers)
+
+    @staticmethod
+    def get_bootstrap_service_ips():
+        """
+        Get the IPs of all tasks of the bootstrap service, sorted
+        """
+        service = Config.get().consul_bootstrap_service
+
+        try:
+            ips = socket.gethostbyname_ex(f"tasks.{service}")[2]
+        except OSError:
+            logging.warning("Unable to resolve the tasks of service %s", service)
+            return []
+
+        return sorted(set(ips), key=socket.inet_aton)
+
+    @staticmethod
+    def should_start_as_server():
+        """
+        Decide the role of the local agent. If a running cluster is found,
+        the agent becomes a server only if fewer than the maximum number of
+        servers are present. Otherwise the cluster is bootstrapping and the
+        first tasks (by IP) become the servers.
+        """
+        max_servers = Consul.get_max_servers()
+        local_ip = Consul.getLocalIp()
+        ips = Consul.get_bootstrap_service_ips()
+
+        for ip in ips:
+            if ip == local_ip:
+                continue
 
-        for _ in range(6):
             try:
-                self.client.session.destroy(self.node_health_session)
-                break
+                response = requests.get(f"http://{ip}:8500/v1/status/peers", timeout=1)
+                response.raise_for_status()
+                peers = response.json()
             except:
-                logging.warning(
-                    "Unable to destroy session %s, retrying in 5 seconds",
-                    self.node_health_session,
-                )
-                time.sleep(5)
+                logging.debug("Unable to get the Consul servers from %s", ip)
                 continue
 
-        return True
+            if not peers:
+                continue
+
+            logging.info(
+                "Found running Consul cluster with %d of %d servers",
+                len(peers),
+                max_servers,
+            )
+            return len(peers) < max_servers
+
+        if local_ip not in ips:
+            ips = sorted(ips + [local_ip], key=socket.inet_aton)
+
+        return ips.index(local_ip) < max_servers
 
     @staticmethod
-    def agent_start():
+    def agent_start(server=None):
         """
-        Start the local Consul agent.
+        Start the local Consul agent. The role (server or client) is
+        decided by should_start_as_server if not given.
         """
         if Consul.getLocalIp() is None:
             logging.error(
@@ -809,7 +1569,12 @@ class Consul:
             )
             sys.exit(1)
 
-        logging.info("Starting Consul Agent")
+        if server is None:
+            server = Consul.should_start_as_server()
+
+        Consul.agent_server = server
+
+        logging.info("Starting Consul Agent (server=%s)", server)
         consul_args = ["consul"]
         consul_args.append("agent")
         consul_args.append("-data-dir")
@@ -821,52 +1586,129 @@ class Consul:
         consul_args.append("-client")
         consul_args.append("0.0.0.0")
 
-        consul_args.append("-server")
+        # Further nodes run as lightweight clients to keep the Raft voters small
+        if server:
+            consul_args.append("-server")
 
         consul_args.append("-retry-join")
-        consul_args.append(
-            f"tasks.{Utils.get_envvar_or_secret('CONSUL_BOOTSTRAP_SERVICE', 'mysql')}"
-        )
+        consul_args.append(f"tasks.{Config.get().consul_bootstrap_service}")
 
-        consul_args.append("-bootstrap-expect")
-        consul_args.append(Utils.get_envvar_or_secret("CONSUL_BOOTSTRAP_EXPECT", "3"))
+        if server:
+            consul_args.append("-bootstrap-expect")
+            consul_args.append(str(Config.get().consul_bootstrap_expect))
 
-        if (
-            Utils.get_envvar_or_secret("CONSUL_ENABLE_UI", "false").lower() == "true"
-            or Utils.get_envvar_or_secret("CONSUL_ENABLE_UI", "false") == "1"
-        ):
+        if Config.get().consul_enable_ui:
             consul_args.append("-ui")
 
         logging.info("Consul args: %s", consul_args)
 
-        # Run process in background
+        # Run process in background, readiness is checked by wait_for_agent
+        Consul.agent_start_time = time.monotonic()
         consul_process = subprocess.Popen(consul_args)
         logging.info("Consul agent started with PID %s", consul_process.pid)
 
-        time.sleep(1)
-
         return consul_process
 
+    @staticmethod
+    def wait_for_agent(client, deadline=None):
+        """
+        Poll the local agent until it answers and a Raft leader exists.
+        Returns False if the agent is not ready within the deadline.
+        """
+        if deadline is None:
+            deadline = Config.get().consul_ready_timeout
+
+        started = time.monotonic()
+
+        for attempt in Consul.readiness_retry.attempts(deadline=deadline):
+            try:
+                leader = client.status.leader()
+            except:
+                logging.debug("Consul agent is not answering yet (attempt %d)", attempt)
+                continue
+
+            if not leader:
+                logging.debug(
+                    "Consul agent has no Raft leader yet (attempt %d)", attempt
+                )
+                continue
+
+            if Consul.agent_start_time is not None:
+                started = Consul.agent_start_time
+
+            logging.info(
+                "Consul agent is ready after %.3fs, Raft leader is %s",
+                time.monotonic() - started,
+                leader,
+            )
+            return True
+
+        return False
+
+    @property
+    def local_ip(self):
+        """
+        The cached local IP
+        """
+        if Consul.local_ip_address is not None:
+            return Consul.local_ip_address
+
+        return Consul.getLocalIp()
+
+    @staticmethod
+    def invalidate_local_ip():
+        """
+        Invalidate the cached local IP, it is resolved again on next access
+        """
+        logging.debug("Invalidating cached local IP %s", Consul.local_ip_address)
+        Consul.local_ip_address = None
+
+    @staticmethod
+    def is_local_ip_assigned(ip_address):
+        """
+        Is the IP assigned to one of the local interfaces
+        """
+        for interface in netifaces.interfaces():
+            if interface == "lo":
+                continue
+
+            addresses = netifaces.ifaddresses(interface).get(netifaces.AF_INET, [])
+            for addressInfo in addresses:
+                if addressInfo["addr"] == ip_address:
+                    return True
+
+        return False
+
     @staticmethod
     def getLocalIp():
         """
-        Get the local IP, based on the service being bootstrapped
+        Get the local IP, based on the service being bootstrapped. The IP is
+        cached until invalidated by an interface change or a DNS failure.
         """
-        ip_addresses = socket.gethostbyname_ex(
-            f"tasks.{Utils.get_envvar_or_secret('CONSUL_BOOTSTRAP_SERVICE', 'mysql')}"
-        )[2]
+        if Consul.local_ip_address is not None:
+            return Consul.local_ip_address
+
+        try:
+            ip_addresses = socket.gethostbyname_ex(
+                f"tasks.{Config.get().consul_bootstrap_service}"
+            )[2]
+        except OSError:
+            logging.warning("Unable to resolve the service tasks for the local IP")
+            return None
 
         for interface in netifaces.interfaces():
             if interface == "lo":
                 continue
 
-            for addressInfo in netifaces.ifaddresses(interface)[netifaces.AF_INET]:
+            addresses = netifaces.ifaddresses(interface).get(netifaces.AF_INET, [])
+            for addressInfo in addresses:
                 if addressInfo["addr"] in ip_addresses:
                     logging.debug(
                         "Found local IP %s on interface %s",
                         addressInfo["addr"],
                         interface,
                     )
-                    return addressInfo["addr"]
+                    Consul.local_ip_address = addressInfo["addr"]
+                    return Consul.local_ip_address
 
         return None
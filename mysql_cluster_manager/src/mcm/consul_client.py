@@ -0,0 +1,144 @@
+"""This file contains the pooled HTTP transport of the Consul client"""
+
+import re
+import threading
+
+import consul as pyconsul
+import consul.base
+import consul.std
+import requests
+from requests.adapters import HTTPAdapter
+
+from mcm.retry import RetryPolicy
+
+
+class PooledHTTPClient(consul.std.HTTPClient):
+    """
+    HTTP transport with keep-alive connections. A requests.Session is not
+    thread-safe, so each thread (main loop, session keep-alive, watches,
+    backup) uses its own session. All sessions share one thread-safe
+    adapter, whose connection pool is sized for all threads, so a session
+    holds no connections of its own and is freed with its thread.
+    """
+
+    # Connections kept alive to the local agent
+    pool_maxsize = 8
+
+    # HTTP timeout (in seconds) of a call outside of a retry loop, calls in
+    # a retry loop are bounded by the remaining deadline
+    default_timeout = 10
+    min_timeout = 0.1
+
+    # Added to the wait of a blocking query, Consul adds up to wait/16 jitter
+    blocking_timeout_margin = 5
+
+    def __init__(self, *args, **kwargs):
+        """
+        Init the transport and the shared adapter
+        """
+        consul.base.HTTPClient.__init__(self, *args, **kwargs)
+
+        self.adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=PooledHTTPClient.pool_maxsize
+        )
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        """
+        Get the session of the current thread
+        """
+        session = getattr(self.local, "session", None)
+
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self.local.session = session
+
+        return session
+
+    @staticmethod
+    def parse_duration(duration):
+        """
+        Parse a Consul duration (e.g., 30s, 100ms, 5m) into seconds
+        """
+        match = re.fullmatch(r"(\d+(?:\.\d+)?)(ms|s|m|h)", str(duration))
+        if match is None:
+            return float(duration)
+
+        factors = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return float(match.group(1)) * factors[match.group(2)]
+
+    @staticmethod
+    def get_timeout(params):
+        """
+        Get the HTTP timeout (in seconds) of a request, blocking queries may
+        take their full wait time
+        """
+        wait = dict(params or []).get("wait")
+        if wait is not None:
+            wait = PooledHTTPClient.parse_duration(wait)
+            return wait * 17 / 16 + PooledHTTPClient.blocking_timeout_margin
+
+        remaining = RetryPolicy.remaining_time()
+        if remaining is None:
+            return PooledHTTPClient.default_timeout
+
+        return max(PooledHTTPClient.min_timeout, remaining)
+
+    def request(self, method, callback, path, params=None, **kwargs):
+        """
+        Perform a request with a bounded timeout
+        """
+        response = self.session.request(
+            method,
+            self.uri(path, params),
+            verify=self.verify,
+            cert=self.cert,
+            timeout=PooledHTTPClient.get_timeout(params),
+            **kwargs,
+        )
+        return callback(self.response(response))
+
+    def get(self, callback, path, params=None, headers=None):
+        """
+        Perform a GET request
+        """
+        return self.request("GET", callback, path, params, headers=headers)
+
+    def put(self, callback, path, params=None, data="", headers=None):
+        """
+        Perform a PUT request
+        """
+        return self.request("PUT", callback, path, params, data=data, headers=headers)
+
+    def delete(self, callback, path, params=None, headers=None):
+        """
+        Perform a DELETE request
+        """
+        return self.request("DELETE", callback, path, params, headers=headers)
+
+    def post(self, callback, path, params=None, data="", headers=None):
+        """
+        Perform a POST request
+        """
+        return self.request("POST", callback, path, params, data=data, headers=headers)
+
+    def close(self):
+        """
+        Close the pooled connections of all sessions
+        """
+        self.adapter.close()
+
+
+class PooledConsul(pyconsul.Consul):
+    """
+    Consul client using the pooled HTTP transport
+    """
+
+    def http_connect(self, host, port, scheme, verify=True, cert=None):
+        """
+        Create the HTTP transport
+        """
+        return PooledHTTPClient(host, port, scheme, verify, cert)
@@ -0,0 +1,570 @@
+"""This file contains an in-process stand-in for the Consul client"""
+
+import base64
+import re
+import threading
+import time
+import uuid
+
+from consul.exceptions import ClientError, NotFound
+
+
+class InMemoryConsul:
+    """
+    In-memory, network-free implementation of the subset of the py-consul
+    client used by the cluster manager: KV (recurse, CAS, acquire/release,
+    blocking queries), transactions, sessions with TTL and behavior, agent
+    services and the status endpoints. It can be injected into the Consul
+    singleton, e.g. Consul(client=InMemoryConsul()), to benchmark the
+    cluster logic without a Consul agent.
+    """
+
+    def __init__(self):
+        """
+        Init the empty store
+        """
+        self.condition = threading.Condition()
+        self.index = 1
+
+        # key -> entry, entries are replaced and never modified in place
+        self.entries = {}
+
+        # key -> index of the deletion, for the index of blocking queries
+        self.tombstones = {}
+
+        # session id -> session
+        self.sessions = {}
+
+        # key -> monotonic time until which the key can not be acquired
+        self.lock_delays = {}
+
+        self.services = {}
+
+        self.kv = InMemoryConsul.KV(self)
+        self.txn = InMemoryConsul.Txn(self)
+        self.session = InMemoryConsul.Session(self)
+        self.agent = InMemoryConsul.Agent(self)
+        self.status = InMemoryConsul.Status(self)
+
+    @staticmethod
+    def parse_duration(duration):
+        """
+        Parse a Consul duration (e.g., 10s, 100ms, 5m) into seconds
+        """
+        if duration is None:
+            return 0
+
+        if isinstance(duration, (int, float)):
+            return duration
+
+        match = re.fullmatch(r"(\d+(?:\.\d+)?)(ms|s|m|h)", duration)
+        if match is None:
+            raise ClientError(f"400 invalid duration {duration}")
+
+        factors = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return float(match.group(1)) * factors[match.group(2)]
+
+    def next_index(self):
+        """
+        Advance the Raft index stand-in, must be called with the condition held
+        """
+        self.index += 1
+        return self.index
+
+    def expire_sessions(self):
+        """
+        Invalidate sessions with an elapsed TTL, must be called with the
+        condition held
+        """
+        now = time.monotonic()
+
+        for session_id, session in list(self.sessions.items()):
+            if session["expires"] is not None and session["expires"] <= now:
+                self.invalidate_session(session_id)
+
+    def invalidate_session(self, session_id):
+        """
+        Invalidate a session and release or delete its locks, must be called
+        with the condition held
+        """
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+
+        index = self.next_index()
+
+        for key, entry in list(self.entries.items()):
+            if entry.get("Session") != session_id:
+                continue
+
+            if session["lock_delay"] > 0:
+                self.lock_delays[key] = time.monotonic() + session["lock_delay"]
+
+            if session["behavior"] == "delete":
+                del self.entries[key]
+                self.tombstones[key] = index
+            else:
+                released = dict(entry, ModifyIndex=index)
+                del released["Session"]
+                self.entries[key] = released
+
+        self.condition.notify_all()
+
+    def query_index(self, key, recurse):
+        """
+        Get the index of a key or prefix as returned in X-Consul-Index
+        """
+        if recurse:
+            indexes = [
+                entry["ModifyIndex"]
+                for entry_key, entry in self.entries.items()
+                if entry_key.startswith(key)
+            ]
+            indexes += [
+                index
+                for tombstone_key, index in self.tombstones.items()
+                if tombstone_key.startswith(key)
+            ]
+        else:
+            indexes = []
+            if key in self.entries:
+                indexes.append(self.entries[key]["ModifyIndex"])
+            if key in self.tombstones:
+                indexes.append(self.tombstones[key])
+
+        return max(indexes, default=1)
+
+    def apply_put(self, key, value, index, cas=None, acquire=None, release=None):
+        """
+        Apply a KV write, must be called with the condition held. Returns
+        the new entry or None if the write was rejected.
+        """
+        existing = self.entries.get(key)
+
+        if acquire is not None:
+            if acquire not in self.sessions:
+                raise ClientError(f"500 invalid session {acquire}")
+
+            if existing is not None and existing.get("Session") not in (
+                None,
+                acquire,
+            ):
+                return None
+
+            if self.lock_delays.get(key, 0) > time.monotonic():
+                return None
+        elif cas is not None:
+            if cas == 0 and existing is not None:
+                return None
+
+            if cas != 0 and (existing is None or existing["ModifyIndex"] != cas):
+                return None
+
+        if release is not None:
+            if existing is None or existing.get("Session") != release:
+                return None
+
+        entry = {
+            "Key": key,
+            "Value": value,
+            "Flags": 0,
+            "CreateIndex": existing["CreateIndex"] if existing else index,
+            "ModifyIndex": index,
+            "LockIndex": existing["LockIndex"] if existing else 0,
+        }
+
+        # Keep the lock of a plain or CAS write
+        if existing is not None and existing.get("Session") is not None:
+            entry["Session"] = existing["Session"]
+
+        if acquire is not None:
+            if entry.get("Session") != acquire:
+                entry["LockIndex"] = entry["LockIndex"] + 1
+            entry["Session"] = acquire
+
+        if release is not None:
+            del entry["Session"]
+
+        self.entries[key] = entry
+        self.tombstones.pop(key, None)
+        return entry
+
+    def apply_delete(self, key, index, recurse=False, cas=None):
+        """
+        Apply a KV delete, must be called with the condition held
+        """
+        if cas is not None:
+            existing = self.entries.get(key)
+            if existing is None or existing["ModifyIndex"] != cas:
+                return False
+
+        keys = [
+            entry_key
+            for entry_key in self.entries
+            if entry_key == key or (recurse and entry_key.startswith(key))
+        ]
+
+        for entry_key in keys:
+            del self.entries[entry_key]
+            self.tombstones[entry_key] = index
+
+        return True
+
+    class KV:
+        """
+        The KV endpoint
+        """
+
+        def __init__(self, store):
+            self.store = store
+
+        def get(self, key, index=None, recurse=False, wait=None, **kwargs):
+            """
+            Get a key or prefix, blocking until the index changed if an
+            index is given
+            """
+            store = self.store
+
+            with store.condition:
+                store.expire_sessions()
+
+                if index:
+                    timeout = InMemoryConsul.parse_duration(wait or "5m")
+                    end_time = time.monotonic() + timeout
+
+                    while store.query_index(key, recurse) <= int(index):
+                        remaining = end_time - time.monotonic()
+                        if remaining <= 0:
+                            break
+
+                        # Wake up regularly to expire sessions
+                        store.condition.wait(min(remaining, 0.1))
+                        store.expire_sessions()
+
+                query_index = str(store.query_index(key, recurse))
+
+                if recurse:
+                    entries = [
+                        dict(entry)
+                        for entry_key, entry in sorted(store.entries.items())
+                        if entry_key.startswith(key)
+                    ]
+                    return query_index, entries if entries else None
+
+                entry = store.entries.get(key)
+                return query_index, dict(entry) if entry is not None else None
+
+        def put(self, key, value, cas=None, acquire=None, release=None, **kwargs):
+            """
+            Write a key, returns True on success
+            """
+            store = self.store
+
+            if isinstance(value, str):
+                value = value.encode()
+
+            with store.condition:
+                store.expire_sessions()
+                index = store.next_index()
+                entry = store.apply_put(key, value, index, cas, acquire, release)
+                store.condition.notify_all()
+                return entry is not None
+
+        def delete(self, key, recurse=False, cas=None, **kwargs):
+            """
+            Delete a key or prefix, returns True on success
+            """
+            store = self.store
+
+            with store.condition:
+                store.expire_sessions()
+                result = store.apply_delete(key, store.next_index(), recurse, cas)
+                store.condition.notify_all()
+                return result
+
+    class Txn:
+        """
+        The transaction endpoint
+        """
+
+        def __init__(self, store):
+            self.store = store
+
+        def put(self, payload):
+            """
+            Apply the KV operations atomically, raises ClientError (409) and
+            rolls back if one of the operations fails
+            """
+            store = self.store
+
+            with store.condition:
+                store.expire_sessions()
+
+                saved_entries = dict(store.entries)
+                saved_tombstones = dict(store.tombstones)
+                saved_index = store.index
+
+                index = store.next_index()
+                results = []
+                errors = []
+
+                for op_index, operation in enumerate(payload):
+                    kv = operation["KV"]
+
+                    # A rejected operation (e.g., an invalid session) fails the
+                    # whole transaction like a failed check
+                    try:
+                        result = self.apply(kv, index)
+                    except ClientError as err:
+                        errors.append({"OpIndex": op_index, "What": str(err)})
+                        break
+
+                    if result is False:
+                        errors.append(
+                            {"OpIndex": op_index, "What": f"{kv['Verb']} failed"}
+                        )
+                        break
+
+                    if result is not None:
+                        results.append({"KV": result})
+
+                if errors:
+                    store.entries = saved_entries
+                    store.tombstones = saved_tombstones
+                    store.index = saved_index
+                    raise ClientError(f"409 {errors}")
+
+                store.condition.notify_all()
+                return {"Results": results, "Errors": None}
+
+        def apply(self, kv, index):
+            """
+            Apply a single KV operation. Returns the entry metadata, None for
+            operations without result or False on failure.
+            """
+            store = self.store
+            verb = kv["Verb"]
+            key = kv["Key"]
+
+            value = None
+            if kv.get("Value") is not None:
+                value = base64.b64decode(kv["Value"])
+
+            if verb == "set":
+                entry = store.apply_put(key, value, index)
+            elif verb == "cas":
+                entry = store.apply_put(key, value, index, cas=kv.get("Index", 0))
+            elif verb == "lock":
+                entry = store.apply_put(key, value, index, acquire=kv.get("Session"))
+            elif verb == "unlock":
+                entry = store.apply_put(key, value, index, release=kv.get("Session"))
+            elif verb == "get":
+                entry = store.entries.get(key)
+            elif verb == "check-index":
+                entry = store.entries.get(key)
+                if entry is not None and entry["ModifyIndex"] != kv.get("Index"):
+                    entry = None
+            elif verb == "check-session":
+                entry = store.entries.get(key)
+                if entry is not None and entry.get("Session") != kv.get("Session"):
+                    entry = None
+            elif verb == "check-not-exists":
+                return None if key not in store.entries else False
+            elif verb == "delete":
+                store.apply_delete(key, index)
+                return None
+            elif verb == "delete-cas":
+                return (
+                    None if store.apply_delete(key, index, cas=kv["Index"]) else False
+                )
+            else:
+                raise ClientError(f"400 unsupported verb {verb}")
+
+            if entry is None:
+                return False
+
+            # Like Consul, only get operations return the value
+            result = dict(entry, Value=None)
+            if verb == "get" and entry["Value"] is not None:
+                result["Value"] = base64.b64encode(entry["Value"]).decode()
+
+            return result
+
+    class Session:
+        """
+        The session endpoint
+        """
+
+        def __init__(self, store):
+            self.store = store
+
+        def create(
+            self, name=None, behavior="release", ttl=None, lock_delay=15, **kwargs
+        ):
+            """
+            Create a session and return its id
+            """
+            store = self.store
+            session_id = str(uuid.uuid4())
+
+            with store.condition:
+                store.sessions[session_id] = {
+                    "ID": session_id,
+                    "Name": name,
+                    "Behavior": behavior,
+                    "behavior": behavior,
+                    "TTL": f"{ttl}s" if ttl else "",
+                    "ttl": ttl,
+                    "lock_delay": lock_delay,
+                    "expires": time.monotonic() + ttl if ttl else None,
+                }
+
+            return session_id
+
+        def renew(self, session_id, **kwargs):
+            """
+            Renew a session, raises NotFound for unknown sessions
+            """
+            store = self.store
+
+            with store.condition:
+                store.expire_sessions()
+
+                session = store.sessions.get(session_id)
+                if session is None:
+                    raise NotFound(f"Session {session_id} not found")
+
+                if session["ttl"]:
+                    session["expires"] = time.monotonic() + session["ttl"]
+
+                return [{"ID": session_id, "TTL": session["TTL"]}]
+
+        def destroy(self, session_id, **kwargs):
+            """
+            Destroy a session
+            """
+            store = self.store
+
+            with store.condition:
+                store.invalidate_session(session_id)
+
+            return True
+
+        def info(self, session_id, **kwargs):
+            """
+            Get a session
+            """
+            store = self.store
+
+            with store.condition:
+                store.expire_sessions()
+                session = store.sessions.get(session_id)
+
+                if session is None:
+                    return str(store.index), None
+
+                return str(store.index), {
+                    "ID": session_id,
+                    "Name": session["Name"],
+                    "Behavior": session["Behavior"],
+                    "TTL": session["TTL"],
+                }
+
+        def list(self, **kwargs):
+            """
+            List all sessions
+            """
+            store = self.store
+
+            with store.condition:
+                store.expire_sessions()
+                return str(store.index), [
+                    self.info(session_id)[1] for session_id in store.sessions
+                ]
+
+    class Agent:
+        """
+        The agent endpoint
+        """
+
+        def __init__(self, store):
+            self.store = store
+            self.service = InMemoryConsul.Agent.Service(store)
+
+        def services(self):
+            """
+            Get all services of the agent
+            """
+            with self.store.condition:
+                return {
+                    service_id: dict(service)
+                    for service_id, service in self.store.services.items()
+                }
+
+        def self(self):
+            """
+            Get the agent configuration
+            """
+            return {"Config": {"NodeName": "in-memory", "Server": True}}
+
+        class Service:
+            """
+            The agent service endpoint
+            """
+
+            def __init__(self, store):
+                self.store = store
+
+            def register(
+                self,
+                name,
+                service_id=None,
+                address=None,
+                port=None,
+                tags=None,
+                **kwargs,
+            ):
+                """
+                Register (or replace) a service
+                """
+                service_id = service_id or name
+
+                with self.store.condition:
+                    self.store.services[service_id] = {
+                        "ID": service_id,
+                        "Service": name,
+                        "Address": address or "",
+                        "Port": port or 0,
+                        "Tags": list(tags or []),
+                    }
+
+                return True
+
+            def deregister(self, service_id, **kwargs):
+                """
+                Deregister a service
+                """
+                with self.store.condition:
+                    self.store.services.pop(service_id, None)
+
+                return True
+
+    class Status:
+        """
+        The status endpoint
+        """
+
+        def __init__(self, store):
+            self.store = store
+
+        def leader(self):
+            """
+            Get the Raft leader
+            """
+            return "127.0.0.1:8300"
+
+        def peers(self):
+            """
+            Get the Raft peers
+            """
+            return ["127.0.0.1:8300"]
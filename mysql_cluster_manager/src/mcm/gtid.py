@@ -0,0 +1,135 @@
+"""This file contains the GTID set arithmetic of the cluster manager"""
+
+
+class Gtid:
+    """
+    Operations on MySQL GTID sets. A parsed set maps the source (the server
+    UUID, with the tag for tagged GTIDs) to a sorted list of disjoint,
+    inclusive (start, end) intervals.
+    """
+
+    @staticmethod
+    def parse(gtid_set):
+        """
+        Parse a GTID set (e.g., "uuid:1-5:7,uuid2:tag:1-3")
+        """
+        result = {}
+
+        if not gtid_set:
+            return result
+
+        for part in gtid_set.replace("\n", "").split(","):
+            part = part.strip()
+            if not part:
+                continue
+
+            tokens = part.split(":")
+            uuid = tokens[0].lower()
+            source = uuid
+
+            for token in tokens[1:]:
+                if not token[0].isdigit():
+                    # A tag, the following intervals belong to uuid:tag
+                    source = f"{uuid}:{token.lower()}"
+                    continue
+
+                if "-" in token:
+                    start, end = token.split("-")
+                else:
+                    start = end = token
+
+                result.setdefault(source, []).append((int(start), int(end)))
+
+        return {source: Gtid.merge(intervals) for source, intervals in result.items()}
+
+    @staticmethod
+    def merge(intervals):
+        """
+        Sort and merge overlapping or adjacent intervals
+        """
+        merged = []
+
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+
+        return merged
+
+    @staticmethod
+    def union(first, second):
+        """
+        Get the parsed set of the transactions in either set
+        """
+        result = {}
+
+        for source in set(first) | set(second):
+            result[source] = Gtid.merge(first.get(source, []) + second.get(source, []))
+
+        return result
+
+    @staticmethod
+    def subtract(minuend, subtrahend):
+        """
+        Get the parsed set of the transactions in minuend but not in subtrahend
+        """
+        result = {}
+
+        for source, intervals in minuend.items():
+            removed = subtrahend.get(source, [])
+            remaining = []
+
+            for start, end in intervals:
+                for removed_start, removed_end in removed:
+                    if removed_end < start or removed_start > end:
+                        continue
+
+                    if removed_start > start:
+                        remaining.append((start, removed_start - 1))
+
+                    start = removed_end + 1
+                    if start > end:
+                        break
+
+                if start <= end:
+                    remaining.append((start, end))
+
+            if remaining:
+                result[source] = remaining
+
+        return result
+
+    @staticmethod
+    def count(gtid_set):
+        """
+        Get the number of transactions of a parsed set
+        """
+        return sum(
+            end - start + 1
+            for intervals in gtid_set.values()
+            for start, end in intervals
+        )
+
+    @staticmethod
+    def is_superset(superset, subset):
+        """
+        Test if the parsed set contains all transactions of the other set
+        """
+        return not Gtid.subtract(subset, superset)
+
+    @staticmethod
+    def format(gtid_set):
+        """
+        Format a parsed set as a GTID set string
+        """
+        parts = []
+
+        for source, intervals in sorted(gtid_set.items()):
+            formatted = [
+                str(start) if start == end else f"{start}-{end}"
+                for start, end in intervals
+            ]
+            parts.append(":".join([source] + formatted))
+
+        return ",".join(parts)
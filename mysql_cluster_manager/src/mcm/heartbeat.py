@@ -0,0 +1,81 @@
+"""This file contains the replication heartbeat writer"""
+
+import logging
+import threading
+
+import mysql.connector
+
+from mcm.mysql import Mysql
+
+
+class Heartbeat:
+    """
+    Writes a high-resolution timestamp into the heartbeat table of the
+    replication leader at a fixed interval. The replicas measure their
+    lag (in ms) against the replicated timestamp.
+    """
+
+    def __init__(self, interval_ms):
+        """
+        Init the writer
+        """
+        self.interval = interval_ms / 1000
+
+        # Only the first failure of a series is logged as a warning
+        self.failing = False
+
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def is_running(self):
+        """
+        Is the writer running
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """
+        Create the heartbeat table and start the writer thread
+        """
+        if self.is_running():
+            return
+
+        Mysql.create_heartbeat_table()
+
+        logging.info(
+            "Starting the replication heartbeat (interval=%dms)", self.interval * 1000
+        )
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the writer thread
+        """
+        if self.thread is None:
+            return
+
+        logging.info("Stopping the replication heartbeat")
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        """
+        Write the heartbeat until stopped
+        """
+        while not self.stop_event.wait(self.interval):
+            try:
+                Mysql.write_heartbeat()
+            except mysql.connector.Error as err:
+                if not self.failing:
+                    logging.warning(
+                        "Unable to write the replication heartbeat: %s", err
+                    )
+                self.failing = True
+                continue
+
+            if self.failing:
+                logging.info("Replication heartbeat is written again")
+            self.failing = False
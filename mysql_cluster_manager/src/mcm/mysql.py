@@ -1,7 +1,10 @@
 """This file is part of the MySQL cluster manager"""
 
+import json
 import logging
 import os
+import select
+import socket
 import subprocess
 import sys
 import threading
@@ -10,7 +13,10 @@ from datetime import timedelta
 
 import mysql.connector
 
+from mcm.config import Config
 from mcm.consul import Consul
+from mcm.gtid import Gtid
+from mcm.sizing import Sizing
 from mcm.utils import Utils
 
 
@@ -23,9 +29,40 @@ class Mysql:
     mysql_server_binary = "/usr/sbin/mysqld"
     mysqld_binary = "/usr/sbin/mysqld"
     mysql_datadir = "/var/lib/mysql"
+    mysql_socket = "/var/run/mysqld/mysqld.sock"
+    mysql_notify_socket = "/var/run/mysqld/mcm_notify.sock"
+    server_id_lease_file = f"{mysql_datadir}/mcm_server_id.json"
     _replication_unhealthy_flag = False
     _replication_lagging = False
 
+    # Bounds of the automatically sized replica applier workers
+    replica_workers_min = 4
+    replica_workers_max = 32
+
+    # Consecutive health checks with a growing applier backlog (or a lag
+    # above replica_scale_up_lag_ms) before adding workers, and without a
+    # backlog before removing them again
+    replica_backlog_checks = 6
+    replica_clear_checks = 12
+    replica_scale_up_lag_ms = 10000
+    _replica_backlog_count = 0
+    _replica_clear_count = 0
+    _replica_backlog_previous = 0
+
+    # Bounded wait (in seconds) for the received transactions to be applied
+    # before taking part in a replication leader election
+    election_apply_timeout = 10
+
+    # Idle persistent connections per (user, password, database, port)
+    _connection_pool = {}
+    _connection_pool_lock = threading.Lock()
+    _connection_pool_size = 2
+
+    # Startup readiness polling (in seconds) and the last start's phase timings
+    start_poll_interval = 0.05
+    start_connect_interval = 0.25
+    start_timings = {}
+
     @staticmethod
     def init_database_if_needed():
         """
@@ -46,88 +83,60 @@ class Mysql:
             use_root_password=False, skip_config_build=True
         )
 
-        # Create application user
-        logging.debug("Creating MySQL user for the application")
-        application_user = Utils.get_envvar_or_secret("MYSQL_USER")
-        appication_password = Utils.get_envvar_or_secret("MYSQL_PASSWORD")
-
-        Mysql.execute_statement_or_exit(
-            f"CREATE USER '{application_user}'@'%' "
-            f"IDENTIFIED WITH caching_sha2_password BY '{appication_password}'"
-        )
-
-        # Create backup user
-        logging.debug("Creating MySQL user for backups")
-        backup_user = Utils.get_envvar_or_secret("MYSQL_BACKUP_USER")
-        backup_password = Utils.get_envvar_or_secret("MYSQL_BACKUP_PASSWORD")
-        Mysql.execute_statement_or_exit(
-            f"CREATE USER '{backup_user}'@'localhost' "
-            f"IDENTIFIED WITH caching_sha2_password BY '{backup_password}'"
-        )
-        Mysql.execute_statement_or_exit(
+        application_user = Config.get().mysql_user
+        appication_password = Config.get().mysql_password
+        backup_user = Config.get().mysql_backup_user
+        backup_password = Config.get().mysql_backup_password
+        replication_user = Config.get().mysql_replication_user
+        replication_password = Config.get().mysql_replication_password
+        root_password = Config.get().mysql_root_password
+
+        # The bootstrap runs as one batch in a single session. All statements
+        # are idempotent, so a re-run of a partially applied batch is safe.
+        bootstrap = [
+            # Create application user
+            f"CREATE USER IF NOT EXISTS '{application_user}'@'%' "
+            f"IDENTIFIED WITH caching_sha2_password BY '{appication_password}'",
+            # Create backup user
+            f"CREATE USER IF NOT EXISTS '{backup_user}'@'localhost' "
+            f"IDENTIFIED WITH caching_sha2_password BY '{backup_password}'",
             "GRANT BACKUP_ADMIN, PROCESS, RELOAD, LOCK TABLES, REPLICATION CLIENT, REPLICATION_SLAVE_ADMIN, "
-            f"REPLICATION CLIENT ON *.* TO '{backup_user}'@'localhost'"
-        )
-        Mysql.execute_statement_or_exit(
+            f"REPLICATION CLIENT ON *.* TO '{backup_user}'@'localhost'",
             "GRANT SELECT ON performance_schema.log_status TO "
-            f"'{backup_user}'@'localhost'"
-        )
-        Mysql.execute_statement_or_exit(
+            f"'{backup_user}'@'localhost'",
             "GRANT SELECT ON performance_schema.keyring_component_status TO "
-            f"'{backup_user}'@'localhost'"
-        )
-        Mysql.execute_statement_or_exit(
+            f"'{backup_user}'@'localhost'",
             "GRANT SELECT ON performance_schema.replication_group_members TO "
-            f"'{backup_user}'@'localhost'"
-        )
-
-        # Create replication user
-        logging.debug("Creating replication user")
-        replication_user = Utils.get_envvar_or_secret("MYSQL_REPLICATION_USER")
-        replication_password = Utils.get_envvar_or_secret("MYSQL_REPLICATION_PASSWORD")
-        Mysql.execute_statement_or_exit(
-            f"CREATE USER '{replication_user}'@'%' "
-            f"IDENTIFIED WITH caching_sha2_password BY '{replication_password}'"
-        )
-        Mysql.execute_statement_or_exit(
-            f"GRANT USAGE, REPLICATION SLAVE, REPLICATION CLIENT ON *.* TO '{replication_user}'@'%'"
-        )
-
-        # Change permissions for the root user
-        logging.debug("Set permissions for the root user")
-        root_password = Utils.get_envvar_or_secret("MYSQL_ROOT_PASSWORD")
-        Mysql.execute_statement_or_exit(
-            f"CREATE USER 'root'@'%' IDENTIFIED WITH caching_sha2_password BY '{root_password}'"
-        )
-        Mysql.execute_statement_or_exit(
-            "GRANT ALL PRIVILEGES ON *.* TO 'root'@'%' WITH GRANT OPTION"
-        )
-        Mysql.execute_statement_or_exit(
+            f"'{backup_user}'@'localhost'",
+            # Create replication user
+            f"CREATE USER IF NOT EXISTS '{replication_user}'@'%' "
+            f"IDENTIFIED WITH caching_sha2_password BY '{replication_password}'",
+            f"GRANT USAGE, REPLICATION SLAVE, REPLICATION CLIENT ON *.* TO '{replication_user}'@'%'",
+            # Change permissions for the root user
+            f"CREATE USER IF NOT EXISTS 'root'@'%' IDENTIFIED WITH caching_sha2_password BY '{root_password}'",
+            "GRANT ALL PRIVILEGES ON *.* TO 'root'@'%' WITH GRANT OPTION",
             "ALTER USER 'root'@'localhost' "
-            f"IDENTIFIED WITH caching_sha2_password BY '{root_password}'"
-        )
+            f"IDENTIFIED WITH caching_sha2_password BY '{root_password}'",
+        ]
 
         # Create database if specified
-        if Utils.get_envvar_or_secret("MYSQL_DATABASE"):
-            database_name = Utils.get_envvar_or_secret("MYSQL_DATABASE")
-            logging.debug("Setting up initial database")
-            Mysql.execute_statement_or_exit(
-                sql=f"CREATE DATABASE IF NOT EXISTS `{database_name}`",
-                username="root",
-                password=root_password,
-            )
-            Mysql.execute_statement_or_exit(
-                sql=f"GRANT ALL PRIVILEGES ON `{database_name}`.* TO '{application_user}'@'%'",
-                username="root",
-                password=root_password,
-            )
+        if Config.get().mysql_database:
+            database_name = Config.get().mysql_database
+            bootstrap += [
+                f"CREATE DATABASE IF NOT EXISTS `{database_name}`",
+                f"GRANT ALL PRIVILEGES ON `{database_name}`.* TO '{application_user}'@'%'",
+            ]
+
+        # Shutdown MySQL server (the session outlives the new root password)
+        bootstrap.append("SHUTDOWN")
+
+        logging.debug("Running the MySQL bootstrap (%d statements)", len(bootstrap))
+        if not Mysql.execute_script(bootstrap):
+            sys.exit(1)
 
-        # Shutdown MySQL server
-        logging.debug("Inital MySQL setup done, shutdown server..")
-        Mysql.execute_statement_or_exit(
-            sql="SHUTDOWN", username="root", password=root_password
-        )
+        logging.debug("Inital MySQL setup done, server is shutting down..")
         mysql_process.wait()
+        Mysql.close_connections()
 
         return True
 
@@ -136,8 +145,9 @@ class Mysql:
         """
         Build the MySQL server configuratuion.
         """
-        consul = Consul.get_instance()
-        server_id = consul.get_mysql_server_id()
+        from mcm.semi_sync import SemiSync
+
+        server_id = Mysql.get_server_id()
 
         outfile = open("/etc/mysql/conf.d/zz_cluster.cnf", "w")
         outfile.write("# DO NOT EDIT - This file was generated automatically\n")
@@ -146,48 +156,110 @@ class Mysql:
         outfile.write("gtid_mode=ON\n")
         outfile.write("enforce-gtid-consistency=ON\n")
 
-        if (
-            Utils.get_envvar("MYSQL_TLS_CA", False)
-            and Utils.get_envvar("MYSQL_TLS_CERT", False)
-            and Utils.get_envvar("MYSQL_TLS_KEY", False)
-        ):
-            outfile.write(f"ssl_ca={Utils.get_envvar('MYSQL_TLS_CA')}\n")
-            outfile.write(f"ssl_cert={Utils.get_envvar('MYSQL_TLS_CERT')}\n")
-            outfile.write(f"ssl_key={Utils.get_envvar('MYSQL_TLS_KEY')}\n")
+        # Parallel apply on the replicas, based on WRITESET dependency tracking
+        # on the leader (the only mode since MySQL 8.4, hence loose-)
+        outfile.write("loose-binlog_transaction_dependency_tracking=WRITESET\n")
+        outfile.write(
+            f"replica_parallel_workers={Mysql.get_replica_parallel_workers()}\n"
+        )
+        outfile.write("replica_preserve_commit_order=ON\n")
 
-        if (
-            Utils.get_envvar_or_secret("MYSQL_TLS_REQUIRED", "True").lower() == "true"
-            or Utils.get_envvar_or_secret("MYSQL_TLS_REQUIRED", "True") == "1"
-        ):
+        # Optional semi-synchronous replication
+        if SemiSync.is_enabled():
+            for option in SemiSync.get_plugin_options():
+                outfile.write(f"{option}\n")
+
+        # InnoDB sized from the container limits and the data volume
+        for option, value in Sizing.build_options(Mysql.mysql_datadir):
+            outfile.write(f"{option}={value}\n")
+
+        if Config.get().tls_enabled:
+            outfile.write(f"ssl_ca={Config.get().tls_ca}\n")
+            outfile.write(f"ssl_cert={Config.get().tls_cert}\n")
+            outfile.write(f"ssl_key={Config.get().tls_key}\n")
+
+        if Config.get().tls_required:
             outfile.write("require_secure_transport=ON\n")
 
         outfile.close()
 
+    @staticmethod
+    def get_server_id():
+        """
+        Get the server id of this node. The id is claimed from Consul once,
+        stored in a lease file in the data directory and reused across
+        restarts.
+        """
+        lease = Mysql.read_server_id_lease()
+
+        if lease is not None and lease.get("server_id"):
+            logging.debug("Reusing leased server_id %s", lease["server_id"])
+            return lease["server_id"]
+
+        lease = {"server_id": Consul.get_instance().claim_server_id()}
+        Mysql.write_server_id_lease(lease)
+
+        logging.info("Using new server_id %s", lease["server_id"])
+        return lease["server_id"]
+
+    @staticmethod
+    def read_server_id_lease():
+        """
+        Read the server id lease of the data directory
+        """
+        if not os.path.isfile(Mysql.server_id_lease_file):
+            return None
+
+        try:
+            with open(Mysql.server_id_lease_file, "r") as lease_file:
+                return json.load(lease_file)
+        except (OSError, ValueError):
+            logging.warning(
+                "Ignoring invalid server id lease %s", Mysql.server_id_lease_file
+            )
+            return None
+
+    @staticmethod
+    def write_server_id_lease(lease):
+        """
+        Write (or remove, if None) the server id lease of the data directory
+        """
+        if lease is None:
+            if os.path.isfile(Mysql.server_id_lease_file):
+                os.remove(Mysql.server_id_lease_file)
+            return
+
+        with open(Mysql.server_id_lease_file, "w") as lease_file:
+            json.dump(lease, lease_file)
+
     @staticmethod
     def change_to_replication_client(leader_ip):
         """
         Make the local MySQL installation to a replication follower
         """
 
+        from mcm.semi_sync import SemiSync
+
         logging.info("Setting up replication (leader=%s)", leader_ip)
 
-        replication_user = Utils.get_envvar_or_secret("MYSQL_REPLICATION_USER")
-        replication_password = Utils.get_envvar_or_secret("MYSQL_REPLICATION_PASSWORD")
+        replication_user = Config.get().mysql_replication_user
+        replication_password = Config.get().mysql_replication_password
 
         Mysql.execute_query_as_root("STOP REPLICA", discard_result=True)
 
-        if (
-            Utils.get_envvar("MYSQL_TLS_CA", False)
-            and Utils.get_envvar("MYSQL_TLS_CERT", False)
-            and Utils.get_envvar("MYSQL_TLS_KEY", False)
-        ):
+        # Acknowledge the received transactions to the leader
+        if SemiSync.is_enabled():
+            SemiSync.disable_source()
+            SemiSync.set_replica_enabled(True)
+
+        if Config.get().tls_enabled:
             Mysql.execute_query_as_root(
                 f"CHANGE REPLICATION SOURCE TO SOURCE_HOST = '{leader_ip}', "
                 f"SOURCE_PORT = 3306, "
                 "SOURCE_AUTO_POSITION = 1, GET_SOURCE_PUBLIC_KEY = 1, "
-                f"SOURCE_SSL=1, SOURCE_SSL_CA = '{Utils.get_envvar('MYSQL_TLS_CA')}', "
-                f"SOURCE_SSL_CERT = '{Utils.get_envvar('MYSQL_TLS_CERT')}', "
-                f"SOURCE_SSL_KEY = '{Utils.get_envvar('MYSQL_TLS_KEY')}'",
+                f"SOURCE_SSL=1, SOURCE_SSL_CA = '{Config.get().tls_ca}', "
+                f"SOURCE_SSL_CERT = '{Config.get().tls_cert}', "
+                f"SOURCE_SSL_KEY = '{Config.get().tls_key}'",
                 discard_result=True,
             )
         else:
@@ -205,27 +277,84 @@ class Mysql:
         )
 
         # Set replicia to read only
-        logging.info("Set MySQL-Server mode to read-only")
-        Mysql.execute_query_as_root("SET GLOBAL read_only = 1", discard_result=True)
-        Mysql.execute_query_as_root(
-            "SET GLOBAL super_read_only = 1", discard_result=True
-        )
+        Mysql.set_read_only(True)
 
     @staticmethod
     def delete_replication_config():
         """
         Stop the replication
         """
+        from mcm.semi_sync import SemiSync
+
         logging.debug("Removing old replication configuraion")
         Mysql.execute_query_as_root("STOP REPLICA", discard_result=True)
         Mysql.execute_query_as_root("RESET REPLICA ALL", discard_result=True)
 
+        # The source side is enabled by the main loop
+        if SemiSync.is_enabled():
+            SemiSync.set_replica_enabled(False)
+
         # Accept writes
-        logging.info("Set MySQL-Server mode to read-write")
-        Mysql.execute_query_as_root(
-            "SET GLOBAL super_read_only = 0", discard_result=True
+        Mysql.set_read_only(False)
+
+    @staticmethod
+    def set_read_only(read_only):
+        """
+        Set the local MySQL server read-only or read-write
+        """
+        if read_only:
+            logging.info("Set MySQL-Server mode to read-only")
+            Mysql.execute_query_as_root("SET GLOBAL read_only = 1", discard_result=True)
+            Mysql.execute_query_as_root(
+                "SET GLOBAL super_read_only = 1", discard_result=True
+            )
+        else:
+            logging.info("Set MySQL-Server mode to read-write")
+            Mysql.execute_query_as_root(
+                "SET GLOBAL super_read_only = 0", discard_result=True
+            )
+            Mysql.execute_query_as_root("SET GLOBAL read_only = 0", discard_result=True)
+
+    @staticmethod
+    def execute_query_on_node(ip_address, sql):
+        """
+        Execute the given SQL query as root on another node (via TCP)
+        and return the rows
+        """
+        cnx = mysql.connector.connect(
+            user="root",
+            password=Config.get().mysql_root_password,
+            database="mysql",
+            host=ip_address,
+            port=3306,
+            connection_timeout=5,
         )
-        Mysql.execute_query_as_root("SET GLOBAL read_only = 0", discard_result=True)
+
+        try:
+            cur = cnx.cursor(dictionary=True)
+            cur.execute(sql)
+            result = cur.fetchall()
+            cur.close()
+            return result
+        finally:
+            cnx.close()
+
+    @staticmethod
+    def wait_for_gtid_set_on_node(ip_address, gtid_set, timeout):
+        """
+        Wait (up to timeout seconds) until the given node has applied the
+        GTID set. Returns True if the node has applied the set.
+        """
+        try:
+            result = Mysql.execute_query_on_node(
+                ip_address,
+                f"SELECT WAIT_FOR_EXECUTED_GTID_SET('{gtid_set}', {timeout}) AS result",
+            )
+        except mysql.connector.Error as err:
+            logging.error("Unable to wait for the GTID set on %s: %s", ip_address, err)
+            return False
+
+        return len(result) == 1 and result[0]["result"] == 0
 
     @staticmethod
     def get_replication_leader_ip():
@@ -260,34 +389,24 @@ class Mysql:
             logging.debug("Skipping replication health check during snapshot")
             return True
 
-        slave_status = Mysql.execute_query_as_root("SHOW REPLICA STATUS")
+        status = Mysql.get_replication_status()
 
-        if len(slave_status) != 1:
+        if status is None:
             return False
 
-        status = slave_status[0]
-
         # Check that the replication threads are running
-        io_running = status.get("Replica_IO_Running", "No")
-        sql_running = status.get("Replica_SQL_Running", "No")
-
-        if io_running != "Yes" or sql_running != "Yes":
-            io_error = status.get("Last_IO_Error", "")
-            sql_error = status.get("Last_SQL_Error", "")
-
+        if not status["io_running"] or not status["sql_running"]:
             logging.warning(
                 "Replication is not healthy (IO_Running=%s, SQL_Running=%s, "
                 "IO_Error='%s', SQL_Error='%s'), attempting restart",
-                io_running,
-                sql_running,
-                io_error,
-                sql_error,
+                status["io_running"],
+                status["sql_running"],
+                status["io_error"],
+                status["sql_error"],
             )
 
-            replication_user = Utils.get_envvar_or_secret("MYSQL_REPLICATION_USER")
-            replication_password = Utils.get_envvar_or_secret(
-                "MYSQL_REPLICATION_PASSWORD"
-            )
+            replication_user = Config.get().mysql_replication_user
+            replication_password = Config.get().mysql_replication_password
 
             Mysql.execute_query_as_root("STOP REPLICA", discard_result=True)
             Mysql.execute_query_as_root(
@@ -299,19 +418,16 @@ class Mysql:
             # Allow threads time to start before verifying
             time.sleep(1)
 
-            verify_status = Mysql.execute_query_as_root("SHOW REPLICA STATUS")
-            if len(verify_status) == 1:
-                new_io = verify_status[0].get("Replica_IO_Running", "No")
-                new_sql = verify_status[0].get("Replica_SQL_Running", "No")
-
-                if new_io == "No" or new_sql == "No":
+            verify_status = Mysql.get_replication_status()
+            if verify_status is not None:
+                if not verify_status["io_running"] or not verify_status["sql_running"]:
                     logging.error(
                         "Replication restart failed (IO_Running=%s, SQL_Running=%s, "
                         "IO_Error='%s', SQL_Error='%s')",
-                        new_io,
-                        new_sql,
-                        verify_status[0].get("Last_IO_Error", ""),
-                        verify_status[0].get("Last_SQL_Error", ""),
+                        verify_status["io_running"],
+                        verify_status["sql_running"],
+                        verify_status["io_error"],
+                        verify_status["sql_error"],
                     )
                 else:
                     logging.info("Replication restart succeeded")
@@ -326,35 +442,299 @@ class Mysql:
             Consul.get_instance().node_set_replication_unhealthy_flag(False)
             Mysql._replication_unhealthy_flag = False
 
-        seconds_behind = status.get("Seconds_Behind_Source")
-        lag_threshold = int(
-            Utils.get_envvar_or_secret("MYSQL_REPLICATION_LAG_THRESHOLD", "5")
-        )
+        lag_ms = status["lag_ms"]
+        gtid_backlog = status["gtid_backlog"]
+        Consul.get_instance().node_set_replication_lag(lag_ms, gtid_backlog)
+
+        # Add applier workers while the backlog keeps growing or the lag is
+        # high, remove them again once the backlog has cleared
+        if gtid_backlog > 0:
+            Mysql._replica_clear_count = 0
+
+            if (
+                gtid_backlog > Mysql._replica_backlog_previous
+                or lag_ms > Mysql.replica_scale_up_lag_ms
+            ):
+                Mysql._replica_backlog_count += 1
+            else:
+                Mysql._replica_backlog_count = 0
+
+            if Mysql._replica_backlog_count >= Mysql.replica_backlog_checks:
+                Mysql.retune_replica_parallel_workers(True)
+                Mysql._replica_backlog_count = 0
+        else:
+            Mysql._replica_backlog_count = 0
+            Mysql._replica_clear_count += 1
+
+            if Mysql._replica_clear_count >= Mysql.replica_clear_checks:
+                Mysql.retune_replica_parallel_workers(False)
+                Mysql._replica_clear_count = 0
+
+        Mysql._replica_backlog_previous = gtid_backlog
+
+        # Exclude the replica from routing while it lags
+        routing_lag_ms = Config.get().replication_routing_lag_ms
+        if routing_lag_ms > 0:
+            Consul.get_instance().node_set_replication_unhealthy_flag(
+                lag_ms > routing_lag_ms
+            )
+
+        lag_threshold = Config.get().replication_lag_threshold
         if lag_threshold > 0:
-            if seconds_behind is not None and seconds_behind > lag_threshold:
-                logging.warning("Replica is %s seconds behind source", seconds_behind)
-                Consul.get_instance().node_set_replication_unhealthy_flag(True)
+            if lag_ms > lag_threshold * 1000:
+                logging.warning(
+                    "Replica is %d ms (%d transactions) behind source",
+                    lag_ms,
+                    gtid_backlog,
+                )
                 Mysql._replication_lagging = True
             else:
-                logging.debug("Replica is %s seconds behind source", seconds_behind)
-                Consul.get_instance().node_set_replication_unhealthy_flag(False)
+                logging.debug(
+                    "Replica is %d ms (%d transactions) behind source",
+                    lag_ms,
+                    gtid_backlog,
+                )
                 Mysql._replication_lagging = False
 
-        io_state = status.get("Replica_IO_State", "")
-        logging.debug("Follower IO state is '%s'", io_state)
-        if (
-            io_state != "Waiting for source to send event"
-            and io_state != "Reconnecting after a failed source event read"
-        ):
+        # Caught up if all received transactions are applied
+        return gtid_backlog == 0
+
+    @staticmethod
+    def get_replication_status():
+        """
+        Get the state of the replication threads and the transaction-level
+        lag from performance_schema. The GTID backlog is the number of
+        received but not yet applied transactions. The lag (in ms) is taken
+        from the heartbeat table, or if there is no heartbeat, the time since
+        the original commit of the oldest transaction in apply.
+        Returns None if no replication is configured.
+        """
+        connection = Mysql.execute_query_as_root(
+            "SELECT SERVICE_STATE, LAST_ERROR_MESSAGE, RECEIVED_TRANSACTION_SET, "
+            "TIMESTAMPDIFF(MICROSECOND, "
+            "LAST_QUEUED_TRANSACTION_ORIGINAL_COMMIT_TIMESTAMP, NOW(6)) AS queued_us "
+            "FROM performance_schema.replication_connection_status "
+            "WHERE CHANNEL_NAME = ''"
+        )
+
+        if len(connection) != 1:
+            return None
+
+        connection = connection[0]
+
+        applier = Mysql.execute_query_as_root(
+            "SELECT SERVICE_STATE, @@GLOBAL.gtid_executed AS gtid_executed "
+            "FROM performance_schema.replication_applier_status "
+            "WHERE CHANNEL_NAME = ''"
+        )
+
+        workers = Mysql.execute_query_as_root(
+            "SELECT LAST_ERROR_MESSAGE, APPLYING_TRANSACTION, "
+            "TIMESTAMPDIFF(MICROSECOND, "
+            "APPLYING_TRANSACTION_ORIGINAL_COMMIT_TIMESTAMP, NOW(6)) AS applying_us "
+            "FROM performance_schema.replication_applier_status_by_worker "
+            "WHERE CHANNEL_NAME = ''"
+        )
+
+        sql_running = len(applier) == 1 and applier[0]["SERVICE_STATE"] == "ON"
+        executed = applier[0]["gtid_executed"] if len(applier) == 1 else ""
+
+        received = Gtid.parse(connection["RECEIVED_TRANSACTION_SET"])
+        gtid_backlog = Gtid.count(Gtid.subtract(received, Gtid.parse(executed)))
+
+        sql_errors = [
+            w["LAST_ERROR_MESSAGE"] for w in workers if w["LAST_ERROR_MESSAGE"]
+        ]
+
+        lag_ms = Mysql.get_heartbeat_lag_ms()
+        if lag_ms is None:
+            lag_ms = 0
+
+        if lag_ms == 0 and gtid_backlog > 0:
+            applying = [
+                w["applying_us"]
+                for w in workers
+                if w["APPLYING_TRANSACTION"] and w["applying_us"] is not None
+            ]
+
+            # No worker is applying yet, the last queued transaction is the lower bound
+            if not applying and connection["queued_us"] is not None:
+                applying = [connection["queued_us"]]
+
+            lag_ms = max(0, max(applying, default=0) // 1000)
+
+        return {
+            "io_running": connection["SERVICE_STATE"] == "ON",
+            "sql_running": sql_running,
+            "io_error": connection["LAST_ERROR_MESSAGE"] or "",
+            "sql_error": "; ".join(sql_errors),
+            "gtid_executed": executed,
+            "gtid_received": connection["RECEIVED_TRANSACTION_SET"] or "",
+            "gtid_backlog": gtid_backlog,
+            "lag_ms": int(lag_ms),
+        }
+
+    @staticmethod
+    def get_election_state():
+        """
+        Get the GTID state of this replica for the replication leader
+        election. The received transactions are applied first, bounded by
+        election_apply_timeout. Returns None if the replica can not be
+        promoted (no replication configured or the applier has failed).
+        """
+        status = Mysql.get_replication_status()
+
+        if status is None or not status["sql_running"] or status["sql_error"]:
+            return None
+
+        if status["gtid_backlog"] > 0:
+            logging.info(
+                "Applying %d received transactions before the election",
+                status["gtid_backlog"],
+            )
+            Mysql.execute_query_as_root(
+                "SELECT WAIT_FOR_EXECUTED_GTID_SET("
+                f"'{status['gtid_received']}', {Mysql.election_apply_timeout}) AS result"
+            )
+            status = Mysql.get_replication_status()
+
+            if status is None:
+                return None
+
+        return {
+            "gtid_executed": status["gtid_executed"],
+            "gtid_received": status["gtid_received"],
+            "gtid_backlog": status["gtid_backlog"],
+        }
+
+    @staticmethod
+    def reset_replication_health():
+        """
+        Reset the replica health state after the promotion to replication
+        leader (the node document is reset by the promotion itself)
+        """
+        Mysql._replication_unhealthy_flag = False
+        Mysql._replication_lagging = False
+        Mysql._replica_backlog_count = 0
+        Mysql._replica_clear_count = 0
+        Mysql._replica_backlog_previous = 0
+
+    @staticmethod
+    def get_replica_parallel_workers():
+        """
+        Get the number of replica applier workers, sized from the available
+        CPUs unless configured
+        """
+        configured = Config.get().replica_parallel_workers
+        if configured > 0:
+            return configured
+
+        return max(
+            Mysql.replica_workers_min,
+            min(Sizing.get_available_cpus(), Mysql.replica_workers_max),
+        )
+
+    @staticmethod
+    def retune_replica_parallel_workers(increase):
+        """
+        Double the replica applier workers on a sustained backlog, up to
+        twice the available CPUs, or halve them back towards the sized
+        number once the backlog has cleared. Returns True if the workers
+        were changed.
+        """
+        if Config.get().replica_parallel_workers > 0:
             return False
 
-        sql_state = status.get("Replica_SQL_Running_State", "")
-        logging.debug("Follower SQL state is '%s'", sql_state)
-        if sql_state != "Replica has read all relay log; waiting for more updates":
+        current = Mysql.execute_query_as_root(
+            "SELECT @@GLOBAL.replica_parallel_workers AS workers"
+        )[0]["workers"]
+
+        if increase:
+            limit = min(2 * Sizing.get_available_cpus(), Mysql.replica_workers_max)
+            target = min(2 * max(current, 1), limit)
+        else:
+            target = max(current // 2, Mysql.get_replica_parallel_workers())
+
+        if increase and target <= current:
+            logging.debug(
+                "Replica applier backlog persists, already at %d workers", current
+            )
+            return False
+
+        if not increase and target >= current:
             return False
 
+        logging.info(
+            "Replica applier backlog %s, changing workers from %d to %d",
+            "persists" if increase else "cleared",
+            current,
+            target,
+        )
+
+        # The workers are only changed on a restart of the applier
+        Mysql.execute_query_as_root("STOP REPLICA SQL_THREAD", discard_result=True)
+        Mysql.execute_query_as_root(
+            f"SET GLOBAL replica_parallel_workers = {target}", discard_result=True
+        )
+        Mysql.execute_query_as_root("START REPLICA SQL_THREAD", discard_result=True)
         return True
 
+    @staticmethod
+    def create_heartbeat_table():
+        """
+        Create the heartbeat table on the replication leader
+        """
+        Mysql.execute_query_as_root(
+            "CREATE DATABASE IF NOT EXISTS mcm", discard_result=True
+        )
+        Mysql.execute_query_as_root(
+            "CREATE TABLE IF NOT EXISTS mcm.heartbeat ("
+            "id TINYINT UNSIGNED NOT NULL PRIMARY KEY, "
+            "server_id INT UNSIGNED NOT NULL, "
+            "ts TIMESTAMP(6) NOT NULL)",
+            discard_result=True,
+        )
+
+    @staticmethod
+    def write_heartbeat():
+        """
+        Write the current time into the heartbeat table
+        """
+        Mysql.execute_query_as_root(
+            "REPLACE INTO mcm.heartbeat (id, server_id, ts) "
+            "VALUES (1, @@GLOBAL.server_id, NOW(6))",
+            discard_result=True,
+        )
+
+    @staticmethod
+    def get_heartbeat_lag_ms():
+        """
+        Get the replication lag (in ms) from the replicated heartbeat. The
+        heartbeat is up to one interval old on a caught up replica, so the
+        interval is not counted as lag. Returns None if the heartbeat is
+        disabled or not available.
+        """
+        interval_ms = Config.get().heartbeat_interval_ms
+
+        # A row left by an earlier run (or a restored snapshot) is not updated
+        if interval_ms <= 0:
+            return None
+
+        try:
+            result = Mysql.execute_query_as_root(
+                "SELECT TIMESTAMPDIFF(MICROSECOND, ts, NOW(6)) AS lag_us "
+                "FROM mcm.heartbeat WHERE id = 1"
+            )
+        except mysql.connector.ProgrammingError:
+            logging.debug("No heartbeat table available")
+            return None
+
+        if len(result) != 1 or result[0]["lag_us"] is None:
+            return None
+
+        lag_ms = int(result[0]["lag_us"]) // 1000
+        return max(0, lag_ms - interval_ms)
+
     @staticmethod
     def server_start(use_root_password=True, skip_config_build=False):
         """
@@ -362,22 +742,61 @@ class Mysql:
         """
 
         logging.info("Starting MySQL")
+        started = time.monotonic()
+        Mysql.start_timings = {}
 
         if not skip_config_build:
             Mysql.build_configuration()
+            Mysql.start_timings["config"] = time.monotonic() - started
+
+        # mysqld reports READY=1 on the notify socket (systemd protocol)
+        notify_socket = Mysql.create_notify_socket()
+        environment = dict(os.environ)
+        if notify_socket is not None:
+            environment["NOTIFY_SOCKET"] = Mysql.mysql_notify_socket
 
         mysql_server = [Mysql.mysql_server_binary, "--user=mysql"]
-        mysql_process = subprocess.Popen(mysql_server)
+        mysql_process = subprocess.Popen(mysql_server, env=environment)
 
         # Use root password for the connection or not
         root_password = None
         if use_root_password:
-            root_password = Utils.get_envvar_or_secret("MYSQL_ROOT_PASSWORD")
+            root_password = Config.get().mysql_root_password
 
-        Mysql.wait_for_connection(password=root_password)
+        try:
+            Mysql.wait_for_connection(
+                password=root_password,
+                process=mysql_process,
+                notify_socket=notify_socket,
+                started=started,
+            )
+        finally:
+            if notify_socket is not None:
+                notify_socket.close()
 
         return mysql_process
 
+    @staticmethod
+    def create_notify_socket():
+        """
+        Create the datagram socket mysqld sends its readiness notification
+        to. Returns None if the socket can not be created.
+        """
+        try:
+            if os.path.exists(Mysql.mysql_notify_socket):
+                os.unlink(Mysql.mysql_notify_socket)
+
+            notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            notify_socket.bind(Mysql.mysql_notify_socket)
+
+            # mysqld sends the notification after switching to the mysql user
+            os.chmod(Mysql.mysql_notify_socket, 0o666)
+        except OSError as err:
+            logging.warning("Unable to create the MySQL notify socket: %s", err)
+            return None
+
+        return notify_socket
+
     @staticmethod
     def server_stop():
         """
@@ -390,70 +809,266 @@ class Mysql:
 
         # Try to shutdown the server using the root password
         if not result:
-            root_password = Utils.get_envvar_or_secret("MYSQL_ROOT_PASSWORD")
+            root_password = Config.get().mysql_root_password
             Mysql.execute_statement(sql="SHUTDOWN", password=root_password)
 
+        Mysql.close_connections()
+
     @staticmethod
     def execute_query_as_root(sql, database="mysql", discard_result=False):
         """
         Execute the SQL query and return result.
         """
 
-        root_password = Utils.get_envvar_or_secret("MYSQL_ROOT_PASSWORD")
+        root_password = Config.get().mysql_root_password
 
-        cnx = None
+        return Mysql.execute_pooled(
+            sql,
+            username="root",
+            password=root_password,
+            database=database,
+            fetch=not discard_result,
+        )
 
-        try:
+    @staticmethod
+    def execute_pooled(
+        sql, username="root", password=None, database="mysql", port=None, fetch=False
+    ):
+        """
+        Execute the SQL on a pooled persistent connection and return the
+        rows if fetch is set. If a pooled connection was lost (e.g., after
+        a server restart), the pool is flushed and the SQL retried once.
+        """
+        key = (username, password, database, port)
+
+        for attempt in range(2):
+            cnx, reused = Mysql.acquire_connection(key)
+
+            try:
+                cur = cnx.cursor(dictionary=True, buffered=True)
+                cur.execute(sql)
+                result = cur.fetchall() if fetch else None
+                cur.close()
+            except mysql.connector.Error:
+                if cnx.is_connected():
+                    Mysql.release_connection(key, cnx)
+                    raise
+
+                Mysql.close_connections(key)
+                cnx.close()
+
+                if reused and attempt == 0:
+                    logging.debug("Pooled MySQL connection was lost, reconnecting")
+                    continue
+
+                raise
+
+            Mysql.release_connection(key, cnx)
+            return result
+
+        return None
+
+    @staticmethod
+    def acquire_connection(key):
+        """
+        Get an idle pooled connection or open a new one. Returns the
+        connection and whether it was reused.
+        """
+        with Mysql._connection_pool_lock:
+            idle = Mysql._connection_pool.get(key)
+
+            if idle:
+                return idle.pop(), True
+
+        username, password, database, port = key
+
+        if port is None:
             cnx = mysql.connector.connect(
-                user="root",
-                password=root_password,
+                user=username,
+                password=password,
+                database=database,
+                unix_socket=Mysql.mysql_socket,
+                autocommit=True,
+            )
+        else:
+            cnx = mysql.connector.connect(
+                user=username,
+                password=password,
                 database=database,
-                unix_socket="/var/run/mysqld/mysqld.sock",
+                port=port,
+                autocommit=True,
             )
 
-            cur = cnx.cursor(dictionary=True, buffered=True)
-            cur.execute(sql)
+        return cnx, False
 
-            if discard_result:
-                return None
+    @staticmethod
+    def release_connection(key, cnx):
+        """
+        Return a connection to the pool, surplus connections are closed
+        """
+        with Mysql._connection_pool_lock:
+            idle = Mysql._connection_pool.setdefault(key, [])
 
-            return cur.fetchall()
-        finally:
-            if cnx:
+            if len(idle) < Mysql._connection_pool_size:
+                idle.append(cnx)
+                return
+
+        cnx.close()
+
+    @staticmethod
+    def close_connections(key=None):
+        """
+        Close the idle pooled connections (default: of all keys)
+        """
+        with Mysql._connection_pool_lock:
+            if key is None:
+                connections = [
+                    cnx for idle in Mysql._connection_pool.values() for cnx in idle
+                ]
+                Mysql._connection_pool = {}
+            else:
+                connections = Mysql._connection_pool.pop(key, [])
+
+        for cnx in connections:
+            try:
                 cnx.close()
+            except mysql.connector.Error:
+                logging.debug("Unable to close pooled MySQL connection")
 
     @staticmethod
     def wait_for_connection(
-        timeout=120, username="root", password=None, database="mysql"
+        timeout=120,
+        username="root",
+        password=None,
+        database="mysql",
+        process=None,
+        notify_socket=None,
+        started=None,
     ):
         """
         Test connection via unix-socket. During first init
         MySQL start without network access.
+
+        The socket file is polled every start_poll_interval seconds and the
+        readiness notification of mysqld is awaited on the notify socket (if
+        any). A connection is tried once mysqld is ready, or every
+        start_connect_interval seconds once the socket file exists (for
+        servers without notification support).
         """
-        elapsed_time = 0
+        if started is None:
+            started = time.monotonic()
+            Mysql.start_timings = {}
+
+        deadline = time.monotonic() + timeout
+        next_connect = 0
         last_error = None
 
-        while elapsed_time < timeout:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                logging.error(
+                    "MySQL exited during startup (exit code %i)", process.returncode
+                )
+                sys.exit(1)
+
+            if notify_socket is not None and "notify" not in Mysql.start_timings:
+                readable, _, _ = select.select(
+                    [notify_socket], [], [], Mysql.start_poll_interval
+                )
+                if readable:
+                    message = notify_socket.recv(4096)
+                    if b"READY=1" in message.split(b"\n"):
+                        Mysql.start_timings["notify"] = time.monotonic() - started
+            else:
+                time.sleep(Mysql.start_poll_interval)
+
+            now = time.monotonic()
+
+            if not os.path.exists(Mysql.mysql_socket):
+                continue
+
+            Mysql.start_timings.setdefault("socket", now - started)
+
+            if "notify" not in Mysql.start_timings and now < next_connect:
+                continue
+
+            next_connect = now + Mysql.start_connect_interval
+
             try:
                 cnx = mysql.connector.connect(
                     user=username,
                     password=password,
                     database=database,
-                    unix_socket="/var/run/mysqld/mysqld.sock",
+                    unix_socket=Mysql.mysql_socket,
                 )
                 cnx.close()
-                logging.debug("MySQL connection successfully")
-                return True
             except mysql.connector.Error as err:
-                time.sleep(1)
-                elapsed_time = elapsed_time + 1
                 last_error = err
+                continue
+
+            Mysql.start_timings["connect"] = time.monotonic() - started
+            logging.info(
+                "MySQL is ready for connections (%s)",
+                ", ".join(
+                    f"{phase}={duration:.3f}s"
+                    for phase, duration in Mysql.start_timings.items()
+                ),
+            )
+            return True
 
         logging.error(
-            "Unable to connect to MySQL (timeout=%i). %s", elapsed_time, last_error
+            "Unable to connect to MySQL (timeout=%i). %s", timeout, last_error
         )
         sys.exit(1)
 
+    @staticmethod
+    def execute_script(
+        statements, username="root", password=None, database="mysql", port=None
+    ):
+        """
+        Execute the given SQL statements in order in a single session. Stops
+        at the first failing statement.
+        """
+        try:
+            if port is None:
+                cnx = mysql.connector.connect(
+                    user=username,
+                    password=password,
+                    database=database,
+                    unix_socket=Mysql.mysql_socket,
+                    autocommit=True,
+                )
+            else:
+                cnx = mysql.connector.connect(
+                    user=username,
+                    password=password,
+                    database=database,
+                    port=port,
+                    autocommit=True,
+                )
+        except mysql.connector.Error as err:
+            logging.error("Failed to connect to MySQL: %s", err)
+            return False
+
+        number = 0
+
+        try:
+            cur = cnx.cursor()
+            for number, sql in enumerate(statements, start=1):
+                cur.execute(sql)
+            cur.close()
+        except mysql.connector.Error as err:
+            logging.error(
+                "Failed to execute SQL (statement %d of %d): %s",
+                number,
+                len(statements),
+                err,
+            )
+            return False
+        finally:
+            cnx.close()
+
+        return True
+
     @staticmethod
     def execute_statement_or_exit(
         sql=None, username="root", password=None, database="mysql", port=None
@@ -480,24 +1095,13 @@ class Mysql:
         Execute the given SQL statement.
         """
         try:
-            if port is None:
-                cnx = mysql.connector.connect(
-                    user=username,
-                    password=password,
-                    database=database,
-                    unix_socket="/var/run/mysqld/mysqld.sock",
-                )
-
-            else:
-                cnx = mysql.connector.connect(
-                    user=username, password=password, database=database, port=port
-                )
-
-            cursor = cnx.cursor()
-
-            cursor.execute(sql)
-
-            cnx.close()
+            Mysql.execute_pooled(
+                sql,
+                username=username,
+                password=password,
+                database=database,
+                port=port,
+            )
             return True
         except mysql.connector.Error as err:
             if log_error:
@@ -526,7 +1130,7 @@ class Mysql:
             return False
 
         backup_date = Snapshot.getTime()
-        maxage_seconds = int(Utils.get_envvar_or_secret("SNAPSHOT_MINUTES", 15)) * 60
+        maxage_seconds = Config.get().snapshot_minutes * 60
         if maxage_seconds < 60:
             maxage_seconds = 60
 
@@ -562,8 +1166,8 @@ class Mysql:
         """
 
         # Ensure replication user is still available and set up correctly
-        replication_user = Utils.get_envvar_or_secret("MYSQL_REPLICATION_USER")
-        replication_password = Utils.get_envvar_or_secret("MYSQL_REPLICATION_PASSWORD")
+        replication_user = Config.get().mysql_replication_user
+        replication_password = Config.get().mysql_replication_password
 
         grants = Mysql.execute_query_as_root(
             f"SHOW GRANTS FOR '{replication_user}'@'%'"
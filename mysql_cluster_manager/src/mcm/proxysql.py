@@ -5,6 +5,7 @@ import os
 import subprocess
 import time
 
+from mcm.config import Config
 from mcm.mysql import Mysql
 from mcm.utils import Utils
 
@@ -19,6 +20,7 @@ class Proxysql:
         Init the instance
         """
         self.configured_mysql_hosts = ()
+        self.configured_leader = None
 
     @staticmethod
     def inital_setup():
@@ -28,9 +30,9 @@ class Proxysql:
         logging.info("Performing initial ProxySQL setup")
 
         # Change admin password if needed
-        if Utils.get_envvar_or_secret("PROXYSQL_ADMIN_PASSWORD", "admin") != "admin":
+        if Config.get().proxysql_admin_password != "admin":
             Mysql.execute_statement_or_exit(
-                sql=f"UPDATE global_variables SET variable_value='admin:{Utils.get_envvar_or_secret('PROXYSQL_ADMIN_PASSWORD', 'admin')}' "
+                sql=f"UPDATE global_variables SET variable_value='admin:{Config.get().proxysql_admin_password}' "
                 "WHERE variable_name='admin-admin_credentials'",
                 username="admin",
                 password="admin",
@@ -56,8 +58,8 @@ class Proxysql:
         )
 
         # Setup Monitoring User
-        replication_user = Utils.get_envvar_or_secret("MYSQL_REPLICATION_USER")
-        replication_password = Utils.get_envvar_or_secret("MYSQL_REPLICATION_PASSWORD")
+        replication_user = Config.get().mysql_replication_user
+        replication_password = Config.get().mysql_replication_password
 
         Proxysql.perform_sql_query(
             f"UPDATE global_variables SET variable_value='{replication_user}' "
@@ -69,21 +71,17 @@ class Proxysql:
         )
 
         # Enable TLS for MySQL backend connections if needed
-        if (
-            Utils.get_envvar("MYSQL_TLS_CA", False)
-            and Utils.get_envvar("MYSQL_TLS_CERT", False)
-            and Utils.get_envvar("MYSQL_TLS_KEY", False)
-        ):
+        if Config.get().tls_enabled:
             Proxysql.perform_sql_query(
-                f"UPDATE global_variables SET variable_value='{Utils.get_envvar('MYSQL_TLS_CA')}' "
+                f"UPDATE global_variables SET variable_value='{Config.get().tls_ca}' "
                 "WHERE variable_name='mysql-ssl_p2s_ca'"
             )
             Proxysql.perform_sql_query(
-                f"UPDATE global_variables SET variable_value='{Utils.get_envvar('MYSQL_TLS_CERT')}' "
+                f"UPDATE global_variables SET variable_value='{Config.get().tls_cert}' "
                 "WHERE variable_name='mysql-ssl_p2s_cert'"
             )
             Proxysql.perform_sql_query(
-                f"UPDATE global_variables SET variable_value='{Utils.get_envvar('MYSQL_TLS_KEY')}' "
+                f"UPDATE global_variables SET variable_value='{Config.get().tls_key}' "
                 "WHERE variable_name='mysql-ssl_p2s_key'"
             )
 
@@ -105,20 +103,11 @@ class Proxysql:
         )
 
         # Configure Application User
-        application_user = Utils.get_envvar_or_secret("MYSQL_USER")
-        application_password = Utils.get_envvar_or_secret("MYSQL_PASSWORD")
+        application_user = Config.get().mysql_user
+        application_password = Config.get().mysql_password
 
         # Force SSL/TLS for application connections if needed
-        if (
-            Utils.get_envvar("MYSQL_TLS_CA", False)
-            and Utils.get_envvar("MYSQL_TLS_CERT", False)
-            and Utils.get_envvar("MYSQL_TLS_KEY", False)
-            and (
-                Utils.get_envvar_or_secret("MYSQL_TLS_REQUIRED", "True").lower()
-                == "true"
-                or Utils.get_envvar_or_secret("MYSQL_TLS_REQUIRED", "True") == "1"
-            )
-        ):
+        if Config.get().tls_enabled and (Config.get().tls_required):
             use_ssl = 1
         else:
             use_ssl = 0
@@ -133,26 +122,18 @@ class Proxysql:
         Proxysql.activate_config()
 
         # Copy TLS files to the right place for ProxySQL and initialise TLS
-        if (
-            Utils.get_envvar("MYSQL_TLS_CA", False)
-            and Utils.get_envvar("MYSQL_TLS_CERT", False)
-            and Utils.get_envvar("MYSQL_TLS_KEY", False)
-        ):
+        if Config.get().tls_enabled:
             time.sleep(1)
 
             os.remove("/var/lib/proxysql/proxysql-ca.pem")
             os.remove("/var/lib/proxysql/proxysql-cert.pem")
             os.remove("/var/lib/proxysql/proxysql-key.pem")
+            os.symlink(Config.get().tls_ca, "/var/lib/proxysql/proxysql-ca.pem")
             os.symlink(
-                Utils.get_envvar("MYSQL_TLS_CA"), "/var/lib/proxysql/proxysql-ca.pem"
-            )
-            os.symlink(
-                Utils.get_envvar("MYSQL_TLS_CERT"),
+                Config.get().tls_cert,
                 "/var/lib/proxysql/proxysql-cert.pem",
             )
-            os.symlink(
-                Utils.get_envvar("MYSQL_TLS_KEY"), "/var/lib/proxysql/proxysql-key.pem"
-            )
+            os.symlink(Config.get().tls_key, "/var/lib/proxysql/proxysql-key.pem")
 
             Proxysql.perform_sql_query("PROXYSQL RELOAD TLS")
 
@@ -172,50 +153,56 @@ class Proxysql:
         Proxysql.perform_sql_query("SAVE MYSQL QUERY RULES TO DISK")
 
     @staticmethod
-    def set_mysql_server(mysql_servers):
+    def set_mysql_server(mysql_servers, leader_ip=None):
         """
-        Set the backend MySQL server
+        Set the backend MySQL server. If the replication leader is known,
+        the other servers are placed in the reader hostgroup right away
+        instead of waiting for the read_only monitor of ProxySQL.
         """
         logging.info("Removing all old backend MySQL Server")
         Proxysql.perform_sql_query("DELETE FROM mysql_servers")
 
-        max_lag = int(
-            Utils.get_envvar_or_secret("MYSQL_REPLICATION_LAG_THRESHOLD", "5")
-        )
+        max_lag = Config.get().replication_lag_threshold
 
         for mysql_server in mysql_servers:
             logging.info("Adding %s as backend MySQL Server", mysql_server)
-            if (
-                Utils.get_envvar("MYSQL_TLS_CA", False)
-                and Utils.get_envvar("MYSQL_TLS_CERT", False)
-                and Utils.get_envvar("MYSQL_TLS_KEY", False)
-            ):
+            if Config.get().tls_enabled:
                 use_ssl = 1
             else:
                 use_ssl = 0
 
+            if leader_ip is not None and mysql_server != leader_ip:
+                hostgroup = 2
+            else:
+                hostgroup = 1
+
             Proxysql.perform_sql_query(
                 "INSERT INTO mysql_servers(hostgroup_id, hostname, port, use_ssl, max_replication_lag) "
-                f"VALUES (1, '{mysql_server}', 3306, {use_ssl}, {max_lag})"
+                f"VALUES ({hostgroup}, '{mysql_server}', 3306, {use_ssl}, {max_lag})"
             )
 
         Proxysql.perform_sql_query("LOAD MYSQL SERVERS TO RUNTIME")
         Proxysql.perform_sql_query("SAVE MYSQL SERVERS TO DISK")
 
-    def update_mysql_server_if_needed(self, current_mysql_servers):
+    def update_mysql_server_if_needed(self, current_mysql_servers, leader_ip=None):
         """
         Update the MySQL-Servers if needed (changed)
         """
         current_mysql_servers.sort()
 
-        if self.configured_mysql_hosts != current_mysql_servers:
+        if (
+            self.configured_mysql_hosts != current_mysql_servers
+            or self.configured_leader != leader_ip
+        ):
             logging.info(
-                "MySQL backend has changed (old=%s, new=%s), reconfiguring",
+                "MySQL backend has changed (old=%s, new=%s, leader=%s), reconfiguring",
                 self.configured_mysql_hosts,
                 current_mysql_servers,
+                leader_ip,
             )
-            Proxysql.set_mysql_server(current_mysql_servers)
+            Proxysql.set_mysql_server(current_mysql_servers, leader_ip)
             self.configured_mysql_hosts = current_mysql_servers
+            self.configured_leader = leader_ip
             return True
 
         return False
@@ -228,7 +215,7 @@ class Proxysql:
         Mysql.execute_statement_or_exit(
             sql=sql,
             username="admin",
-            password=Utils.get_envvar_or_secret("PROXYSQL_ADMIN_PASSWORD", "admin"),
+            password=Config.get().proxysql_admin_password,
             database="",
             port=6032,
         )
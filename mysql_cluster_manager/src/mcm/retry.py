@@ -0,0 +1,77 @@
+"""This file contains the retry policy of the cluster manager"""
+
+import logging
+import random
+import threading
+import time
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter, bounded by a per-call deadline
+    """
+
+    # End time of the innermost running call per thread, used to bound the
+    # duration of each attempt (e.g., the HTTP timeout of the Consul client)
+    local = threading.local()
+
+    def __init__(self, name, deadline, initial_delay=0.05, max_delay=2, multiplier=2):
+        """
+        Init the policy, all durations are in seconds
+        """
+        self.name = name
+        self.deadline = deadline
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+
+    def attempts(self, deadline=None):
+        """
+        Yield the attempt numbers of a call. Between two attempts, the policy
+        sleeps with exponential backoff and jitter. No further attempt is
+        made once the deadline (default: the policy deadline) has passed.
+        While an attempt runs, remaining_time() returns the time left.
+        """
+        if deadline is None:
+            deadline = self.deadline
+
+        end_time = time.monotonic() + deadline
+        delay = self.initial_delay
+        attempt = 0
+
+        previous_end_time = getattr(RetryPolicy.local, "end_time", None)
+
+        try:
+            while True:
+                RetryPolicy.local.end_time = end_time
+                yield attempt
+                attempt += 1
+
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    logging.warning(
+                        "Giving up %s operation after %d attempts (deadline %ss)",
+                        self.name,
+                        attempt,
+                        deadline,
+                    )
+                    return
+
+                # Sleep between half and the full delay, but never past the deadline
+                time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+                delay = min(self.max_delay, delay * self.multiplier)
+        finally:
+            RetryPolicy.local.end_time = previous_end_time
+
+    @staticmethod
+    def remaining_time():
+        """
+        Get the time (in seconds) left until the deadline of the running call
+        of the current thread, None if no call is running
+        """
+        end_time = getattr(RetryPolicy.local, "end_time", None)
+
+        if end_time is None:
+            return None
+
+        return max(0, end_time - time.monotonic())
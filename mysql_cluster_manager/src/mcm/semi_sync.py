@@ -0,0 +1,225 @@
+"""This file contains the semi-synchronous replication of the cluster manager"""
+
+import logging
+import socket
+import time
+
+from mcm.config import Config
+from mcm.consul import Consul
+from mcm.mysql import Mysql
+
+
+class SemiSync:
+    """
+    Optional semi-synchronous replication. The leader waits for the
+    acknowledgement of a majority of the nodes (counting itself) before a
+    commit returns. The number of acknowledgements follows the healthy
+    replicas in Consul, the timeout follows the measured round-trip time
+    to the replicas.
+    """
+
+    # The adaptive timeout is rtt_factor times the round-trip time of the
+    # slowest replica that has to acknowledge, within these bounds (in ms)
+    rtt_factor = 20
+    timeout_min_ms = 100
+    timeout_max_ms = 10000
+
+    # Weight of a new round-trip time measurement (exponential smoothing)
+    rtt_smoothing = 0.3
+
+    # Interval (in seconds) of the commit latency report
+    report_interval = 60
+
+    # The smoothed round-trip times (in ms) per replica
+    _replica_rtt_ms = {}
+
+    # The applied source settings and the last report
+    _source_settings = None
+    _last_report = None
+
+    @staticmethod
+    def is_enabled():
+        """
+        Is semi-synchronous replication enabled
+        """
+        return Config.get().semi_sync
+
+    @staticmethod
+    def get_plugin_options():
+        """
+        Get the server options loading the plugins. All nodes load both
+        plugins, as every node can become the leader.
+        """
+        return [
+            "plugin-load-add=semisync_source.so",
+            "plugin-load-add=semisync_replica.so",
+        ]
+
+    @staticmethod
+    def set_replica_enabled(enabled):
+        """
+        Enable or disable the replica side (takes effect on the next start
+        of the replication IO thread)
+        """
+        Mysql.execute_query_as_root(
+            f"SET GLOBAL rpl_semi_sync_replica_enabled = {int(enabled)}",
+            discard_result=True,
+        )
+
+    @staticmethod
+    def disable_source():
+        """
+        Disable the source side (e.g., on demotion to a replica)
+        """
+        Mysql.execute_query_as_root(
+            "SET GLOBAL rpl_semi_sync_source_enabled = 0", discard_result=True
+        )
+        SemiSync._source_settings = None
+        SemiSync._last_report = None
+
+    @staticmethod
+    def measure_round_trip_ms(ip_address):
+        """
+        Measure the round-trip time (in ms) to a replica with a TCP handshake
+        on the MySQL port. Returns None if the replica is not reachable.
+        """
+        start = time.monotonic()
+
+        try:
+            with socket.create_connection((ip_address, 3306), timeout=1):
+                pass
+        except OSError:
+            return None
+
+        return (time.monotonic() - start) * 1000
+
+    @staticmethod
+    def get_timeout_ms(replica_ips, wait_count):
+        """
+        Get the source timeout (in ms) for the given replicas
+        """
+        configured = Config.get().semi_sync_timeout_ms
+        if configured > 0:
+            return configured
+
+        for ip_address in replica_ips:
+            rtt_ms = SemiSync.measure_round_trip_ms(ip_address)
+            if rtt_ms is None:
+                continue
+
+            smoothed = SemiSync._replica_rtt_ms.get(ip_address, rtt_ms)
+            SemiSync._replica_rtt_ms[ip_address] = (
+                1 - SemiSync.rtt_smoothing
+            ) * smoothed + SemiSync.rtt_smoothing * rtt_ms
+
+        rtts = sorted(
+            SemiSync._replica_rtt_ms[ip_address]
+            for ip_address in replica_ips
+            if ip_address in SemiSync._replica_rtt_ms
+        )
+
+        if len(rtts) < wait_count:
+            return SemiSync.timeout_max_ms
+
+        # Round to 10 ms, so measurement noise does not change the setting
+        timeout_ms = round(rtts[wait_count - 1] * SemiSync.rtt_factor, -1)
+
+        return int(
+            min(max(timeout_ms, SemiSync.timeout_min_ms), SemiSync.timeout_max_ms)
+        )
+
+    @staticmethod
+    def tune_source(replica_ips):
+        """
+        Adapt the source side to the healthy replicas (on the leader)
+        """
+        # Acknowledgements needed for a majority of the nodes (counting the leader)
+        wait_count = (len(replica_ips) + 1) // 2
+
+        for ip_address in list(SemiSync._replica_rtt_ms):
+            if ip_address not in replica_ips:
+                del SemiSync._replica_rtt_ms[ip_address]
+
+        if wait_count == 0:
+            settings = (False, None, None)
+        else:
+            timeout_ms = SemiSync.get_timeout_ms(replica_ips, wait_count)
+            settings = (True, wait_count, timeout_ms)
+
+        if settings != SemiSync._source_settings:
+            enabled, wait_count, timeout_ms = settings
+
+            if enabled:
+                logging.info(
+                    "Semi-sync replication waits for %d of %d replicas (timeout=%dms)",
+                    wait_count,
+                    len(replica_ips),
+                    timeout_ms,
+                )
+                Mysql.execute_query_as_root(
+                    f"SET GLOBAL rpl_semi_sync_source_wait_for_replica_count = {wait_count}",
+                    discard_result=True,
+                )
+                Mysql.execute_query_as_root(
+                    f"SET GLOBAL rpl_semi_sync_source_timeout = {timeout_ms}",
+                    discard_result=True,
+                )
+            else:
+                logging.info("No healthy replica, semi-sync replication is paused")
+
+            Mysql.execute_query_as_root(
+                f"SET GLOBAL rpl_semi_sync_source_enabled = {int(enabled)}",
+                discard_result=True,
+            )
+            SemiSync._source_settings = settings
+
+        if SemiSync._last_report is None or (
+            time.monotonic() - SemiSync._last_report[0] >= SemiSync.report_interval
+        ):
+            SemiSync.report()
+
+    @staticmethod
+    def report():
+        """
+        Report the commit latency added by semi-sync replication since the
+        last report, and publish it in the node document
+        """
+        status = {
+            row["Variable_name"]: row["Value"]
+            for row in Mysql.execute_query_as_root(
+                "SHOW GLOBAL STATUS LIKE 'Rpl_semi_sync_source_%'"
+            )
+        }
+
+        wait_time_us = int(status.get("Rpl_semi_sync_source_tx_wait_time", 0))
+        waits = int(status.get("Rpl_semi_sync_source_tx_waits", 0))
+        acknowledged = int(status.get("Rpl_semi_sync_source_yes_tx", 0))
+        timed_out = int(status.get("Rpl_semi_sync_source_no_tx", 0))
+
+        now = time.monotonic()
+        last_report = SemiSync._last_report
+        SemiSync._last_report = (now, wait_time_us, waits, acknowledged, timed_out)
+
+        if last_report is None:
+            return
+
+        _, last_wait_time_us, last_waits, last_acknowledged, last_timed_out = (
+            last_report
+        )
+
+        commit_wait_us = 0
+        if waits > last_waits:
+            commit_wait_us = (wait_time_us - last_wait_time_us) // (waits - last_waits)
+
+        logging.info(
+            "Semi-sync replication added %.3fms per commit "
+            "(status=%s, acknowledged=%d, timed out=%d)",
+            commit_wait_us / 1000,
+            status.get("Rpl_semi_sync_source_status", "OFF"),
+            acknowledged - last_acknowledged,
+            timed_out - last_timed_out,
+        )
+
+        Consul.get_instance().update_node_document(
+            "update semi-sync commit latency", semi_sync_commit_wait_us=commit_wait_us
+        )
@@ -0,0 +1,102 @@
+"""This file contains the keep-alive scheduler of the Consul sessions"""
+
+import logging
+import threading
+import time
+
+
+class SessionKeepAlive:
+    """
+    Renews the node health session at a fraction of its TTL, independent
+    of the main event loop. All timings are monotonic.
+    """
+
+    def __init__(self, consul, ttl, fraction=1 / 3):
+        """
+        Init the scheduler
+        """
+        self.consul = consul
+        self.ttl = ttl
+        self.interval = ttl * fraction
+
+        # Metrics of the last renewal (in seconds)
+        self.last_renewal = None
+        self.last_latency = None
+        self.last_slack = None
+
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def is_running(self):
+        """
+        Is the scheduler running
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """
+        Start the scheduler thread
+        """
+        if self.is_running():
+            return
+
+        logging.info(
+            "Starting the Consul session keep-alive (ttl=%ss, interval=%.1fs)",
+            self.ttl,
+            self.interval,
+        )
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the scheduler thread
+        """
+        if self.thread is None:
+            return
+
+        logging.info("Stopping the Consul session keep-alive")
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        logging.info("Consul session keep-alive is stopped")
+
+    def run(self):
+        """
+        Renew the session until stopped
+        """
+        next_renewal = time.monotonic()
+
+        while not self.stop_event.wait(max(0, next_renewal - time.monotonic())):
+            started = time.monotonic()
+            next_renewal = started + self.interval
+
+            renewed = self.consul.refresh_sessions()
+            finished = time.monotonic()
+            self.last_latency = finished - started
+
+            if not renewed:
+                # The session was recreated, start a new TTL period
+                self.last_renewal = finished
+                self.last_slack = None
+                continue
+
+            # The slack is the TTL left at the time the renewal was applied
+            if self.last_renewal is not None:
+                self.last_slack = self.ttl - (finished - self.last_renewal)
+
+            self.last_renewal = finished
+
+            if self.last_slack is not None and self.last_slack < self.interval:
+                logging.warning(
+                    "Consul session renewal is late (latency=%.3fs, slack=%.3fs)",
+                    self.last_latency,
+                    self.last_slack,
+                )
+            else:
+                logging.debug(
+                    "Consul session renewed (latency=%.3fs, slack=%s)",
+                    self.last_latency,
+                    self.last_slack,
+                )
@@ -0,0 +1,247 @@
+"""This file contains the resource-based sizing of the MySQL server"""
+
+import glob
+import logging
+import math
+import os
+
+from mcm.config import Config
+
+MIB = 1024 * 1024
+GIB = 1024 * MIB
+
+
+class Sizing:
+    """
+    Derives the InnoDB settings from the cgroup (v1 or v2) memory and CPU
+    limits of the container and the device of the data volume. Options set
+    in an operator configuration file or via environment variable win.
+    """
+
+    cgroup_root = "/sys/fs/cgroup"
+    mysql_config_file = "/etc/my.cnf"
+    generated_config_file = "/etc/mysql/conf.d/zz_cluster.cnf"
+
+    # Memory left for ProxySQL, Consul and the cluster manager
+    reserved_memory = 512 * MIB
+
+    # Share of the remaining memory used for the buffer pool
+    buffer_pool_ratio = 0.6
+
+    # Bounds of the redo log capacity
+    redo_log_capacity_min = 100 * MIB
+    redo_log_capacity_max = 16 * GIB
+
+    # Options with an environment override as (option, config attribute)
+    overrides = (
+        ("innodb_buffer_pool_size", "innodb_buffer_pool_size"),
+        ("innodb_redo_log_capacity", "innodb_redo_log_capacity"),
+        ("innodb_io_capacity", "innodb_io_capacity"),
+    )
+
+    @staticmethod
+    def read_cgroup_file(*paths):
+        """
+        Get the stripped content of the first readable cgroup file
+        """
+        for path in paths:
+            try:
+                with open(os.path.join(Sizing.cgroup_root, path), "r") as file:
+                    return file.read().strip()
+            except OSError:
+                continue
+
+        return None
+
+    @staticmethod
+    def get_memory_limit():
+        """
+        Get the memory (in bytes) available to the container
+        """
+        host_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+        # cgroup v2 ("max" if unlimited), then cgroup v1 (a huge value if unlimited)
+        limit = Sizing.read_cgroup_file("memory.max", "memory/memory.limit_in_bytes")
+
+        if limit is None or not limit.isdigit():
+            return host_memory
+
+        return min(int(limit), host_memory)
+
+    @staticmethod
+    def get_available_cpus():
+        """
+        Get the number of CPUs available to the container, the CPU quota
+        rounded up
+        """
+        cpus = len(os.sched_getaffinity(0))
+        quota = None
+        period = None
+
+        cpu_max = Sizing.read_cgroup_file("cpu.max")
+        if cpu_max is not None:
+            # cgroup v2: "<quota> <period>", quota is "max" if unlimited
+            values = cpu_max.split()
+            if len(values) == 2 and values[0].isdigit():
+                quota, period = int(values[0]), int(values[1])
+        else:
+            # cgroup v1: quota is -1 if unlimited
+            cfs_quota = Sizing.read_cgroup_file(
+                "cpu/cpu.cfs_quota_us", "cpu,cpuacct/cpu.cfs_quota_us"
+            )
+            cfs_period = Sizing.read_cgroup_file(
+                "cpu/cpu.cfs_period_us", "cpu,cpuacct/cpu.cfs_period_us"
+            )
+            if cfs_quota is not None and cfs_quota.isdigit() and cfs_period:
+                quota, period = int(cfs_quota), int(cfs_period)
+
+        if quota is not None and period:
+            cpus = min(cpus, max(1, math.ceil(quota / period)))
+
+        return cpus
+
+    @staticmethod
+    def is_rotational(path):
+        """
+        Test if the block device of the path is rotational. Returns None if
+        the device is unknown (e.g., an overlay or network filesystem).
+        """
+        try:
+            device = os.stat(path).st_dev
+        except OSError:
+            return None
+
+        block_path = f"/sys/dev/block/{os.major(device)}:{os.minor(device)}"
+
+        # Partitions have no queue of their own, use the parent device
+        for queue in ("queue/rotational", "../queue/rotational"):
+            try:
+                with open(os.path.join(block_path, queue), "r") as file:
+                    return file.read().strip() == "1"
+            except OSError:
+                continue
+
+        return None
+
+    @staticmethod
+    def get_configured_options(path=None, visited=None):
+        """
+        Get the server options set in the MySQL configuration files, except
+        the generated file. Follows !include and !includedir directives.
+        """
+        if path is None:
+            path = Sizing.mysql_config_file
+
+        if visited is None:
+            visited = set()
+
+        options = set()
+
+        if path in visited or path == Sizing.generated_config_file:
+            return options
+
+        visited.add(path)
+
+        try:
+            with open(path, "r") as file:
+                lines = file.readlines()
+        except OSError:
+            return options
+
+        server_section = False
+
+        for line in lines:
+            line = line.strip()
+
+            if line.startswith("!includedir"):
+                directory = line.split(None, 1)[1]
+                for include in sorted(glob.glob(os.path.join(directory, "*.cnf"))):
+                    options |= Sizing.get_configured_options(include, visited)
+                continue
+
+            if line.startswith("!include"):
+                options |= Sizing.get_configured_options(
+                    line.split(None, 1)[1], visited
+                )
+                continue
+
+            if not line or line[0] in "#;":
+                continue
+
+            if line.startswith("["):
+                section = line.strip("[]").strip().lower()
+                server_section = section in ("mysqld", "server") or section.startswith(
+                    "mysqld-"
+                )
+                continue
+
+            if server_section:
+                option = line.split("=", 1)[0].strip().lower().replace("-", "_")
+                options.add(option.removeprefix("loose_"))
+
+        return options
+
+    @staticmethod
+    def build_options(datadir):
+        """
+        Get the tuned server options as (option, value) tuples
+        """
+        memory = Sizing.get_memory_limit()
+        cpus = Sizing.get_available_cpus()
+        rotational = Sizing.is_rotational(datadir)
+
+        logging.info(
+            "Sizing MySQL for %d MiB memory, %d CPUs and %s storage",
+            memory // MIB,
+            cpus,
+            {True: "rotational", False: "solid-state", None: "unknown"}[rotational],
+        )
+
+        # Whole multiples of the default chunk size (128 MiB)
+        buffer_pool = (memory - Sizing.reserved_memory) * Sizing.buffer_pool_ratio
+        buffer_pool = max(128 * MIB, int(buffer_pool) // (128 * MIB) * (128 * MIB))
+
+        redo_log_capacity = min(
+            max(buffer_pool // 4, Sizing.redo_log_capacity_min),
+            Sizing.redo_log_capacity_max,
+        )
+
+        options = [
+            ("innodb_buffer_pool_size", buffer_pool),
+            ("innodb_redo_log_capacity", redo_log_capacity),
+            ("innodb_read_io_threads", max(4, cpus // 2)),
+            ("innodb_write_io_threads", max(4, cpus // 2)),
+            ("innodb_parallel_read_threads", max(4, cpus)),
+        ]
+
+        if rotational is True:
+            options += [("innodb_io_capacity", 200), ("innodb_io_capacity_max", 2000)]
+        elif rotational is False:
+            options += [("innodb_io_capacity", 2000), ("innodb_io_capacity_max", 4000)]
+
+        # Environment overrides replace the tuned value
+        config = Config.get()
+        overridden = {}
+
+        for option, attribute in Sizing.overrides:
+            value = getattr(config, attribute)
+            if value is not None:
+                overridden[option] = value
+
+        options = [(option, overridden.pop(option, value)) for option, value in options]
+        options += list(overridden.items())
+
+        # Options of operator configuration files are not written at all
+        configured = Sizing.get_configured_options()
+        skipped = set(configured)
+
+        for option, _ in options:
+            if option in configured:
+                logging.info("Using %s from the MySQL configuration files", option)
+
+        # The I/O capacity must not exceed its maximum, which is left to MySQL
+        # (twice the I/O capacity) once the capacity is set by the operator
+        if "innodb_io_capacity" in configured or config.innodb_io_capacity:
+            skipped.add("innodb_io_capacity_max")
+
+        return [(option, value) for option, value in options if option not in skipped]
@@ -6,9 +6,9 @@ import subprocess
 import time
 from shutil import move, rmtree
 
+from mcm.config import Config
 from mcm.consul import Consul
 from mcm.mysql import Mysql
-from mcm.utils import Utils
 
 
 class Snapshot:
@@ -59,18 +59,18 @@ class Snapshot:
 
         retryCounter = 100
 
+        # Keep consul sessions alive while waiting
+        Consul.get_instance().start_session_keepalive()
+
         for _ in range(retryCounter):
-            if not Snapshot.isPending() and Snapshot.exists():
+            pending = Snapshot.isPending()
+            exists = Snapshot.exists()
+
+            if not pending and exists:
                 return True
 
-            logging.debug(
-                "Still waiting for snapshot (%s, %s)",
-                Snapshot.isPending(),
-                Snapshot.exists(),
-            )
+            logging.debug("Still waiting for snapshot (%s, %s)", pending, exists)
 
-            # Keep consul sessions alive
-            Consul.get_instance().refresh_sessions()
             time.sleep(5)
 
         return False
@@ -81,23 +81,24 @@ class Snapshot:
 
         retryCounter = 100
 
+        # Keep consul sessions alive while waiting
+        Consul.get_instance().start_session_keepalive()
+
         for _ in range(retryCounter):
-            if (
-                Snapshot.exists()
-                and not Snapshot.isPending()
-                and not Consul.get_instance().are_nodes_restoring()
-            ):
+            pending = Snapshot.isPending()
+            exists = Snapshot.exists()
+            restoring = Consul.get_instance().are_nodes_restoring()
+
+            if exists and not pending and not restoring:
                 return True
 
             logging.debug(
                 "Still waiting for snapshot and restores (%s, %s, %s)",
-                Snapshot.isPending(),
-                Snapshot.exists(),
-                Consul.get_instance().are_nodes_restoring(),
+                pending,
+                exists,
+                restoring,
             )
 
-            # Keep consul sessions alive
-            Consul.get_instance().refresh_sessions()
             time.sleep(5)
 
         return False
@@ -136,8 +137,8 @@ class Snapshot:
             Snapshot.is_snapshotting = True
 
             # Create mysql backup
-            backupUser = Utils.get_envvar_or_secret("MYSQL_BACKUP_USER")
-            backupPass = Utils.get_envvar_or_secret("MYSQL_BACKUP_PASSWORD")
+            backupUser = Config.get().mysql_backup_user
+            backupPass = Config.get().mysql_backup_password
             xtrabackup = [
                 Mysql.xtrabackup_binary,
                 f"--user={backupUser}",
@@ -201,6 +202,9 @@ class Snapshot:
 
         oldMysqlDir = None
 
+        # The server id lease belongs to this node, not to the snapshot
+        serverIdLease = Mysql.read_server_id_lease()
+
         try:
             Consul.get_instance().node_set_restoring_flag(restoring=True)
 
@@ -235,6 +239,8 @@ class Snapshot:
             chown = ["chown", "mysql.mysql", "-R", "/var/lib/mysql/"]
             subprocess.run(chown, check=True)
 
+            Mysql.write_server_id_lease(serverIdLease)
+
             # Delete backup MySQL directory
             if oldMysqlDir:
                 logging.info("Removing old MySQL data from %s", oldMysqlDir)
@@ -28,6 +28,7 @@ AVAILABLE_OPERATIONS = [
     "mysql_autobackup",
     "proxysql_init",
     "execute_file",
+    "switchover",
 ]
 
 parser.add_argument(
@@ -36,6 +37,12 @@ parser.add_argument(
     help=f"Operation to be executed ({AVAILABLE_OPERATIONS})",
 )
 
+parser.add_argument(
+    "--target",
+    default=None,
+    help="IP address of the new replication leader (switchover, default: the most up-to-date replica)",
+)
+
 log_levels = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
 parser.add_argument("--log-level", default="INFO", choices=log_levels)
 
@@ -76,10 +83,13 @@ try:
     # Perform operations
     if args.operation == "join_or_bootstrap":
         signal.signal(signal.SIGTERM, Actions.terminate_handler)
+        signal.signal(signal.SIGHUP, Actions.reload_handler)
         Actions.join_or_bootstrap()
     elif args.operation == "execute_file":
         signal.signal(signal.SIGTERM, Actions.terminate_handler)
         Actions.execute_file()
+    elif args.operation == "switchover":
+        Actions.switchover(args.target)
     elif args.operation == "mysql_backup":
         Snapshot.create()
     elif args.operation == "mysql_restore":
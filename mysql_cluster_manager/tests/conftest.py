@@ -0,0 +1,63 @@
+"""Shared fixtures of the cluster manager tests"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from mcm.config import Config
+from mcm.consul import Consul
+from mcm.consul_memory import InMemoryConsul
+from mcm.proxysql import Proxysql
+
+
+@pytest.fixture
+def config(monkeypatch):
+    """
+    A fresh configuration state, the environment of the configuration can be
+    changed through the returned monkeypatch
+    """
+    for _, variable, _, _ in Config.settings:
+        monkeypatch.delenv(variable, raising=False)
+        monkeypatch.delenv(f"{variable}_FILE", raising=False)
+
+    monkeypatch.setattr(Config, "_current", None)
+    monkeypatch.setattr(Config, "_reload_requested", False)
+    monkeypatch.setattr(Config, "_last_check", 0)
+    monkeypatch.setattr(Config, "_secret_mtimes", {})
+    return monkeypatch
+
+
+@pytest.fixture
+def store():
+    """
+    The in-memory Consul store shared by all nodes of a test
+    """
+    return InMemoryConsul()
+
+
+@pytest.fixture
+def consul(store, monkeypatch):
+    """
+    The Consul singleton of the local node (10.0.0.2), backed by the
+    in-memory store
+    """
+    monkeypatch.setattr(Consul, "local_ip_address", "10.0.0.2")
+    Consul.reset_instance()
+    consul_client = Consul(client=store)
+    yield consul_client
+    Consul.reset_instance()
+
+
+@pytest.fixture
+def proxysql_queries(monkeypatch):
+    """
+    The SQL statements sent to the ProxySQL admin interface
+    """
+    queries = []
+    monkeypatch.setattr(
+        Proxysql, "perform_sql_query", staticmethod(lambda sql: queries.append(sql))
+    )
+    return queries
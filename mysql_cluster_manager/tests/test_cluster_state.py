@@ -0,0 +1,74 @@
+"""Tests of the cached cluster state"""
+
+import json
+
+from mcm.cluster_state import ClusterState
+
+
+def entry(ip_address, modify_index, **fields):
+    """
+    Get the KV entry of a node document
+    """
+    node_data = dict({"ip_address": ip_address}, **fields)
+
+    return {
+        "Key": f"mcm/instances/{ip_address}",
+        "Value": json.dumps(node_data).encode(),
+        "ModifyIndex": modify_index,
+    }
+
+
+def test_aggregates():
+    """
+    The routable nodes and the flags are computed from the node documents
+    """
+    state = ClusterState().update(
+        10,
+        [
+            entry("10.0.0.3", 5),
+            entry("10.0.0.2", 6),
+            entry("10.0.0.4", 7, snapshotting=True),
+            entry("10.0.0.5", 8, replication_unhealthy=True),
+        ],
+    )
+
+    assert state.routable_ips == ("10.0.0.2", "10.0.0.3")
+    assert state.any_snapshotting
+    assert not state.any_restoring
+
+
+def test_unchanged_index():
+    """
+    The same state is returned for an unchanged index
+    """
+    state = ClusterState().update(10, [entry("10.0.0.2", 5)])
+
+    assert state.update(10, []) is state
+
+
+def test_unchanged_nodes_are_reused():
+    """
+    Only nodes with a changed ModifyIndex are parsed again
+    """
+    state = ClusterState().update(10, [entry("10.0.0.2", 5), entry("10.0.0.3", 6)])
+    updated = state.update(
+        11, [entry("10.0.0.2", 5), entry("10.0.0.3", 11, restoring=True)]
+    )
+
+    key = "mcm/instances/10.0.0.2"
+    assert updated.nodes[key] is state.nodes[key]
+    assert updated.any_restoring
+    assert updated.routable_ips == ("10.0.0.2",)
+
+
+def test_invalid_and_removed_nodes():
+    """
+    Invalid documents are skipped and removed nodes are dropped
+    """
+    state = ClusterState().update(10, [entry("10.0.0.2", 5), entry("10.0.0.3", 6)])
+    invalid = {"Key": "mcm/instances/10.0.0.4", "Value": b"{", "ModifyIndex": 7}
+
+    updated = state.update(11, [entry("10.0.0.2", 5), invalid])
+
+    assert updated.routable_ips == ("10.0.0.2",)
+    assert ClusterState().update(12, None).nodes == {}
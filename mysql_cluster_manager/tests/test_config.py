@@ -0,0 +1,76 @@
+"""Tests of the runtime configuration"""
+
+import os
+
+import pytest
+
+from mcm.config import Config
+
+
+def test_defaults_and_types(config):
+    """
+    Settings are typed, unset settings fall back to their defaults
+    """
+    config.setenv("MYSQL_REPLICATION_LAG_THRESHOLD", "7")
+    config.setenv("MYSQL_SEMI_SYNC", "True")
+
+    current = Config.get()
+
+    assert current.replication_lag_threshold == 7
+    assert current.replication_routing_lag_ms == 7000
+    assert current.semi_sync is True
+    assert current.heartbeat_interval_ms == 100
+    assert current.mysql_root_password is None
+    assert current.tls_enabled is False
+
+
+def test_immutable(config):
+    """
+    The configuration can not be modified
+    """
+    with pytest.raises(AttributeError):
+        Config.get().heartbeat_interval_ms = 0
+
+
+def test_reload_on_request(config):
+    """
+    The environment is only read again after a reload was requested
+    """
+    config.setenv("MYSQL_HEARTBEAT_INTERVAL_MS", "100")
+    first = Config.get()
+
+    config.setenv("MYSQL_HEARTBEAT_INTERVAL_MS", "250")
+    assert Config.get() is first
+
+    Config.request_reload()
+    assert Config.get().heartbeat_interval_ms == 250
+
+
+def test_reload_on_secret_change(config, tmp_path):
+    """
+    A changed secret file is picked up on the next check
+    """
+    secret_file = tmp_path / "root_password"
+    secret_file.write_text("first\n")
+    config.setenv("MYSQL_ROOT_PASSWORD_FILE", str(secret_file))
+
+    assert Config.get().mysql_root_password == "first"
+
+    secret_file.write_text("second\n")
+    stat = os.stat(secret_file)
+    os.utime(secret_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    config.setattr(Config, "_last_check", 0)
+
+    assert Config.get().mysql_root_password == "second"
+
+
+def test_invalid_reload_keeps_configuration(config):
+    """
+    An invalid value keeps the current configuration
+    """
+    first = Config.get()
+
+    config.setenv("MYSQL_HEARTBEAT_INTERVAL_MS", "fast")
+    Config.request_reload()
+
+    assert Config.get() is first
@@ -0,0 +1,145 @@
+"""Tests of the in-memory Consul stand-in"""
+
+import base64
+import threading
+
+import pytest
+from consul.exceptions import ClientError
+
+
+def test_cas_write(store):
+    """
+    A CAS write only succeeds on the current ModifyIndex, CAS 0 only creates
+    """
+    assert store.kv.put("key", "a", cas=0)
+    assert not store.kv.put("key", "b", cas=0)
+
+    index = store.kv.get("key")[1]["ModifyIndex"]
+    assert not store.kv.put("key", "b", cas=index + 100)
+    assert store.kv.put("key", "b", cas=index)
+    assert store.kv.get("key")[1]["Value"] == b"b"
+
+
+def test_session_behavior(store):
+    """
+    Locks are deleted or released with their session, depending on the
+    session behavior
+    """
+    delete_session = store.session.create(behavior="delete", lock_delay=0)
+    release_session = store.session.create(behavior="release", lock_delay=0)
+
+    assert store.kv.put("deleted", "a", acquire=delete_session)
+    assert store.kv.put("released", "b", acquire=release_session)
+    assert not store.kv.put("released", "c", acquire=delete_session)
+
+    store.session.destroy(delete_session)
+    store.session.destroy(release_session)
+
+    assert store.kv.get("deleted")[1] is None
+    released = store.kv.get("released")[1]
+    assert released["Value"] == b"b"
+    assert "Session" not in released
+
+
+def test_recurse_get(store):
+    """
+    A recursive get returns all keys of the prefix, sorted
+    """
+    store.kv.put("prefix/b", "2")
+    store.kv.put("prefix/a", "1")
+    store.kv.put("other", "3")
+
+    entries = store.kv.get("prefix/", recurse=True)[1]
+    assert [entry["Key"] for entry in entries] == ["prefix/a", "prefix/b"]
+    assert store.kv.get("missing/", recurse=True)[1] is None
+
+
+def test_blocking_query(store):
+    """
+    A blocking query returns on a change, or unchanged after the wait time
+    """
+    store.kv.put("key", "a")
+    index = store.kv.get("key")[0]
+
+    assert store.kv.get("key", index=index, wait="50ms")[0] == index
+
+    timer = threading.Timer(0.05, lambda: store.kv.put("key", "b"))
+    timer.start()
+    new_index, entry = store.kv.get("key", index=index, wait="5s")
+    timer.join()
+
+    assert int(new_index) > int(index)
+    assert entry["Value"] == b"b"
+
+
+def encode(value):
+    """
+    Encode a transaction value
+    """
+    return base64.b64encode(value.encode()).decode()
+
+
+def test_transaction_rollback(store):
+    """
+    A failed operation rolls back the whole transaction with a 409
+    """
+    store.kv.put("existing", "a")
+
+    with pytest.raises(ClientError, match="409"):
+        store.txn.put(
+            [
+                {"KV": {"Verb": "set", "Key": "new", "Value": encode("b")}},
+                {"KV": {"Verb": "cas", "Key": "existing", "Index": 0}},
+            ]
+        )
+
+    assert store.kv.get("new")[1] is None
+
+
+def test_transaction_rollback_on_rejected_operation(store):
+    """
+    An operation raising an error (e.g., an invalid session) also rolls
+    back the transaction
+    """
+    with pytest.raises(ClientError, match="409"):
+        store.txn.put(
+            [
+                {"KV": {"Verb": "set", "Key": "new", "Value": encode("b")}},
+                {
+                    "KV": {
+                        "Verb": "lock",
+                        "Key": "locked",
+                        "Value": encode("c"),
+                        "Session": "invalid",
+                    }
+                },
+            ]
+        )
+
+    assert store.kv.get("new")[1] is None
+    assert store.kv.get("locked")[1] is None
+
+
+def test_transaction_results(store):
+    """
+    A successful transaction applies all operations and returns the
+    metadata of the written keys
+    """
+    session = store.session.create(behavior="delete")
+
+    result = store.txn.put(
+        [
+            {"KV": {"Verb": "set", "Key": "a", "Value": encode("1")}},
+            {
+                "KV": {
+                    "Verb": "lock",
+                    "Key": "b",
+                    "Value": encode("2"),
+                    "Session": session,
+                }
+            },
+        ]
+    )
+
+    assert [item["KV"]["Key"] for item in result["Results"]] == ["a", "b"]
+    assert store.kv.get("b")[1]["Session"] == session
@@ -0,0 +1,63 @@
+"""Tests of the GTID set arithmetic"""
+
+from mcm.gtid import Gtid
+
+UUID = "3e11fa47-71ca-11e1-9e33-c80aa9429562"
+OTHER = "4e11fa47-71ca-11e1-9e33-c80aa9429562"
+
+
+def test_parse():
+    """
+    Intervals are merged per source, tags and case are normalized
+    """
+    parsed = Gtid.parse(f"{UUID.upper()}:1-5:7:6,\n{OTHER}:Tag:1-3:10")
+
+    assert parsed == {
+        UUID: [(1, 7)],
+        f"{OTHER}:tag": [(1, 3), (10, 10)],
+    }
+    assert Gtid.parse("") == {}
+
+
+def test_format_roundtrip():
+    """
+    A formatted set parses to the same set
+    """
+    gtid_set = f"{UUID}:1-5:7,{OTHER}:3"
+
+    assert Gtid.format(Gtid.parse(gtid_set)) == gtid_set
+
+
+def test_subtract():
+    """
+    The difference keeps the transactions missing in the subtrahend
+    """
+    received = Gtid.parse(f"{UUID}:1-100,{OTHER}:1-10")
+    executed = Gtid.parse(f"{UUID}:1-40:50-60,{OTHER}:1-10")
+
+    backlog = Gtid.subtract(received, executed)
+
+    assert backlog == {UUID: [(41, 49), (61, 100)]}
+    assert Gtid.count(backlog) == 49
+
+
+def test_union():
+    """
+    The union merges the intervals of both sets
+    """
+    first = Gtid.parse(f"{UUID}:1-5")
+    second = Gtid.parse(f"{UUID}:6-9,{OTHER}:1")
+
+    assert Gtid.union(first, second) == {UUID: [(1, 9)], OTHER: [(1, 1)]}
+
+
+def test_is_superset():
+    """
+    A set contains all of its subsets, but not sets with other transactions
+    """
+    executed = Gtid.parse(f"{UUID}:1-100")
+
+    assert Gtid.is_superset(executed, Gtid.parse(f"{UUID}:10-20"))
+    assert Gtid.is_superset(executed, {})
+    assert not Gtid.is_superset(executed, Gtid.parse(f"{UUID}:100-101"))
+    assert not Gtid.is_superset(executed, Gtid.parse(f"{OTHER}:1"))
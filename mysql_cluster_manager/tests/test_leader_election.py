@@ -0,0 +1,97 @@
+"""Tests of the replication leader promotion"""
+
+import json
+
+from mcm.cluster_state import ClusterState
+from mcm.consul import Consul
+from mcm.mysql import Mysql
+from mcm.proxysql import Proxysql
+
+
+def register_replica(store, ip_address, **fields):
+    """
+    Register the node document of another replica
+    """
+    session = store.session.create(behavior="delete", ttl=10)
+    node_document = dict(
+        {
+            "ip_address": ip_address,
+            "replication_unhealthy": False,
+            "replication_leader": False,
+        },
+        **fields,
+    )
+    store.kv.put(
+        f"{Consul.instances_path}{ip_address}",
+        json.dumps(node_document),
+        acquire=session,
+    )
+
+
+def writer_hostgroup(queries):
+    """
+    Get the servers inserted into the writer hostgroup
+    """
+    return [
+        sql
+        for sql in queries
+        if sql.startswith("INSERT INTO mysql_servers") and "VALUES (1," in sql
+    ]
+
+
+def test_promoted_flagged_replica_is_routed_as_writer(consul, store, proxysql_queries):
+    """
+    A replica flagged as lagging is promoted, the writer hostgroup must not
+    be empty afterwards
+    """
+    consul.register_node()
+    consul.node_set_replication_unhealthy_flag(True)
+    consul.node_set_replication_lag(9000, 50)
+    Mysql._replication_unhealthy_flag = True
+    register_replica(store, "10.0.0.3")
+
+    assert consul.get_all_registered_nodes() == ["10.0.0.3"]
+
+    assert consul.try_to_become_replication_leader()
+    Mysql.reset_replication_health()
+
+    node_document = json.loads(store.kv.get(consul.get_node_path())[1]["Value"])
+    assert node_document["replication_leader"] is True
+    assert node_document["replication_unhealthy"] is False
+    assert node_document["replication_lag_ms"] == 0
+    assert node_document["gtid_backlog"] == 0
+    assert Mysql._replication_unhealthy_flag is False
+
+    consul.cluster_state_read_time = None
+    mysql_nodes = consul.get_all_registered_nodes()
+    assert mysql_nodes == ["10.0.0.2", "10.0.0.3"]
+
+    Proxysql().update_mysql_server_if_needed(
+        mysql_nodes, consul.get_replication_leader_ip()
+    )
+
+    writers = writer_hostgroup(proxysql_queries)
+    assert len(writers) == 1
+    assert "'10.0.0.2'" in writers[0]
+
+
+def test_leader_is_always_routable():
+    """
+    The replication leader is routed even if a replica flag is still set
+    """
+    leader = {
+        "ip_address": "10.0.0.2",
+        "replication_leader": True,
+        "replication_unhealthy": True,
+    }
+    replica = dict(leader, ip_address="10.0.0.3", replication_leader=False)
+
+    assert ClusterState.is_routable(leader)
+    assert not ClusterState.is_routable(replica)
+
+    state = ClusterState(1, {"leader": leader, "replica": replica})
+    assert state.routable_ips == ("10.0.0.2",)
+
+    # The topology document marks the leader by its role
+    topology = ClusterState.from_topology(state.topology("10.0.0.2"))
+    assert topology.routable_ips == ("10.0.0.2",)
@@ -0,0 +1,83 @@
+"""Tests of the local node document"""
+
+import json
+
+
+def read_node_document(consul, store):
+    """
+    Get the node document of the local node as stored in Consul
+    """
+    entry = store.kv.get(consul.get_node_path())[1]
+    return None if entry is None else json.loads(entry["Value"])
+
+
+def test_unchanged_fields_are_not_written(consul, store):
+    """
+    Only changed fields cause a Consul write
+    """
+    consul.register_node()
+    index = consul.node_document_index
+
+    assert consul.node_set_snapshotting_flag(False)
+    assert consul.node_document_index == index
+
+    assert consul.node_set_snapshotting_flag(True)
+    assert consul.node_document_index != index
+    assert read_node_document(consul, store)["snapshotting"] is True
+
+
+def test_failed_update_is_published_on_reregistration(consul, store):
+    """
+    A flag cleared while the node key is gone must not come back with the
+    re-registration
+    """
+    consul.register_node()
+    consul.node_set_snapshotting_flag(True)
+
+    # The node key is deleted together with the invalidated session
+    store.session.destroy(consul.node_health_session)
+    assert read_node_document(consul, store) is None
+
+    assert not consul.node_set_snapshotting_flag(False)
+
+    consul.recreate_node_health_session()
+
+    assert read_node_document(consul, store)["snapshotting"] is False
+    consul.cluster_state_read_time = None
+    assert not consul.are_nodes_snapshotting()
+
+
+def test_small_lag_changes_are_not_written(consul, store):
+    """
+    The published lag only changes when the lag changes significantly
+    """
+    consul.register_node()
+    index = consul.node_document_index
+
+    for lag_ms, gtid_backlog in ((120, 3), (480, 17), (35, 0)):
+        assert consul.node_set_replication_lag(lag_ms, gtid_backlog)
+    assert consul.node_document_index == index
+
+    assert consul.node_set_replication_lag(2500, 350)
+    node_document = read_node_document(consul, store)
+    assert node_document["replication_lag_ms"] == 2000
+    assert node_document["gtid_backlog"] == 200
+
+
+def test_leadership_lost_with_session(consul, store):
+    """
+    Recreating the session of the leader drops the leadership and calls the
+    leadership lost callback
+    """
+    lost = []
+    consul.leadership_lost_callback = lambda: lost.append(True)
+
+    consul.register_node()
+    assert consul.try_to_become_replication_leader()
+
+    store.session.destroy(consul.node_health_session)
+    consul.recreate_node_health_session()
+
+    assert lost == [True]
+    assert consul.replication_leader is False
+    assert read_node_document(consul, store)["replication_leader"] is False
@@ -0,0 +1,66 @@
+"""Tests of the retry policy"""
+
+import time
+
+from mcm.retry import RetryPolicy
+
+
+def test_attempts_stop_at_deadline():
+    """
+    No further attempt is made once the deadline has passed
+    """
+    policy = RetryPolicy("test", deadline=0.2, initial_delay=0.01, max_delay=0.05)
+
+    started = time.monotonic()
+    attempts = list(policy.attempts())
+    elapsed = time.monotonic() - started
+
+    assert len(attempts) > 2
+    assert attempts == list(range(len(attempts)))
+    assert 0.2 <= elapsed < 1
+
+
+def test_attempts_stop_on_success():
+    """
+    Leaving the loop makes no further attempt
+    """
+    policy = RetryPolicy("test", deadline=5, initial_delay=0.01)
+    calls = []
+
+    for attempt in policy.attempts():
+        calls.append(attempt)
+        if attempt == 2:
+            break
+
+    assert calls == [0, 1, 2]
+
+
+def test_backoff_is_bounded():
+    """
+    The delay between attempts grows up to the maximum delay
+    """
+    policy = RetryPolicy("test", deadline=0.3, initial_delay=0.01, max_delay=0.02)
+    times = [time.monotonic() for _ in policy.attempts()]
+
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    assert max(gaps) < 0.05
+
+
+def test_remaining_time():
+    """
+    The remaining time is only known while a call runs, and a nested call
+    restores the deadline of the outer call
+    """
+    assert RetryPolicy.remaining_time() is None
+
+    for _ in RetryPolicy("outer", deadline=10).attempts():
+        assert 9 < RetryPolicy.remaining_time() <= 10
+
+        for _ in RetryPolicy("inner", deadline=1).attempts():
+            assert RetryPolicy.remaining_time() <= 1
+            break
+
+        assert RetryPolicy.remaining_time() > 9
+        break
+
+    assert RetryPolicy.remaining_time() is None
@@ -0,0 +1,82 @@
+"""Tests of the planned switchover"""
+
+import json
+
+from mcm.actions import Actions
+from mcm.consul import Consul
+from mcm.mysql import Mysql
+
+
+def new_consul(store, monkeypatch, ip_address):
+    """
+    Create the Consul singleton of another process on the given node
+    """
+    Consul.reset_instance()
+    monkeypatch.setattr(Consul, "local_ip_address", ip_address)
+    return Consul(client=store)
+
+
+def test_switchover_moves_leader_key_and_topology(consul, store, monkeypatch):
+    """
+    The switchover runs in its own process with its own session. The leader
+    key moves to the node session of the target, and the target must be able
+    to publish the topology document locked by the old leader.
+    """
+    target_session = store.session.create(behavior="delete", ttl=10)
+    store.kv.put(
+        f"{Consul.instances_path}10.0.0.3",
+        json.dumps({"ip_address": "10.0.0.3", "gtid_backlog": 0}),
+        acquire=target_session,
+    )
+
+    # The daemon of the old leader
+    daemon = consul
+    daemon.register_node()
+    assert daemon.try_to_become_replication_leader()
+    assert daemon.publish_topology()
+    daemon_session = daemon.node_health_session
+
+    monkeypatch.setattr(Mysql, "set_read_only", staticmethod(lambda read_only: None))
+    monkeypatch.setattr(
+        Mysql,
+        "execute_query_as_root",
+        staticmethod(lambda sql: [{"gtid_executed": "uuid:1-10"}]),
+    )
+    monkeypatch.setattr(
+        Mysql,
+        "wait_for_gtid_set_on_node",
+        staticmethod(lambda ip_address, gtid_set, timeout: True),
+    )
+    monkeypatch.setattr(
+        Mysql,
+        "execute_query_on_node",
+        staticmethod(lambda ip_address, sql: [{"read_only": 0}]),
+    )
+
+    # The switchover command on the old leader
+    command = new_consul(store, monkeypatch, "10.0.0.2")
+    assert command.node_health_session != daemon_session
+
+    Actions.switchover("10.0.0.3")
+
+    leader_entry = store.kv.get(Consul.replication_leader_path)[1]
+    assert leader_entry["Session"] == target_session
+    assert json.loads(leader_entry["Value"])["ip_address"] == "10.0.0.3"
+    assert store.session.info(command.node_health_session)[1] is None
+    assert store.session.info(daemon_session)[1] is not None
+    assert store.kv.get(Consul.topology_path)[1] is None
+
+    # The old leader published again before it noticed the handover
+    daemon.published_topology = None
+    assert daemon.publish_topology()
+    daemon.set_replication_leader_role(False)
+    assert store.kv.get(Consul.topology_path)[1] is None
+
+    # The target promotes itself with the session holding the leader key
+    new_leader = new_consul(store, monkeypatch, "10.0.0.3")
+    new_leader.node_health_session = target_session
+    new_leader.set_replication_leader_role(True)
+
+    topology = store.kv.get(Consul.topology_path)[1]
+    assert topology["Session"] == target_session
+    assert json.loads(topology["Value"])["leader"] == "10.0.0.3"